@@ -0,0 +1,534 @@
+"""
+Benchmark offline do storymaker (api.py) e do historia.py
+Troca o cliente do Gemini por um falso, com latências, erros e rajadas de 429
+configuráveis, e mede a vazão sem gastar cota nem depender de rede.
+
+Uso:
+    python benchmark.py api --clientes 4 --historias 12
+    python benchmark.py historia --historias 4
+    python benchmark.py api --progressivo --latencia-rascunho 4
+    python benchmark.py api --prazo 30 --sigma 0.8
+    python benchmark.py inicio --repeticoes 5
+Os resultados ficam em bench_results/ (JSON), para comparar execuções.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+
+try:
+    import resource  # só existe em Unix: sem ele, o pico de memória não é medido
+except ImportError:
+    resource = None
+
+from PIL import Image
+from google.genai import types, errors as genai_errors
+
+PASTA_RAIZ = os.path.dirname(os.path.abspath(__file__))
+PASTA_API = os.path.join(PASTA_RAIZ, "storymaker-app")
+PASTA_RESULTADOS = "bench_results"
+LADO_2K = 2048  # maior lado das imagens "2K"
+LADO_RASCUNHO = 1024  # os modelos de rascunho devolvem 1K
+
+# --- BACKEND FALSO DO GEMINI ---
+
+class FakeGemini:
+    """
+    Cliente falso com a mesma interface usada pelos scripts
+    (client.aio.models.generate_content, generate_content_stream e get).
+    - Latências log-normais em torno da mediana de cada modelo (os *flash-image*,
+      de rascunho no modo progressivo, usam `latencia_rascunho`)
+    - `taxa_erro` de falhas transitórias (503)
+    - Rajadas de 429: a cada `rajada_cada` segundos, todas as chamadas falham
+      durante `rajada_duracao` segundos
+    """
+
+    def __init__(self, latencia_texto=3.0, latencia_imagem=12.0, sigma=0.4,
+                 taxa_erro=0.0, rajada_cada=0.0, rajada_duracao=0.0, semente=None, latencia_rascunho=4.0):
+        self.latencia_texto = latencia_texto
+        self.latencia_imagem = latencia_imagem
+        self.latencia_rascunho = latencia_rascunho
+        self.sigma = sigma
+        self.taxa_erro = taxa_erro
+        self.rajada_cada = rajada_cada
+        self.rajada_duracao = rajada_duracao
+        self._random = random.Random(semente)
+        self._inicio = time.monotonic()
+        self._imagens = {}  # (proporção, lado) -> PNGs sintéticos já codificados
+        self.chamadas = {"texto": 0, "imagem": 0, "erros": 0, "rate_limit": 0}
+        self.aio = self  # client.aio.models -> self
+        self.models = self
+
+    def _latencia(self, mediana: float) -> float:
+        return mediana * math.exp(self._random.gauss(0, self.sigma))
+
+    def _falha(self):
+        """Levanta 429 durante uma rajada ou, com probabilidade taxa_erro, 503"""
+        decorrido = time.monotonic() - self._inicio
+        if self.rajada_cada and decorrido % self.rajada_cada < self.rajada_duracao:
+            self.chamadas["rate_limit"] += 1
+            raise genai_errors.ClientError(429, {"error": {
+                "code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Rajada de 429 simulada"}})
+        if self._random.random() < self.taxa_erro:
+            self.chamadas["erros"] += 1
+            raise genai_errors.ServerError(503, {"error": {
+                "code": 503, "status": "UNAVAILABLE", "message": "Falha transitória simulada"}})
+
+    def _historia_json(self) -> str:
+        n = self.chamadas["texto"]
+        return json.dumps({
+            "title": f"Benchmark {n}",
+            "cover_prompt": f"Capa cinematográfica da história {n}, luz dramática",
+            "parts": [[f"Texto da parte {i} da história {n}. " * 20, f"Ilustração da parte {i} da história {n}"]
+                      for i in range(1, 6)]
+        }, ensure_ascii=False)
+
+    @staticmethod
+    def _renderizar_png(proporcao: str, lado: int) -> bytes:
+        """
+        PNG (maior lado `lado`) com manchas suaves e um pouco de grão, perto de uma ilustração
+        de verdade (ruído puro deixaria o AVIF/WebP muito mais lentos que o real)
+        """
+        w, h = (int(x) for x in proporcao.split(":"))
+        escala = lado / max(w, h)
+        tamanho = (round(w * escala), round(h * escala))
+        manchas = [Image.effect_noise((w * 8, h * 8), 80).resize(tamanho, Image.Resampling.BICUBIC)
+                   for _ in range(3)]
+        img = Image.blend(Image.merge("RGB", manchas),
+                          Image.merge("RGB", [Image.effect_noise(tamanho, 20)] * 3), 0.1)
+        buffer = BytesIO()
+        img.save(buffer, "PNG", compress_level=1)
+        return buffer.getvalue()
+
+    async def _png(self, proporcao: str, lado: int) -> bytes:
+        if (proporcao, lado) not in self._imagens:
+            self._imagens[proporcao, lado] = await asyncio.to_thread(self._renderizar_png, proporcao, lado)
+        return self._imagens[proporcao, lado]
+
+    @staticmethod
+    def _resposta(part: types.Part) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=[part]))
+        ])
+
+    async def generate_content(self, model, contents, config=None):
+        self.chamadas["imagem"] += 1
+        rascunho = "flash-image" in model
+        await asyncio.sleep(self._latencia(self.latencia_rascunho if rascunho else self.latencia_imagem))
+        self._falha()
+        image_config = getattr(config, "image_config", None)
+        proporcao = getattr(image_config, "aspect_ratio", None) or "1:1"
+        dados = await self._png(proporcao, LADO_RASCUNHO if rascunho else LADO_2K)
+        return self._resposta(types.Part.from_bytes(data=dados, mime_type="image/png"))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.chamadas["texto"] += 1
+        texto = self._historia_json()
+        pedacos = [texto[i:i + 200] for i in range(0, len(texto), 200)]
+        latencia = self._latencia(self.latencia_texto)
+        # A falha acontece antes do primeiro pedaço, como num erro de conexão
+        self._falha()
+
+        async def gerar():
+            for pedaco in pedacos:
+                await asyncio.sleep(latencia / len(pedacos))
+                yield self._resposta(types.Part.from_text(text=pedaco))
+        return gerar()
+
+    async def get(self, model):
+        """Metadados do modelo: o aquecimento da API chama isso para abrir conexões"""
+        await asyncio.sleep(0.05)
+        return types.Model(name=f"models/{model}")
+
+# --- MEDIDAS ---
+
+class LoopLagProbe:
+    """Mede o atraso do event loop: acorda a cada `intervalo` e compara com o esperado"""
+
+    def __init__(self, intervalo: float = 0.05):
+        self.intervalo = intervalo
+        self.amostras = []
+        self._tarefa = None
+
+    async def _rodar(self):
+        while True:
+            esperado = time.perf_counter() + self.intervalo
+            await asyncio.sleep(self.intervalo)
+            self.amostras.append(max(0.0, time.perf_counter() - esperado))
+
+    def start(self):
+        self._tarefa = asyncio.create_task(self._rodar())
+
+    async def stop(self):
+        self._tarefa.cancel()
+        try:
+            await self._tarefa
+        except asyncio.CancelledError:
+            pass
+
+    def resumo(self) -> dict:
+        if not self.amostras:
+            return {}
+        ordenadas = sorted(self.amostras)
+        return {"p50Ms": round(percentil(ordenadas, 50) * 1000, 2),
+                "p99Ms": round(percentil(ordenadas, 99) * 1000, 2),
+                "maxMs": round(ordenadas[-1] * 1000, 2)}
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return None
+    indice = min(len(valores_ordenados) - 1, round(p / 100 * (len(valores_ordenados) - 1)))
+    return valores_ordenados[indice]
+
+def resumo_tempos(valores) -> dict:
+    ordenados = sorted(v for v in valores if v is not None)
+    if not ordenados:
+        return {}
+    return {"p50": round(percentil(ordenados, 50), 2), "p95": round(percentil(ordenados, 95), 2),
+            "max": round(ordenados[-1], 2), "mean": round(statistics.mean(ordenados), 2)}
+
+def pico_rss_mb() -> dict:
+    """Pico de memória deste processo e dos filhos já encerrados (pool de codificação)"""
+    if resource is None:
+        return {}
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor, 1)}
+
+def versao_git() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PASTA_RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def foto_sintetica(semente: int) -> bytes:
+    """Foto de referência falsa (JPEG 512px)"""
+    rnd = random.Random(semente)
+    img = Image.new("RGB", (512, 512), tuple(rnd.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+# --- CARGA NA API (SSE) ---
+
+async def cliente_sse(http, base_url: str, n: int, foto_b64: str, progressivo: bool = False) -> dict:
+    """
+    Cria uma história e acompanha o SSE até o fim, medindo os marcos. No modo
+    progressivo, "total" é o livro completo (rascunhos) e "finals" o fim das
+    versões finais.
+    """
+    corpo = {
+        "characters": [{"id": "bench", "name": "Bench", "images": [foto_b64]}],
+        "universe": {"id": "bench", "name": "Benchmark", "style": "ilustração digital"},
+        "description": f"História de benchmark {n}",  # descrições distintas: sem deduplicação
+        "use_cache": False,
+        "progressive": progressivo
+    }
+    inicio = time.perf_counter()
+    resultado = {"n": n, "status": "error", "firstImage": None, "total": None, "finals": None,
+                 "imagesDone": 0, "imagesUpgraded": 0, "degraded": False, "error": None}
+    try:
+        resposta = await http.post(f"{base_url}/api/create-story", json=corpo)
+        resposta.raise_for_status()
+        url_eventos = base_url + resposta.json()["eventsUrl"]
+        async with http.stream("GET", url_eventos) as sse:
+            async for linha in sse.aiter_lines():
+                if not linha.startswith("data: "):
+                    continue
+                evento = json.loads(linha[6:])
+                tipo = evento.get("type")
+                if tipo == "image_done":
+                    resultado["imagesDone"] += 1
+                    if resultado["firstImage"] is None:
+                        resultado["firstImage"] = time.perf_counter() - inicio
+                elif tipo == "image_upgraded":
+                    resultado["imagesUpgraded"] += 1
+                elif tipo in ("complete", "error"):
+                    if resultado["status"] == "complete":
+                        continue  # erro depois do livro completo: só as versões finais foram afetadas
+                    resultado["status"] = tipo
+                    resultado["error"] = evento.get("message") if tipo == "error" else None
+                    resultado["degraded"] = bool(evento.get("degraded"))
+                    resultado["total"] = time.perf_counter() - inicio
+                    if tipo == "error" or not progressivo:
+                        break
+        if progressivo and resultado["status"] == "complete":
+            resultado["finals"] = time.perf_counter() - inicio
+    except Exception as e:
+        resultado["error"] = str(e)
+    if resultado["total"] is None:
+        resultado["total"] = time.perf_counter() - inicio
+    return resultado
+
+async def benchmark_api(args, fake: FakeGemini, pasta_tmp: str) -> dict:
+    # A API lê as pastas do ambiente na importação: tudo vai para a pasta temporária
+    os.environ["STORIES_DIR"] = os.path.join(pasta_tmp, "historias")
+    os.environ["JOBS_DB"] = os.path.join(pasta_tmp, "jobs.db")
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(pasta_tmp, ".cache")
+    os.environ["CHARACTERS_DIR"] = os.path.join(pasta_tmp, "characters")
+    os.environ.setdefault("GEMINI_API_KEY", "offline")
+    if args.prazo:
+        os.environ["STORY_DEADLINE_SECONDS"] = str(args.prazo)
+    sys.path.insert(0, PASTA_API)
+    import api
+    import httpx
+    import uvicorn
+    api.client = fake
+
+    # Servidor e clientes no mesmo event loop: a carga dos clientes é pequena
+    # (só leitura de SSE) e o atraso medido é o que a API sentiria
+    config = uvicorn.Config(api.app, host="127.0.0.1", port=args.porta, log_level="warning", lifespan="on")
+    servidor = uvicorn.Server(config)
+    tarefa_servidor = asyncio.create_task(servidor.serve())
+    while not servidor.started:
+        if tarefa_servidor.done():
+            raise RuntimeError(f"O servidor não subiu na porta {args.porta}")
+        await asyncio.sleep(0.05)
+    porta = servidor.servers[0].sockets[0].getsockname()[1]  # porta 0 = qualquer uma livre
+    base_url = f"http://127.0.0.1:{porta}"
+
+    foto_b64 = "data:image/jpeg;base64," + base64.b64encode(foto_sintetica(0)).decode("ascii")
+    sonda = LoopLagProbe()
+    sonda.start()
+    fila = asyncio.Queue()
+    for n in range(args.historias):
+        fila.put_nowait(n)
+    resultados = []
+
+    async def cliente(http):
+        while not fila.empty():
+            resultados.append(await cliente_sse(http, base_url, fila.get_nowait(), foto_b64, args.progressivo))
+
+    inicio = time.perf_counter()
+    limites = httpx.Limits(max_connections=args.clientes * 2)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=None), limits=limites) as http:
+        await asyncio.gather(*(cliente(http) for _ in range(args.clientes)))
+        metricas = (await http.get(f"{base_url}/api/metrics")).text
+    duracao = time.perf_counter() - inicio
+    await sonda.stop()
+
+    servidor.should_exit = True
+    await tarefa_servidor
+
+    completas = [r for r in resultados if r["status"] == "complete"]
+    return {
+        "durationSeconds": round(duracao, 2),
+        "stories": len(resultados),
+        "completed": len(completas),
+        "degraded": sum(1 for r in completas if r["degraded"]),
+        "failed": len(resultados) - len(completas),
+        "storiesPerMinute": round(len(completas) / duracao * 60, 2),
+        "timeToFirstImageSeconds": resumo_tempos(r["firstImage"] for r in resultados),
+        "storySeconds": resumo_tempos(r["total"] for r in completas),
+        "finalImagesSeconds": resumo_tempos(r["finals"] for r in completas),
+        "imagesUpgraded": sum(r["imagesUpgraded"] for r in resultados),
+        "eventLoopLag": sonda.resumo(),
+        "peakRssMb": pico_rss_mb(),
+        "errors": sorted({r["error"] for r in resultados if r["error"]}),
+        "metrics": metricas
+    }
+
+# --- LOTE DO historia.py ---
+
+async def benchmark_historia(args, fake: FakeGemini, pasta_tmp: str) -> dict:
+    os.environ.setdefault("GEMINI_API_KEY", "offline")
+    sys.path.insert(0, PASTA_RAIZ)
+    import historia
+    historia.client = fake
+    historia.USAR_CACHE = False
+    historia.MODO_PROGRESSIVO = args.progressivo
+    historia.PRAZO_HISTORIA = args.prazo
+
+    # historia.py grava tudo relativo à pasta atual
+    pasta_original = os.getcwd()
+    os.chdir(pasta_tmp)
+    try:
+        os.makedirs("fotos")
+        for i in range(2):
+            with open(os.path.join("fotos", f"foto_{i}.jpg"), "wb") as f:
+                f.write(foto_sintetica(i))
+        with open("lote.jsonl", "w", encoding="utf-8") as f:
+            for n in range(args.historias):
+                f.write(json.dumps({"nome": "Bench", "descricao": f"História de benchmark {n}",
+                                    "universo": "Benchmark", "fotos": "fotos"}) + "\n")
+
+        sonda = LoopLagProbe()
+        sonda.start()
+        inicio = time.perf_counter()
+        relatorio = await historia.pipeline_lote("lote.jsonl", args.texto, args.imagens, "relatorio.json")
+        duracao = time.perf_counter() - inicio
+        await sonda.stop()
+    finally:
+        os.chdir(pasta_original)
+
+    completas = [h for h in relatorio["historias"] if h["status"] == "ok"]
+    return {
+        "durationSeconds": round(duracao, 2),
+        "stories": len(relatorio["historias"]),
+        "completed": len(completas),
+        "failed": len(relatorio["historias"]) - len(completas),
+        "storiesPerMinute": round(len(completas) / duracao * 60, 2),
+        "storySeconds": resumo_tempos(h["tempo"] for h in relatorio["historias"]),
+        "eventLoopLag": sonda.resumo(),
+        "peakRssMb": pico_rss_mb(),
+        "errors": sorted({h["erro"] for h in relatorio["historias"] if h["erro"]})
+    }
+
+# --- TEMPO DE INICIALIZAÇÃO ---
+
+# nome -> (pasta, argumentos do python, módulo cujos imports detalhar); cada
+# comando roda num processo novo com -X importtime
+COMANDOS_INICIO = {
+    "historia --help": (PASTA_RAIZ, ["historia.py", "--help"], None),
+    "import historia": (PASTA_RAIZ, ["-c", "import historia"], "historia"),
+    "import api": (PASTA_API, ["-c", "import api"], "api"),
+}
+TOP_IMPORTS = 8
+
+def ler_importtime(saida: str, raiz: str = None):
+    """
+    Lê a saída do -X importtime: (segundos em imports, {módulo: ms cumulativos}).
+    Os módulos são os de primeiro nível ou, com `raiz`, os importados por ela
+    mais o tempo do corpo da própria raiz.
+    """
+    total, modulos, filhos = 0, {}, {}
+    for linha in saida.splitlines():
+        if not linha.startswith("import time:") or "[us]" in linha:
+            continue
+        proprio, cumulativo, nome = linha[len("import time:"):].split("|")
+        profundidade = (len(nome) - len(nome.lstrip()) - 1) // 2
+        nome = nome.strip()
+        if profundidade == 0:
+            total += int(cumulativo)
+            if raiz is None:
+                modulos[nome] = int(cumulativo) / 1000
+            elif nome == raiz:
+                # Os filhos aparecem antes do pai na saída
+                modulos.update(filhos)
+                modulos[f"{raiz} (corpo do módulo)"] = int(proprio) / 1000
+            filhos = {}
+        elif profundidade == 1:
+            filhos[nome] = int(cumulativo) / 1000
+    return total / 1e6, modulos
+
+def benchmark_inicio(args, pasta_tmp: str) -> dict:
+    # Mesmo isolamento do alvo api: a importação do api.py cria as pastas do ambiente
+    ambiente = dict(os.environ, STORIES_DIR=os.path.join(pasta_tmp, "historias"),
+                    JOBS_DB=os.path.join(pasta_tmp, "jobs.db"),
+                    RESULT_CACHE_DIR=os.path.join(pasta_tmp, ".cache"),
+                    CHARACTERS_DIR=os.path.join(pasta_tmp, "characters"))
+    ambiente.setdefault("GEMINI_API_KEY", "offline")
+    resultados = {}
+    for nome, (pasta, argumentos, raiz) in COMANDOS_INICIO.items():
+        tempos, imports, modulos = [], [], {}
+        for _ in range(args.repeticoes):
+            inicio = time.perf_counter()
+            processo = subprocess.run([sys.executable, "-X", "importtime", *argumentos], cwd=pasta,
+                                      env=ambiente, capture_output=True, text=True)
+            tempos.append(time.perf_counter() - inicio)
+            if processo.returncode != 0:
+                raise RuntimeError(f"'{nome}' falhou: {processo.stderr.strip().splitlines()[-1]}")
+            segundos, medidos = ler_importtime(processo.stderr, raiz)
+            imports.append(segundos)
+            for modulo, ms in medidos.items():
+                modulos.setdefault(modulo, []).append(ms)
+        mais_lentos = sorted(modulos.items(), key=lambda item: -statistics.median(item[1]))[:TOP_IMPORTS]
+        resultados[nome] = {
+            "wallSeconds": resumo_tempos(tempos),
+            "importSeconds": resumo_tempos(imports),
+            "slowestImportsMs": {modulo: round(statistics.median(ms), 1) for modulo, ms in mais_lentos}
+        }
+    return resultados
+
+async def main(args):
+    fake = FakeGemini(args.latencia_texto, args.latencia_imagem, args.sigma,
+                      args.taxa_erro, args.rajada_cada, args.rajada_duracao, args.semente,
+                      args.latencia_rascunho)
+    pasta_tmp = tempfile.mkdtemp(prefix="storymaker_bench_")
+    try:
+        if args.alvo == "api":
+            resultado = await benchmark_api(args, fake, pasta_tmp)
+        elif args.alvo == "inicio":
+            resultado = benchmark_inicio(args, pasta_tmp)
+        else:
+            resultado = await benchmark_historia(args, fake, pasta_tmp)
+    finally:
+        if not args.manter:
+            shutil.rmtree(pasta_tmp, ignore_errors=True)
+
+    relatorio = {
+        "target": args.alvo,
+        "startedAt": datetime.now().isoformat(),
+        "commit": versao_git(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("saida", "manter")},
+        "fakeCalls": fake.chamadas,
+        "results": resultado
+    }
+    caminho = args.saida or os.path.join(
+        PASTA_RESULTADOS, f"bench_{args.alvo}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, indent=4, ensure_ascii=False)
+
+    print("\n" + "=" * 50)
+    if args.alvo == "inicio":
+        for nome, r in resultado.items():
+            print(f"🚀 {nome}: processo {r['wallSeconds']['p50']}s, imports {r['importSeconds']['p50']}s (p50)")
+            for modulo, ms in r["slowestImportsMs"].items():
+                print(f"      {ms:8.1f}ms  {modulo}")
+        print(f"📝 Resultado salvo em: {caminho}")
+        return relatorio
+    print(f"📊 {resultado['completed']}/{resultado['stories']} histórias em {resultado['durationSeconds']}s "
+          f"({resultado['storiesPerMinute']} por minuto)")
+    if resultado.get("timeToFirstImageSeconds"):
+        print(f"🖼️ Primeira imagem: {resultado['timeToFirstImageSeconds']}")
+    if resultado.get("storySeconds"):
+        print(f"📖 Livro completo: {resultado['storySeconds']}")
+    if resultado.get("degraded"):
+        print(f"⏰ {resultado['degraded']} história(s) terminaram no prazo sem todas as imagens")
+    if resultado.get("finalImagesSeconds"):
+        print(f"🔁 Versões finais ({resultado['imagesUpgraded']} imagens): {resultado['finalImagesSeconds']}")
+    print(f"⏱️ Atraso do event loop: {resultado['eventLoopLag']}")
+    print(f"🧠 Pico de memória (MB): {resultado['peakRssMb']}")
+    print(f"📝 Resultado salvo em: {caminho}")
+    return relatorio
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline com um Gemini simulado")
+    parser.add_argument("alvo", choices=("api", "historia", "inicio"), help="o que medir")
+    parser.add_argument("--historias", type=int, default=8, help="total de histórias")
+    parser.add_argument("--clientes", type=int, default=4, help="clientes SSE simultâneos (api)")
+    parser.add_argument("--porta", type=int, default=0, help="porta do servidor local (api, 0 = qualquer uma livre)")
+    parser.add_argument("--texto", type=int, default=4, help="chamadas de texto simultâneas (historia)")
+    parser.add_argument("--imagens", type=int, default=6, help="chamadas de imagem simultâneas (historia)")
+    parser.add_argument("--latencia-texto", type=float, default=3.0, help="mediana da latência do texto (s)")
+    parser.add_argument("--latencia-imagem", type=float, default=12.0, help="mediana da latência das imagens (s)")
+    parser.add_argument("--latencia-rascunho", type=float, default=4.0,
+                        help="mediana da latência dos rascunhos no modo progressivo (s)")
+    parser.add_argument("--progressivo", action="store_true", help="rascunhos primeiro, versões finais depois")
+    parser.add_argument("--prazo", type=float, default=None,
+                        help="prazo de cada história (s): passado ele, termina com as imagens prontas")
+    parser.add_argument("--sigma", type=float, default=0.4, help="dispersão log-normal das latências")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="fração de chamadas com 503")
+    parser.add_argument("--rajada-cada", type=float, default=0.0, help="intervalo entre rajadas de 429 (s, 0 = sem)")
+    parser.add_argument("--rajada-duracao", type=float, default=0.0, help="duração de cada rajada de 429 (s)")
+    parser.add_argument("--repeticoes", type=int, default=5, help="execuções de cada comando (inicio)")
+    parser.add_argument("--semente", type=int, default=None, help="semente do gerador aleatório")
+    parser.add_argument("--saida", metavar="ARQUIVO", help="onde salvar o JSON (padrão: bench_results/)")
+    parser.add_argument("--manter", action="store_true", help="não apagar a pasta temporária")
+    asyncio.run(main(parser.parse_args()))
@@ -1,18 +1,27 @@
 import re
+import argparse
+import csv
 import os
 import glob
 import asyncio
 import time
 import json
+import hashlib
+import random
+import shutil
+from functools import lru_cache
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
 from datetime import datetime
-from google import genai
-from google.genai import types
-from pydantic import BaseModel, Field
-from typing import List
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Optional
 from dotenv import load_dotenv
-from PIL import Image
 from io import BytesIO
 
+# google.genai (~0,5s) e PIL são importados só onde são usados: o --help, a
+# leitura do lote e os processos do pool de derivados não pagam esse custo.
+
 # --- CONFIGURAÇÕES DO USUÁRIO ---
 NOME_USUARIO = "Ricardo Rock"
 DESCRICAO_HISTORIA = "em que eu sou solicictado pelo presidente dos EUA Donald Trump para ajudar a resolver uma crise internacional de uma ameaça nuclear terrorista"
@@ -20,8 +29,39 @@ UNIVERSO_HISTORIA = "Washington D.C - fotografia realistica"
 PASTA_FOTOS = "fotos"
 # -------------------------------
 
+# Cache das fotos de referência normalizadas (EXIF + redução + JPEG)
+PASTA_CACHE_FOTOS = ".cache_fotos"
+FOTO_MAX_LADO = 1024
+
+# Cache de resultados (JSON da história e imagens), pelo hash de modelo + prompt + fotos + formato
+USAR_CACHE = True  # False força gerar tudo de novo
+PASTA_CACHE_RESULTADOS = ".cache_resultados"
+CACHE_RESULTADOS_MB = 1024
+
+# Chamadas simultâneas ao Gemini (somando todas as histórias, no modo lote)
+LIMITE_TEXTO = 4
+LIMITE_IMAGENS = 6
+limites = {"texto": asyncio.Semaphore(LIMITE_TEXTO), "imagem": asyncio.Semaphore(LIMITE_IMAGENS)}
+
+MODELO_TEXTO = "gemini-3-flash-preview"
+MODELO_IMAGEM = "gemini-3-pro-image-preview"
+
+# Modo progressivo (--progressivo): rascunhos num modelo rápido primeiro, com o
+# livro HTML já pronto, e depois as versões finais em 2K no lugar deles
+MODO_PROGRESSIVO = False
+MODELO_RASCUNHO = "gemini-2.5-flash-image"
+QUALIDADES_IMAGEM = {"rascunho": (MODELO_RASCUNHO, None), "final": (MODELO_IMAGEM, "2K")}  # modelo, tamanho
+
 load_dotenv()
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+client = None  # criado no primeiro uso por cliente()
+
+def cliente():
+    """Cliente do Gemini, criado na primeira chamada à API"""
+    global client
+    if client is None:
+        from google import genai
+        client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return client
 
 class Story(BaseModel):
     title: str = Field(description="O título épico e chamativo da história.")
@@ -32,6 +72,211 @@ class Story(BaseModel):
         max_length=5
     )
 
+SCHEMA_STORY = Story.model_json_schema()  # calculado uma vez, não a cada chamada
+
+# --- RETENTATIVAS ---
+# Mesma política do api.py: retry por classe de erro, backoff exponencial com
+# jitter completo, dicas de espera do servidor e orçamento por história.
+POLITICA_RETRY = {
+    "rate_limit": {"tentativas": 6, "base": 2.0, "teto": 60.0},
+    "transient": {"tentativas": 4, "base": 1.0, "teto": 20.0},
+    "validation": {"tentativas": 2, "base": 0.0, "teto": 0.0},
+    "safety": {"tentativas": 1, "base": 0.0, "teto": 0.0},
+    "prazo": {"tentativas": 1, "base": 0.0, "teto": 0.0},
+}
+ORCAMENTO_RETRY_HISTORIA = 12  # novas tentativas por história (todas as chamadas)
+
+# Limite de cada chamada ao modelo (o do texto vale para o streaming inteiro) e
+# prazo da história (--prazo). Passado o prazo, o livro sai com as imagens que
+# já existem; rodar de novo gera só o que falta.
+TIMEOUT_TEXTO = 90
+TIMEOUT_IMAGEM = 120
+PRAZO_HISTORIA = None  # segundos; None = sem prazo
+
+# Orçamento de retentativas da história em execução: {"restante", "retries", "rastro", "prazo"}
+orcamento_historia: ContextVar[Optional[dict]] = ContextVar("orcamento_historia", default=None)
+
+class BloqueioSegurancaError(ValueError):
+    """Resposta bloqueada pelos filtros de segurança do modelo"""
+
+class PrazoEsgotadoError(Exception):
+    """O prazo da história acabou"""
+
+def classificar_erro(e):
+    from google.genai import errors as genai_errors
+    if isinstance(e, BloqueioSegurancaError):
+        return "safety"
+    if isinstance(e, PrazoEsgotadoError):
+        return "prazo"
+    if getattr(e, "code", None) == 429 or "RESOURCE_EXHAUSTED" in str(e):
+        return "rate_limit"
+    if isinstance(e, (ValidationError, json.JSONDecodeError, genai_errors.ClientError)):
+        return "validation"
+    return "transient"
+
+def dica_de_espera(e):
+    # RetryInfo.retryDelay no corpo do erro ou cabeçalho Retry-After
+    detalhes = getattr(e, "details", None)
+    if isinstance(detalhes, dict):
+        for item in detalhes.get("error", {}).get("details", []) or []:
+            if isinstance(item, dict) and item.get("retryDelay"):
+                try:
+                    return float(str(item["retryDelay"]).rstrip("s"))
+                except ValueError:
+                    pass
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+def _avaliar_falha(e, tentativa, nome_operacao):
+    """Decide se a falha deve ser repetida. Retorna a espera em segundos ou relança o erro."""
+    classe = classificar_erro(e)
+    politica = POLITICA_RETRY[classe]
+    if tentativa >= politica["tentativas"]:
+        print(f"❌ Falha definitiva após {tentativa} tentativa(s) para {nome_operacao} [{classe}].")
+        raise e
+    espera = random.uniform(0, min(politica["teto"], politica["base"] * 2 ** (tentativa - 1)))
+    dica = dica_de_espera(e)
+    if dica is not None:
+        espera = dica + random.uniform(0, politica["base"])
+    restante = tempo_restante()
+    if restante is not None and espera >= restante:
+        # A próxima tentativa começaria depois do prazo
+        print(f"❌ Prazo da história esgotado em {nome_operacao} [{classe}].")
+        raise PrazoEsgotadoError(f"{nome_operacao}: {e}") from e
+    
+    orcamento = orcamento_historia.get()
+    if orcamento is not None:
+        if orcamento["restante"] <= 0:
+            print(f"❌ Orçamento de retentativas da história esgotado em {nome_operacao} [{classe}].")
+            raise e
+        orcamento["restante"] -= 1
+        orcamento["retries"][classe] = orcamento["retries"].get(classe, 0) + 1
+    
+    print(f"⚠️ Tentativa {tentativa}/{politica['tentativas']} falhou para {nome_operacao} [{classe}]: {e}")
+    print(f"   Aguardando {espera:.1f}s antes da próxima tentativa...")
+    return espera
+
+def tempo_restante():
+    """Segundos até o prazo da história atual (None sem prazo ou fora de uma história)"""
+    orcamento = orcamento_historia.get()
+    if orcamento is None or orcamento.get("prazo") is None:
+        return None
+    return orcamento["prazo"] - time.monotonic()
+
+@asynccontextmanager
+async def limite_chamada(limite, nome_operacao):
+    """Limita uma chamada ao modelo, sem passar do prazo da história"""
+    restante = tempo_restante()
+    if restante is not None and restante <= 0:
+        raise PrazoEsgotadoError(f"{nome_operacao}: prazo da história esgotado")
+    segundos = limite if restante is None else min(limite, restante)
+    try:
+        async with asyncio.timeout(segundos):
+            yield
+    except TimeoutError as e:
+        if segundos < limite:
+            raise PrazoEsgotadoError(f"{nome_operacao}: prazo da história esgotado") from e
+        raise TimeoutError(f"{nome_operacao}: sem resposta em {segundos:.0f}s") from e
+
+async def com_retentativas_async(func, *args, nome_operacao="operação"):
+    tentativa = 0
+    while True:
+        tentativa += 1
+        try:
+            with medir("attempt", operation=nome_operacao, attempt=tentativa):
+                return await func(*args)
+        except Exception as e:
+            espera = _avaliar_falha(e, tentativa, nome_operacao)
+            with medir("backoff", operation=nome_operacao, attempt=tentativa):
+                await asyncio.sleep(espera)
+
+# --- RASTRO DE TEMPOS ---
+# Spans de cada etapa, tentativa, chamada ao modelo e gravação, com início e
+# fim em segundos desde o começo da história. Vai para o dados.json, no mesmo
+# formato do story.json do storymaker-app (relatorio_tempos.py lê os dois).
+
+class Rastro:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.spans = []
+
+    def abrir(self, nome, pai, **attrs):
+        registro = {"id": len(self.spans), "parent": pai, "name": nome,
+                    "start": round(time.perf_counter() - self.t0, 3), "end": None, **attrs}
+        self.spans.append(registro)
+        return registro
+
+    def fechar(self, registro, **attrs):
+        registro["end"] = round(time.perf_counter() - self.t0, 3)
+        registro.update(attrs)
+
+    def para_dict(self):
+        return {"total": round(time.perf_counter() - self.t0, 3), "spans": self.spans}
+
+# Span aberto na task atual (pai dos spans criados dentro dele)
+span_atual: ContextVar[Optional[int]] = ContextVar("span_atual", default=None)
+
+@contextmanager
+def medir(nome, **attrs):
+    """Registra o bloco como um span da história atual (nada acontece fora de uma história)"""
+    orcamento = orcamento_historia.get()
+    if orcamento is None:
+        yield
+        return
+    rastro = orcamento["rastro"]
+    registro = rastro.abrir(nome, span_atual.get(), **attrs)
+    token = span_atual.set(registro["id"])
+    try:
+        yield
+    except asyncio.CancelledError:
+        rastro.fechar(registro, cancelled=True)
+        raise
+    except Exception as e:
+        rastro.fechar(registro, error=classificar_erro(e))
+        raise
+    else:
+        rastro.fechar(registro)
+    finally:
+        span_atual.reset(token)
+
+def verificar_bloqueio(response, nome_operacao):
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        raise BloqueioSegurancaError(f"{nome_operacao} bloqueada: {feedback.block_reason}")
+    for candidato in getattr(response, "candidates", None) or []:
+        motivo = str(candidato.finish_reason or "")
+        if any(m in motivo for m in ("SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII")):
+            raise BloqueioSegurancaError(f"{nome_operacao} bloqueada: {motivo}")
+
+@lru_cache(maxsize=32)
+def _carregar_foto_normalizada(arquivo, mtime_ns, tamanho):
+    # mtime/tamanho entram na chave para invalidar se o arquivo mudar
+    from google.genai import types
+    from PIL import Image, ImageOps
+    with open(arquivo, "rb") as f:
+        dados = f.read()
+    caminho_cache = os.path.join(PASTA_CACHE_FOTOS, f"{hashlib.sha256(dados).hexdigest()}.jpg")
+    
+    if os.path.exists(caminho_cache):
+        with open(caminho_cache, "rb") as f:
+            return types.Part.from_bytes(data=f.read(), mime_type="image/jpeg")
+    
+    with Image.open(BytesIO(dados)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((FOTO_MAX_LADO, FOTO_MAX_LADO), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=90, optimize=True)
+    
+    os.makedirs(PASTA_CACHE_FOTOS, exist_ok=True)
+    with open(caminho_cache, "wb") as f:
+        f.write(buffer.getvalue())
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type="image/jpeg")
+
 def carregar_fotos_usuario(caminho_pasta):
     extensoes = ['*.png', '*.jpg', '*.jpeg', '*.webp']
     arquivos_fotos = []
@@ -39,13 +284,123 @@ def carregar_fotos_usuario(caminho_pasta):
         for ext in extensoes:
             arquivos_fotos.extend(glob.glob(os.path.join(caminho_pasta, ext)))
     
+    # Fotos normalizadas uma vez e reaproveitadas (memória + disco, pelo hash do conteúdo)
     fotos = []
     for arquivo in arquivos_fotos[:5]:
-        fotos.append(Image.open(arquivo))
+        info = os.stat(arquivo)
+        fotos.append(_carregar_foto_normalizada(arquivo, info.st_mtime_ns, info.st_size))
     return fotos
 
-# 1. FUNÇÃO GERADORA DE HISTÓRIA
-def gerar_json_historia(nome, descricao, universo):
+def chave_cache(**partes):
+    texto = json.dumps(partes, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+def caminho_cache(chave, extensao):
+    """Caminho do resultado no cache, ou None se não existir (ou o cache estiver desligado)"""
+    caminho = os.path.join(PASTA_CACHE_RESULTADOS, f"{chave}.{extensao}")
+    if not USAR_CACHE or not os.path.exists(caminho):
+        return None
+    os.utime(caminho)  # marca o uso para a remoção LRU
+    return caminho
+
+def gravar_cache(chave, extensao, dados):
+    """Grava o resultado no cache e remove os menos usados acima do limite"""
+    os.makedirs(PASTA_CACHE_RESULTADOS, exist_ok=True)
+    destino = os.path.join(PASTA_CACHE_RESULTADOS, f"{chave}.{extensao}")
+    with open(destino + ".tmp", "wb") as f:
+        f.write(dados)
+    os.replace(destino + ".tmp", destino)
+    
+    arquivos = [os.path.join(PASTA_CACHE_RESULTADOS, n) for n in os.listdir(PASTA_CACHE_RESULTADOS)]
+    arquivos = sorted((os.stat(a).st_mtime, os.path.getsize(a), a) for a in arquivos)
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for _, tamanho, arquivo in arquivos:
+        if total <= CACHE_RESULTADOS_MB * 1024 * 1024:
+            break
+        os.remove(arquivo)
+        total -= tamanho
+
+# 1. FUNÇÃO GERADORA DE HISTÓRIA (STREAMING)
+class IncrementalJSONParser:
+    """
+    Parser de JSON em pedaços: chama ao_receber_campo(caminho, valor) assim que
+    cada valor string termina de chegar, ex. ("cover_prompt",) ou ("parts", 2, 1).
+    """
+
+    def __init__(self, ao_receber_campo):
+        self.ao_receber_campo = ao_receber_campo
+        self._pilha = []  # [tipo ("obj"/"arr"), chave ou índice atual, esperando chave?]
+        self._em_string = False
+        self._escape = False
+        self._eh_chave = False
+        self._buffer = []
+
+    def feed(self, texto):
+        for c in texto:
+            if self._em_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._fechar_string()
+                    continue
+                self._buffer.append(c)
+            elif c == '"':
+                self._em_string = True
+                self._eh_chave = bool(self._pilha) and self._pilha[-1][0] == "obj" and self._pilha[-1][2]
+                self._buffer = []
+            elif c == "{":
+                self._pilha.append(["obj", None, True])
+            elif c == "[":
+                self._pilha.append(["arr", 0, False])
+            elif c in "}]":
+                if self._pilha:
+                    self._pilha.pop()
+            elif c == ":":
+                if self._pilha:
+                    self._pilha[-1][2] = False
+            elif c == ",":
+                if self._pilha and self._pilha[-1][0] == "obj":
+                    self._pilha[-1][1] = None
+                    self._pilha[-1][2] = True
+                elif self._pilha:
+                    self._pilha[-1][1] += 1
+
+    def _fechar_string(self):
+        self._em_string = False
+        valor = json.loads('"' + "".join(self._buffer) + '"', strict=False)
+        if self._eh_chave:
+            self._pilha[-1][1] = valor
+        else:
+            self.ao_receber_campo(tuple(frame[1] for frame in self._pilha), valor)
+
+async def _gerar_json_historia_interno(prompt_historia, ao_receber_campo):
+    texto = []
+    parser = IncrementalJSONParser(ao_receber_campo) if ao_receber_campo else None
+    async with limites["texto"], limite_chamada(TIMEOUT_TEXTO, "a história"):
+        with medir("model", model=MODELO_TEXTO):
+            stream = await cliente().aio.models.generate_content_stream(
+                model=MODELO_TEXTO,
+                contents=prompt_historia,
+                config={
+                    "response_mime_type": "application/json",
+                    "response_json_schema": SCHEMA_STORY,
+                },
+            )
+            async for chunk in stream:
+                verificar_bloqueio(chunk, "História")
+                if chunk.text:
+                    texto.append(chunk.text)
+                    if parser:
+                        parser.feed(chunk.text)
+    
+    if not texto:
+        raise ValueError("Resposta vazia da API")
+
+    return Story.model_validate_json("".join(texto))
+
+async def gerar_json_historia(nome, descricao, universo, ao_receber_campo=None):
     print(f"\n--- 1. GERANDO ESTRUTURA DA HISTÓRIA PARA {nome.upper()} ---")
     prompt_historia = f"""
     Crie uma história épica e imersiva dividida em EXATAMENTE 5 PARTES para {nome}.
@@ -56,143 +411,344 @@ def gerar_json_historia(nome, descricao, universo):
     O protagonista deve ser {nome}.
     """
     
-    tentativas = 3
-    for i_tentativa in range(tentativas):
-        try:
-            response = client.models.generate_content(
-                model="gemini-3-flash-preview",
-                contents=prompt_historia,
-                config={
-                    "response_mime_type": "application/json",
-                    "response_json_schema": Story.model_json_schema(),
-                },
-            )
-            
-            if not response or not response.text:
-                raise ValueError("Resposta vazia da API")
-
-            story_data = Story.model_validate_json(response.text)
-            
-            # PRINT DETALHADO DA HISTÓRIA E PROMPTS
-            print("\n" + "="*50)
-            print(f"📖 ESTRUTURA DA HISTÓRIA GERADA")
-            print("="*50)
-            for i, (texto, prompt) in enumerate(story_data.parts, 1):
-                print(f"\n[ PARTE {i} ]")
-                print(f"HISTÓRIA: {texto}")
-                print(f"PROMPT DE IMAGEM: {prompt}")
-            print("\n" + "="*50)
-            
-            return {
-                "usuario": nome, 
-                "universo": universo, 
-                "title": story_data.title,
-                "cover_prompt": story_data.cover_prompt,
-                "partes": story_data.parts
-            }
-
-        except Exception as e:
-            print(f"⚠️ Tentativa {i_tentativa + 1}/{tentativas} falhou: {e}")
-            if i_tentativa < tentativas - 1:
-                time.sleep(2) # Espera antes de tentar de novo
-            else:
-                print(f"❌ Falha definitiva após {tentativas} tentativas.")
-                raise e
+    chave = chave_cache(modelo=MODELO_TEXTO, prompt=prompt_historia)
+    if cached := caminho_cache(chave, "json"):
+        print("💾 História encontrada no cache de resultados")
+        with open(cached, "r", encoding="utf-8") as f:
+            texto = f.read()
+        if ao_receber_campo:
+            IncrementalJSONParser(ao_receber_campo).feed(texto)
+        story_data = Story.model_validate_json(texto)
+    else:
+        story_data = await com_retentativas_async(
+            _gerar_json_historia_interno, prompt_historia, ao_receber_campo,
+            nome_operacao="a história"
+        )
+        with medir("cache_write"):
+            gravar_cache(chave, "json", story_data.model_dump_json().encode("utf-8"))
+    
+    # PRINT DETALHADO DA HISTÓRIA E PROMPTS
+    print("\n" + "="*50)
+    print(f"📖 ESTRUTURA DA HISTÓRIA GERADA")
+    print("="*50)
+    for i, (texto, prompt) in enumerate(story_data.parts, 1):
+        print(f"\n[ PARTE {i} ]")
+        print(f"HISTÓRIA: {texto}")
+        print(f"PROMPT DE IMAGEM: {prompt}")
+    print("\n" + "="*50)
+    
+    return {
+        "usuario": nome, 
+        "universo": universo, 
+        "title": story_data.title,
+        "cover_prompt": story_data.cover_prompt,
+        "partes": story_data.parts
+    }
 
 # 2. FUNÇÃO GERADORA DE IMAGENS (ASSÍNCRONA)
-async def gerar_imagens_async(id_arquivo, prompt_base, fotos_usuario, nome_usuario, pasta_destino, universo, ratio="2:3"):
-    instrucao_usuario = f"\n\nIMPORTANTE: O personagem principal desta imagem deve ser exatamente a mesma pessoa que aparece nas fotos anexadas ({nome_usuario}). Mantenha as características faciais e adaptações ao universo: {universo}."
-    prompt_final = prompt_base + instrucao_usuario
+async def _gerar_imagem_interna(id_arquivo, prompt_final, fotos_usuario, pasta_destino, ratio, qualidade="final"):
+    from google.genai import types
+    modelo, tamanho = QUALIDADES_IMAGEM[qualidade]
+    output_path = os.path.join(pasta_destino, f"{id_arquivo}.png")
+    chave = chave_cache(
+        modelo=modelo,
+        prompt=prompt_final,
+        fotos=[hashlib.sha256(foto.inline_data.data).hexdigest() for foto in fotos_usuario],
+        ratio=ratio,
+        tamanho=tamanho
+    )
+    if cached := caminho_cache(chave, "png"):
+        with medir("cache_read"):
+            shutil.copyfile(cached, output_path)
+        print(f"💾 Imagem {id_arquivo} reaproveitada do cache em: {output_path}")
+        return output_path
     
-    tentativas = 3
-    for i_tentativa in range(tentativas):
-        try:
-            response = await client.aio.models.generate_content(
-                model="gemini-3-pro-image-preview",
+    async with limites["imagem"], limite_chamada(TIMEOUT_IMAGEM, f"imagem {id_arquivo}"):
+        with medir("model", model=modelo):
+            response = await cliente().aio.models.generate_content(
+                model=modelo,
                 contents=[prompt_final] + fotos_usuario,
                 config=types.GenerateContentConfig(
                     response_modalities=['TEXT', 'IMAGE'],
-                    image_config=types.ImageConfig(aspect_ratio=ratio, image_size="2K"),
+                    image_config=types.ImageConfig(aspect_ratio=ratio, image_size=tamanho),
                 )
             )
 
-            for part in response.parts:
-                if image := part.as_image():
-                    output_path = os.path.join(pasta_destino, f"{id_arquivo}.png")
-                    image.save(output_path)
-                    print(f"✅ Imagem {id_arquivo} salva em: {output_path}")
-                    return output_path
-            
-            raise ValueError("A resposta não continha uma imagem válida.")
+    for part in response.parts or []:
+        if image := part.as_image():
+            with medir("write_png"):
+                image.save(output_path)
+            with medir("cache_write", bytes=len(image.image_bytes)):
+                gravar_cache(chave, "png", image.image_bytes)
+            print(f"✅ Imagem {id_arquivo} ({qualidade}) salva em: {output_path}")
+            return output_path
+    
+    verificar_bloqueio(response, f"Imagem {id_arquivo}")
+    raise ValueError("A resposta não continha uma imagem válida.")
 
-        except Exception as e:
-            print(f"⚠️ Tentativa {i_tentativa + 1}/{tentativas} falhou para a imagem {id_arquivo}: {e}")
-            if i_tentativa < tentativas - 1:
-                await asyncio.sleep(3) # Espera um pouco mais para imagens
-            else:
-                print(f"❌ Falha definitiva na imagem {id_arquivo}.")
+async def gerar_imagens_async(id_arquivo, prompt_base, fotos_usuario, nome_usuario, pasta_destino, universo, ratio="2:3",
+                              qualidade="final"):
+    instrucao_usuario = f"\n\nIMPORTANTE: O personagem principal desta imagem deve ser exatamente a mesma pessoa que aparece nas fotos anexadas ({nome_usuario}). Mantenha as características faciais e adaptações ao universo: {universo}."
+    prompt_final = prompt_base + instrucao_usuario
+    
+    try:
+        return await com_retentativas_async(
+            _gerar_imagem_interna, id_arquivo, prompt_final, fotos_usuario, pasta_destino, ratio, qualidade,
+            nome_operacao=f"a imagem {id_arquivo}"
+        )
+    except Exception:
+        print(f"❌ Falha definitiva na imagem {id_arquivo}.")
     return None
 
-async def executar_geracao_imagens(json_historia, pasta_fotos):
-    nome = json_historia["usuario"]
-    universo = json_historia["universo"]
-    titulo = json_historia["title"]
-    
+def criar_pasta_historia(titulo):
     # Sanitização do nome da pasta para evitar erros de SO (removendo caracteres como : / \ ? * etc)
     titulo_limpo = re.sub(r'[<>:"/\\|?*]', '', titulo).replace(' ', '_')
     nome_pasta = f"historia_{titulo_limpo}"
     
+    # Não sobrescreve outra história com o mesmo título (ex.: no modo lote)
+    sufixo = 2
+    while os.path.exists(os.path.join(nome_pasta, ARQUIVO_MANIFESTO)) or nome_pasta in pastas_em_uso:
+        nome_pasta = f"historia_{titulo_limpo}_{sufixo}"
+        sufixo += 1
+    
     if not os.path.exists(nome_pasta):
         os.makedirs(nome_pasta)
+    return nome_pasta
+
+# Manifesto da história: o que já foi concluído em cada etapa, gravado a cada
+# passo para que uma nova execução retome de onde parou
+ARQUIVO_MANIFESTO = "manifesto.json"
+
+def novo_manifesto(nome, descricao, universo):
+    return {
+        "entrada": {"nome": nome, "descricao": descricao, "universo": universo},
+        "historia": None,  # dados da história, quando o texto estiver pronto
+        "imagens": {},     # id -> {"prompt", "status": "ok" | "falhou", "qualidade": "rascunho" | "final"}
+        "web": {},         # imagem -> {"sha256" do PNG de origem, "variantes" responsivas}
+        "html": None,      # hash do conteúdo usado no index.html
+        "completo": False
+    }
+
+def ler_manifesto(pasta):
+    caminho = os.path.join(pasta, ARQUIVO_MANIFESTO)
+    if os.path.exists(caminho):
+        with open(caminho, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    # Pastas antigas (sem manifesto): reconstrói a partir do dados.json e dos PNGs existentes
+    caminho_dados = os.path.join(pasta, "dados.json")
+    if not os.path.exists(caminho_dados):
+        return None
+    with open(caminho_dados, "r", encoding="utf-8") as f:
+        dados = json.load(f)
+    dados.pop("trace", None)
+    manifesto = novo_manifesto(dados["usuario"], None, dados["universo"])
+    manifesto["historia"] = dados
+    prompts = {"capa": dados["cover_prompt"], **{f"parte_{i}": p for i, (_, p) in enumerate(dados["partes"], 1)}}
+    for id_arquivo, prompt in prompts.items():
+        if os.path.exists(os.path.join(pasta, f"{id_arquivo}.png")):
+            manifesto["imagens"][id_arquivo] = {"prompt": prompt, "status": "ok"}
+    return manifesto
+
+def salvar_dados(pasta, json_historia, rastro=None):
+    """Grava o dados.json (troca atômica), com o rastro de tempos da execução"""
+    dados = {**json_historia, "trace": rastro.para_dict()} if rastro else json_historia
+    caminho = os.path.join(pasta, "dados.json")
+    with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(dados, f, indent=4, ensure_ascii=False)
+    os.replace(caminho + ".tmp", caminho)
+
+def salvar_manifesto(pasta, manifesto):
+    caminho = os.path.join(pasta, ARQUIVO_MANIFESTO)
+    with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifesto, f, indent=4, ensure_ascii=False)
+    os.replace(caminho + ".tmp", caminho)
+
+# Pastas sendo geradas ou retomadas nesta execução: no modo lote, duas
+# histórias com a mesma entrada não podem retomar (nem gravar) a mesma pasta
+pastas_em_uso = set()
+
+def encontrar_historia_incompleta(nome, descricao, universo):
+    """
+    Pasta historia_* de uma execução anterior com a mesma entrada que não
+    chegou ao fim (e que nenhuma outra história desta execução já pegou)
+    """
+    entrada = {"nome": nome, "descricao": descricao, "universo": universo}
+    for caminho in sorted(glob.glob(os.path.join("historia_*", ARQUIVO_MANIFESTO)), key=os.path.getmtime, reverse=True):
+        if os.path.dirname(caminho) in pastas_em_uso:
+            continue
+        with open(caminho, "r", encoding="utf-8") as f:
+            manifesto = json.load(f)
+        if manifesto["entrada"] == entrada and not manifesto["completo"]:
+            return os.path.dirname(caminho)
+    return None
+
+def imagem_concluida(manifesto, pasta_destino, id_arquivo, prompt, qualidade="final"):
+    """Imagem pronta com este prompt; um rascunho não conta quando se pede a final"""
+    registro = manifesto["imagens"].get(id_arquivo) if manifesto else None
+    # Manifestos sem "qualidade" são de antes do modo progressivo: sempre 2K
+    return (registro is not None and registro["status"] == "ok" and registro["prompt"] == prompt
+            and (qualidade == "rascunho" or registro.get("qualidade", "final") == "final")
+            and os.path.exists(os.path.join(pasta_destino, f"{id_arquivo}.png")))
+
+async def gerar_e_registrar(id_arquivo, prompt, fotos, nome, pasta_destino, universo, ratio, manifesto, qualidade):
+    """Gera a imagem e grava o resultado (ok ou falhou) no manifesto"""
+    span_atual.set(None)  # span de primeiro nível, mesmo se iniciada durante o streaming do texto
+    with medir("image", image=id_arquivo, quality=qualidade):
+        caminho = await gerar_imagens_async(id_arquivo, prompt, fotos, nome, pasta_destino, universo,
+                                            ratio=ratio, qualidade=qualidade)
+    if manifesto is not None:
+        if caminho is None and imagem_concluida(manifesto, pasta_destino, id_arquivo, prompt, "rascunho"):
+            # A versão final falhou mas o rascunho continua valendo
+            print(f"⚠️ Imagem {id_arquivo} fica em rascunho")
+            return None
+        manifesto["imagens"][id_arquivo] = {"prompt": prompt, "status": "ok" if caminho else "falhou",
+                                            "qualidade": qualidade}
+        salvar_manifesto(pasta_destino, manifesto)
+    return caminho
+
+def iniciar_imagem(iniciadas, id_arquivo, prompt, fotos, nome, pasta_destino, universo, manifesto=None, qualidade="final"):
+    """Inicia a task da imagem (ou reinicia, se o prompt mudou). iniciadas: id -> (prompt, task)"""
+    anterior = iniciadas.get(id_arquivo)
+    if anterior is not None:
+        if anterior[0] == prompt:
+            return
+        anterior[1].cancel()
+    elif imagem_concluida(manifesto, pasta_destino, id_arquivo, prompt, qualidade):
+        print(f"⏭️ Imagem {id_arquivo} já concluída em uma execução anterior")
+        return
+    ratio = "16:9" if id_arquivo == "capa" else "2:3"
+    iniciadas[id_arquivo] = (prompt, asyncio.create_task(
+        gerar_e_registrar(id_arquivo, prompt, fotos, nome, pasta_destino, universo, ratio, manifesto, qualidade)
+    ))
+
+async def executar_geracao_imagens(json_historia, pasta_fotos, iniciadas=None, nome_pasta=None, manifesto=None,
+                                   qualidade="final"):
+    """
+    Gera capa e capítulos em paralelo. Reaproveita as imagens já iniciadas
+    durante o streaming do texto (iniciadas) quando o prompt final é o mesmo,
+    e pula as que o manifesto registra como concluídas.
+    """
+    nome = json_historia["usuario"]
+    universo = json_historia["universo"]
+    nome_pasta = nome_pasta or criar_pasta_historia(json_historia["title"])
+    iniciadas = iniciadas if iniciadas is not None else {}
     
-    print(f"\n--- 2. GERANDO IMAGENS EM PARALELO NA PASTA: {nome_pasta} ---")
+    print(f"\n--- 2. GERANDO IMAGENS ({qualidade.upper()}) EM PARALELO NA PASTA: {nome_pasta} ---")
     fotos = carregar_fotos_usuario(pasta_fotos)
     
-    tarefas = []
     # Imagem de Capa (16:9)
-    tarefas.append(gerar_imagens_async("capa", json_historia["cover_prompt"], fotos, nome, nome_pasta, universo, ratio="16:9"))
+    iniciar_imagem(iniciadas, "capa", json_historia["cover_prompt"], fotos, nome, nome_pasta, universo, manifesto, qualidade)
     
     # Imagens dos Capítulos (2:3)
     for i, (texto, prompt) in enumerate(json_historia["partes"], 1):
-        tarefas.append(gerar_imagens_async(f"parte_{i}", prompt, fotos, nome, nome_pasta, universo))
+        iniciar_imagem(iniciadas, f"parte_{i}", prompt, fotos, nome, nome_pasta, universo, manifesto, qualidade)
         
-    await asyncio.gather(*tarefas)
+    await asyncio.gather(*(task for _, task in iniciadas.values()))
     return nome_pasta
 
-# 2.5. FUNÇÃO DE OTIMIZAÇÃO DE IMAGENS
-def otimizar_imagens(pasta_historia):
-    print(f"\n--- 2.5. OTIMIZANDO IMAGENS PARA O LIVRO WEB ---")
+# 2.5. DERIVADOS RESPONSIVOS PARA O LIVRO WEB (várias larguras, WebP e AVIF)
+LARGURAS_WEB = (400, 800, 1200)
+
+@lru_cache(maxsize=None)
+def formatos_web():
+    """Formatos dos derivados, em ordem de preferência (AVIF só se o Pillow suportar)"""
+    from PIL import features
+    return ("avif", "webp") if features.check("avif") else ("webp",)
+QUALIDADE_WEB = {"avif": 60, "webp": 80}
+ARQUIVO_DERIVADOS = "derivados.json"
+
+def _gerar_derivados_imagem(arquivo, pasta_web, larguras, formatos, qualidades):
+    """Gera todas as larguras e formatos de uma imagem. Executa no pool de processos."""
+    from PIL import Image
+    base = os.path.splitext(os.path.basename(arquivo))[0]
+    variantes = []
+    with Image.open(arquivo) as img:
+        img.load()
+        # Nunca amplia: larguras maiores que a original viram a própria original
+        for largura in sorted({min(l, img.width) for l in larguras}):
+            altura = round(img.height * largura / img.width)
+            reduzida = img if largura == img.width else img.resize((largura, altura), Image.Resampling.LANCZOS)
+            for formato in formatos:
+                nome = f"{base}-{largura}.{formato}"
+                caminho = os.path.join(pasta_web, nome)
+                reduzida.save(caminho, formato.upper(), quality=qualidades[formato])
+                variantes.append({"arquivo": f"web/{nome}", "largura": largura, "altura": altura,
+                                  "formato": formato, "bytes": os.path.getsize(caminho)})
+    return variantes
+
+@lru_cache(maxsize=None)
+def pool_derivados():
+    """Pool de processos dos derivados, criado uma vez e compartilhado por todas as histórias da execução"""
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+
+def gerar_derivados(pasta_historia, manifesto=None, pool=None):
+    """
+    Gera as versões responsivas de cada PNG em paralelo (pool de processos),
+    pulando as imagens cujo PNG não mudou desde a última vez.
+    Retorna imagem -> variantes, também salvo em web/derivados.json para o srcset.
+    """
+    print(f"\n--- 2.5. GERANDO IMAGENS RESPONSIVAS PARA O LIVRO WEB ---")
     pasta_web = os.path.join(pasta_historia, "web")
     if not os.path.exists(pasta_web):
         os.makedirs(pasta_web)
+    web = {base: r for base, r in (manifesto or {}).get("web", {}).items() if isinstance(r, dict)}
     
-    arquivos = glob.glob(os.path.join(pasta_historia, "*.png"))
-    for arquivo in arquivos:
-        nome_base = os.path.basename(arquivo).replace(".png", ".webp")
-        caminho_destino = os.path.join(pasta_web, nome_base)
-        
-        with Image.open(arquivo) as img:
-            # Redimensionamento opcional para web (máximo 1200px de largura/altura para performance)
-            img.thumbnail((1200, 1200), Image.Resampling.LANCZOS)
-            # Salva em WebP com qualidade 80 (balanço perfeito entre peso e fidelidade visual)
-            img.save(caminho_destino, "WEBP", quality=80, optimize=True)
-            
-        tamanho_original = os.path.getsize(arquivo) / 1024
-        tamanho_web = os.path.getsize(caminho_destino) / 1024
-        print(f"📦 {nome_base}: {tamanho_original:.1f}KB -> {tamanho_web:.1f}KB")
+    pendentes = {}
+    for arquivo in sorted(glob.glob(os.path.join(pasta_historia, "*.png"))):
+        base = os.path.splitext(os.path.basename(arquivo))[0]
+        with open(arquivo, "rb") as f:
+            hash_origem = hashlib.sha256(f.read()).hexdigest()
+        registro = web.get(base)
+        if (registro is not None and registro["sha256"] == hash_origem
+                and all(os.path.exists(os.path.join(pasta_historia, v["arquivo"])) for v in registro["variantes"])):
+            continue
+        pendentes[base] = (arquivo, hash_origem)
+    
+    if pendentes:
+        pool = pool or pool_derivados()
+        futuros = {
+            base: pool.submit(_gerar_derivados_imagem, arquivo, pasta_web, LARGURAS_WEB, formatos_web(), QUALIDADE_WEB)
+            for base, (arquivo, _) in pendentes.items()
+        }
+        for base, futuro in futuros.items():
+            variantes = futuro.result()
+            web[base] = {"sha256": pendentes[base][1], "variantes": variantes}
+            tamanho_original = os.path.getsize(pendentes[base][0]) / 1024
+            tamanho_web = sum(v["bytes"] for v in variantes) / 1024
+            print(f"📦 {base}: {tamanho_original:.1f}KB -> {len(variantes)} variantes ({tamanho_web:.1f}KB no total)")
+    
+    derivados = {base: r["variantes"] for base, r in web.items()}
+    with open(os.path.join(pasta_web, ARQUIVO_DERIVADOS), "w", encoding="utf-8") as f:
+        json.dump(derivados, f, indent=4, ensure_ascii=False)
+    if manifesto is not None:
+        manifesto["web"] = web
+        salvar_manifesto(pasta_historia, manifesto)
+    return derivados
+
+def tag_imagem(derivados, base, sizes, lazy=True):
+    """<picture> com srcset por formato; cai no WebP único antigo se não houver derivados"""
+    variantes = (derivados or {}).get(base)
+    if not variantes:
+        return f'<img src="web/{base}.webp">'
+    fontes = []
+    for formato in formatos_web():
+        srcset = ", ".join(f'{v["arquivo"]} {v["largura"]}w' for v in variantes if v["formato"] == formato)
+        if srcset:
+            fontes.append(f'<source type="image/{formato}" srcset="{srcset}" sizes="{sizes}">')
+    maior = max(variantes, key=lambda v: (v["formato"] == "webp", v["largura"]))
+    carregamento = ' loading="lazy"' if lazy else ""
+    return (f'<picture>{"".join(fontes)}<img src="{maior["arquivo"]}" '
+            f'width="{maior["largura"]}" height="{maior["altura"]}"{carregamento}></picture>')
 
 # 3. FUNÇÃO GERADORA DE LIVRO HTML
-def gerar_livro_html(json_historia, pasta_historia):
+def gerar_livro_html(json_historia, pasta_historia, derivados=None):
     print(f"\n--- 3. GERANDO LIVRO HTML INTERATIVO ---")
     nome = json_historia["usuario"]
     universo = json_historia["universo"]
     titulo = json_historia["title"]
     partes = json_historia["partes"]
     
-    # Salvar o JSON dentro da pasta da história para integridade
-    with open(os.path.join(pasta_historia, "dados.json"), "w", encoding="utf-8") as f:
-        json.dump(json_historia, f, indent=4, ensure_ascii=False)
-
     html_content = f"""
 <!DOCTYPE html>
 <html lang="pt-br">
@@ -209,6 +765,7 @@ def gerar_livro_html(json_historia, pasta_historia):
         .left-side {{ padding: 4rem; display: flex; flex-direction: column; justify-content: center; border-right: 1px solid rgba(0,0,0,0.1); }}
         .right-side {{ background: #000; overflow: hidden; }}
         .right-side img {{ width: 100%; height: 100%; object-fit: cover; }}
+        picture {{ display: contents; }}
         .part-num {{ font-family: 'Cinzel', serif; color: var(--primary); margin-bottom: 1rem; font-weight: bold; }}
         .story-text {{ font-size: 1.1rem; line-height: 1.8; text-align: justify; }}
         .story-text::first-letter {{ font-size: 2.5rem; float: left; margin-right: 8px; color: var(--primary); font-family: 'Cinzel', serif; }}
@@ -236,7 +793,7 @@ def gerar_livro_html(json_historia, pasta_historia):
             <div class="cover-content">
                 <div class="cover-title">{titulo}</div>
                 <div class="cover-img-container">
-                    <img src="web/capa.webp">
+                    {tag_imagem(derivados, "capa", "(max-width: 1000px) 80vw, 800px", lazy=False)}
                 </div>
                 <div style="margin-top: 2rem; font-family: 'Cinzel'; font-size: 1.2rem; color: #555;">Protagonizado por {nome}</div>
             </div>
@@ -249,7 +806,7 @@ def gerar_livro_html(json_historia, pasta_historia):
                 <div class="story-text">{partes[i][0]}</div>
                 <div class="image-prompt"><b>Prompt:</b> {partes[i][1]}</div>
             </div>
-            <div class="right-side"><img src="web/parte_{i+1}.webp"></div>
+            <div class="right-side">{tag_imagem(derivados, f"parte_{i+1}", "(max-width: 1000px) 50vw, 500px")}</div>
         </div>
         ''' for i in range(len(partes))])}
     </div>
@@ -278,16 +835,197 @@ def gerar_livro_html(json_historia, pasta_historia):
     print(f"✅ Livro HTML gerado em: {html_path}")
     return html_path
 
-async def pipeline_principal():
-    nome = NOME_USUARIO
+def montar_livro(dados_historia, pasta, manifesto, pool=None):
+    """Derivados responsivos e index.html; o HTML só é refeito se a história ou as imagens mudaram"""
+    with medir("derivatives"):
+        derivados = gerar_derivados(pasta, manifesto, pool)
+    hash_html = chave_cache(historia=dados_historia, imagens=manifesto["imagens"], web=manifesto["web"])
+    if manifesto["html"] != hash_html or not os.path.exists(os.path.join(pasta, "index.html")):
+        with medir("html"):
+            gerar_livro_html(dados_historia, pasta, derivados)
+        manifesto["html"] = hash_html
+
+async def pipeline_principal(nome=NOME_USUARIO, descricao=DESCRICAO_HISTORIA, universo=UNIVERSO_HISTORIA,
+                             pasta_fotos=PASTA_FOTOS, pasta_retomada=None, progressivo=None, prazo=None):
+    reservadas = set()
+    try:
+        return await _pipeline_principal(nome, descricao, universo, pasta_fotos, pasta_retomada, progressivo, prazo,
+                                         reservadas)
+    finally:
+        pastas_em_uso.difference_update(reservadas)
+
+def reservar_pasta(pasta, reservadas):
+    """Marca a pasta como em uso por esta história até o fim do pipeline"""
+    if pasta in pastas_em_uso:
+        raise ValueError(f"A pasta {pasta} já está sendo gerada por outra história deste lote")
+    pastas_em_uso.add(pasta)
+    reservadas.add(pasta)
+    return pasta
+
+async def _pipeline_principal(nome, descricao, universo, pasta_fotos, pasta_retomada, progressivo, prazo, reservadas):
+    progressivo = MODO_PROGRESSIVO if progressivo is None else progressivo
+    prazo = PRAZO_HISTORIA if prazo is None else prazo
+    qualidade = "rascunho" if progressivo else "final"
+    orcamento = {"restante": ORCAMENTO_RETRY_HISTORIA, "retries": {}, "rastro": Rastro(),
+                 "prazo": time.monotonic() + prazo if prazo else None}
+    orcamento_historia.set(orcamento)
+    
+    # Retomada: pasta indicada ou execução anterior incompleta com a mesma entrada
+    pasta_retomada = pasta_retomada or encontrar_historia_incompleta(nome, descricao, universo)
+    if pasta_retomada:
+        reservar_pasta(os.path.normpath(pasta_retomada), reservadas)
+    manifesto = ler_manifesto(pasta_retomada) if pasta_retomada else None
+    if pasta_retomada and manifesto is None:
+        raise ValueError(f"A pasta {pasta_retomada} não tem manifesto nem dados.json para retomar")
+    if manifesto is not None:
+        print(f"♻️ Retomando a história da pasta: {pasta_retomada}")
+    
+    # Imagens começam durante o streaming do texto, assim que cada prompt chega
+    fotos = carregar_fotos_usuario(pasta_fotos)
+    iniciadas = {}
+    estado = {"pasta": pasta_retomada, "manifesto": manifesto, "prompts_sem_pasta": {}}
+    
+    def ao_receber_campo(caminho, valor):
+        if caminho == ("title",):
+            if estado["pasta"] is None:
+                estado["pasta"] = reservar_pasta(criar_pasta_historia(valor), reservadas)
+                estado["manifesto"] = novo_manifesto(nome, descricao, universo)
+                salvar_manifesto(estado["pasta"], estado["manifesto"])
+                for id_arquivo, prompt in estado["prompts_sem_pasta"].items():
+                    iniciar_imagem(iniciadas, id_arquivo, prompt, fotos, nome, estado["pasta"], universo,
+                                   estado["manifesto"], qualidade)
+            return
+        if caminho == ("cover_prompt",):
+            id_arquivo = "capa"
+        elif len(caminho) == 3 and caminho[0] == "parts" and caminho[2] == 1 and caminho[1] < 5:
+            id_arquivo = f"parte_{caminho[1] + 1}"
+        else:
+            return
+        print(f"⚡ Prompt de {id_arquivo} recebido: iniciando a imagem antes do fim do texto")
+        if estado["pasta"] is None:
+            estado["prompts_sem_pasta"][id_arquivo] = valor
+        else:
+            iniciar_imagem(iniciadas, id_arquivo, valor, fotos, nome, estado["pasta"], universo, estado["manifesto"], qualidade)
     
     # Execução do Pipeline modular
-    dados_historia = gerar_json_historia(nome, DESCRICAO_HISTORIA, UNIVERSO_HISTORIA)
-    pasta_final = await executar_geracao_imagens(dados_historia, PASTA_FOTOS)
-    otimizar_imagens(pasta_final)
-    gerar_livro_html(dados_historia, pasta_final)
+    if manifesto is not None and manifesto["historia"] is not None:
+        print("⏭️ Estrutura da história já gerada em uma execução anterior")
+        dados_historia = manifesto["historia"]
+    else:
+        with medir("text"):
+            dados_historia = await gerar_json_historia(nome, descricao, universo, ao_receber_campo)
+        if estado["pasta"] is None:
+            estado["pasta"] = reservar_pasta(criar_pasta_historia(dados_historia["title"]), reservadas)
+            estado["manifesto"] = novo_manifesto(nome, descricao, universo)
+        estado["manifesto"]["historia"] = dados_historia
+        salvar_manifesto(estado["pasta"], estado["manifesto"])
+    manifesto = estado["manifesto"]
     
+    pasta_final = await executar_geracao_imagens(dados_historia, pasta_fotos, iniciadas, estado["pasta"], manifesto,
+                                                 qualidade)
+    # Fora do event loop: no lote, as outras histórias seguem enquanto esta monta o livro
+    await asyncio.to_thread(montar_livro, dados_historia, pasta_final, manifesto, pool_derivados())
+    if progressivo:
+        print(f"\n📖 Livro em rascunho pronto em {time.perf_counter() - orcamento['rastro'].t0:.1f}s: gerando as versões finais em 2K")
+        await executar_geracao_imagens(dados_historia, pasta_fotos, {}, pasta_final, manifesto, "final")
+        await asyncio.to_thread(montar_livro, dados_historia, pasta_final, manifesto, pool_derivados())
+    
+    falhas = [id_arquivo for id_arquivo, r in manifesto["imagens"].items() if r["status"] != "ok"]
+    rascunhos = [id_arquivo for id_arquivo, r in manifesto["imagens"].items()
+                 if r["status"] == "ok" and r.get("qualidade") == "rascunho"]
+    manifesto["completo"] = not falhas and not rascunhos
+    salvar_dados(pasta_final, dados_historia, orcamento["rastro"])
+    salvar_manifesto(pasta_final, manifesto)
+    
+    if falhas:
+        print(f"\n⚠️ Imagens com falha: {', '.join(falhas)}. Rode novamente para gerar só o que falta.")
+    if rascunhos:
+        print(f"\n⚠️ Imagens ainda em rascunho: {', '.join(rascunhos)}. Rode novamente para gerar as versões finais.")
     print(f"\n🚀 Pipeline finalizado! História salva na pasta: {pasta_final}")
+    return {"pasta": pasta_final, "falhas": falhas, "retries": orcamento["retries"]}
+
+# 4. MODO LOTE: VÁRIAS HISTÓRIAS EM PARALELO
+CAMPOS_LOTE = {"name": "nome", "description": "descricao", "universe": "universo", "photos": "fotos"}
+
+def ler_lote(caminho):
+    """Lê as histórias do lote (JSONL ou CSV) com nome, descricao, universo e fotos (pasta)"""
+    with open(caminho, "r", encoding="utf-8") as f:
+        if caminho.lower().endswith(".csv"):
+            linhas = list(csv.DictReader(f))
+        else:
+            linhas = [json.loads(linha) for linha in f if linha.strip()]
+    
+    # Aceita os nomes de campo em inglês também
+    specs = [{CAMPOS_LOTE.get(k, k): v for k, v in linha.items()} for linha in linhas]
+    for n, spec in enumerate(specs, 1):
+        faltando = [campo for campo in ("nome", "descricao", "universo") if not spec.get(campo)]
+        if faltando:
+            raise ValueError(f"Linha {n} de {caminho} sem: {', '.join(faltando)}")
+        spec.setdefault("fotos", PASTA_FOTOS)
+    return specs
+
+async def executar_historia_lote(spec):
+    inicio = time.time()
+    try:
+        resultado = await pipeline_principal(spec["nome"], spec["descricao"], spec["universo"], spec["fotos"] or PASTA_FOTOS)
+        status = "ok" if not resultado["falhas"] else "incompleta"
+        return {**spec, "status": status, **resultado, "erro": None, "tempo": round(time.time() - inicio, 1)}
+    except Exception as e:
+        print(f"❌ História de {spec['nome']} falhou: {e}")
+        return {**spec, "status": "erro", "pasta": None, "falhas": [], "retries": {},
+                "erro": str(e), "tempo": round(time.time() - inicio, 1)}
+
+async def pipeline_lote(caminho, limite_texto, limite_imagens, caminho_relatorio=None):
+    """
+    Roda todas as histórias do lote ao mesmo tempo, com um só cliente e
+    limites globais de chamadas de texto e imagem. O tempo total fica perto
+    do da história mais lenta, não da soma de todas.
+    """
+    specs = ler_lote(caminho)
+    limites["texto"] = asyncio.Semaphore(limite_texto)
+    limites["imagem"] = asyncio.Semaphore(limite_imagens)
+    print(f"\n--- MODO LOTE: {len(specs)} HISTÓRIAS (texto {limite_texto}, imagens {limite_imagens} simultâneas) ---")
+    
+    inicio = time.time()
+    resultados = await asyncio.gather(*(executar_historia_lote(spec) for spec in specs))
+    tempo_total = time.time() - inicio
+    
+    relatorio = {
+        "arquivo": caminho,
+        "inicio": datetime.fromtimestamp(inicio).isoformat(),
+        "tempoTotal": round(tempo_total, 1),
+        "somaTempos": round(sum(r["tempo"] for r in resultados), 1),
+        "limites": {"texto": limite_texto, "imagens": limite_imagens},
+        "historias": resultados
+    }
+    caminho_relatorio = caminho_relatorio or f"relatorio_lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(caminho_relatorio, "w", encoding="utf-8") as f:
+        json.dump(relatorio, f, indent=4, ensure_ascii=False)
+    
+    print("\n" + "="*50)
+    print(f"📊 LOTE CONCLUÍDO EM {tempo_total:.1f}s (soma dos tempos: {relatorio['somaTempos']:.1f}s)")
+    print("="*50)
+    for r in resultados:
+        detalhe = r["erro"] or (f"imagens com falha: {', '.join(r['falhas'])}" if r["falhas"] else r["pasta"])
+        print(f"{'✅' if r['status'] == 'ok' else '⚠️'} {r['nome']} ({r['tempo']:.1f}s): {detalhe}")
+    print(f"📝 Relatório salvo em: {caminho_relatorio}")
+    return relatorio
 
 if __name__ == "__main__":
-    asyncio.run(pipeline_principal())
+    parser = argparse.ArgumentParser(description="Gera uma história ilustrada com Gemini")
+    parser.add_argument("--retomar", metavar="PASTA", help="pasta historia_* a retomar (só gera o que falta)")
+    parser.add_argument("--lote", metavar="ARQUIVO", help="JSONL ou CSV com nome, descricao, universo e fotos de cada história")
+    parser.add_argument("--texto", type=int, default=LIMITE_TEXTO, help="chamadas de texto simultâneas no lote")
+    parser.add_argument("--imagens", type=int, default=LIMITE_IMAGENS, help="chamadas de imagem simultâneas no lote")
+    parser.add_argument("--relatorio", metavar="ARQUIVO", help="onde salvar o relatório do lote")
+    parser.add_argument("--progressivo", action="store_true",
+                        help="rascunhos rápidos primeiro (livro pronto logo), versões finais em 2K depois")
+    parser.add_argument("--prazo", type=float, metavar="SEGUNDOS",
+                        help="prazo de cada história: passado ele, o livro sai com as imagens que já existem")
+    args = parser.parse_args()
+    MODO_PROGRESSIVO = args.progressivo
+    PRAZO_HISTORIA = args.prazo
+    if args.lote:
+        asyncio.run(pipeline_lote(args.lote, args.texto, args.imagens, args.relatorio))
+    else:
+        asyncio.run(pipeline_principal(pasta_retomada=args.retomar))
@@ -0,0 +1,177 @@
+"""
+Relatório de tempos da biblioteca de histórias
+Lê o rastro (trace) gravado no story.json do storymaker-app e no dados.json
+das pastas historia_* e mostra onde o tempo vai: distribuição de cada tipo de
+span e o caminho crítico de cada história (a cadeia de spans que determinou
+o tempo total).
+
+Uso:
+    python relatorio_tempos.py
+    python relatorio_tempos.py --api storymaker-app/historias --pastas . --top 5 --json tempos.json
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+
+PASTA_RAIZ = os.path.dirname(os.path.abspath(__file__))
+PASTA_API = os.getenv("STORIES_DIR", os.path.join(PASTA_RAIZ, "storymaker-app", "historias"))
+FOLGA = 0.001  # arredondamento dos offsets (ms)
+
+def carregar_rastros(pasta_api, pasta_historias):
+    """[(origem, título, trace)] de todas as histórias que têm rastro"""
+    arquivos = [("api", c) for c in glob.glob(os.path.join(pasta_api, "*", "story.json"))]
+    arquivos += [("historia", c) for c in glob.glob(os.path.join(pasta_historias, "historia_*", "dados.json"))]
+    rastros = []
+    for origem, caminho in sorted(arquivos, key=lambda a: a[1]):
+        try:
+            with open(caminho, "r", encoding="utf-8") as f:
+                dados = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        trace = dados.get("trace")
+        if trace and trace.get("spans"):
+            titulo = dados.get("title") or os.path.basename(os.path.dirname(caminho))
+            rastros.append((origem, titulo, trace))
+    return rastros
+
+def rotulo(span):
+    """Nome usado nas agregações (o modelo separa as chamadas de texto e imagem)"""
+    return f"{span['name']}[{span['model']}]" if span.get("model") else span["name"]
+
+def descricao(span):
+    extras = [str(span[k]) for k in ("image", "width") if span.get(k) is not None]
+    if span.get("attempt"):
+        extras.append(f"#{span['attempt']}")
+    if span.get("error"):
+        extras.append(span["error"])
+    if span.get("cancelled"):
+        extras.append("cancelado")
+    return rotulo(span) + (f" ({', '.join(extras)})" if extras else "")
+
+def filhos_por_pai(spans):
+    filhos = {}
+    for span in spans:
+        if span.get("end") is not None:
+            filhos.setdefault(span.get("parent"), []).append(span)
+    return filhos
+
+def caminho_critico(filhos, pai, inicio, fim):
+    """
+    Anda para trás a partir do fim: pega o filho que terminou por último,
+    depois o que terminou por último antes de ele começar, e assim por diante.
+    """
+    candidatos = [s for s in filhos.get(pai, []) if s["start"] >= inicio - FOLGA]
+    caminho = []
+    limite = fim
+    while True:
+        anteriores = [s for s in candidatos if s["end"] <= limite + FOLGA and s not in caminho]
+        if not anteriores:
+            break
+        span = max(anteriores, key=lambda s: s["end"])
+        caminho.append(span)
+        limite = span["start"]
+    caminho.reverse()
+    return caminho
+
+def segmentos(filhos, span, nome, inicio, fim, profundidade=0):
+    """
+    Decompõe [inicio, fim] do span pelo caminho crítico dos filhos:
+    [(profundidade, descrição, rótulo, segundos)], com o tempo fora dos filhos
+    atribuído ao próprio span como "(espera)".
+    """
+    resultado = []
+    cursor = inicio
+    for filho in caminho_critico(filhos, span, inicio, fim):
+        if filho["start"] - cursor > FOLGA:
+            resultado.append((profundidade, f"{nome} (espera)", f"{nome} (espera)", filho["start"] - cursor))
+        duracao = filho["end"] - filho["start"]
+        resultado.append((profundidade, descricao(filho), None, duracao))
+        sub = segmentos(filhos, filho["id"], rotulo(filho), filho["start"], filho["end"], profundidade + 1)
+        if sub:
+            resultado.extend(sub)
+        else:
+            # Folha do caminho: é ela que leva o tempo nas agregações
+            resultado[-1] = (profundidade, descricao(filho), rotulo(filho), duracao)
+        cursor = filho["end"]
+    if resultado and fim - cursor > FOLGA:
+        resultado.append((profundidade, f"{nome} (espera)", f"{nome} (espera)", fim - cursor))
+    return resultado
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, round(p / 100 * (len(ordenados) - 1)))]
+
+def gerar_relatorio(rastros):
+    duracoes = {}   # rótulo -> [segundos]
+    critico = {}    # rótulo -> [segundos no caminho crítico]
+    historias = []
+    for origem, titulo, trace in rastros:
+        for span in trace["spans"]:
+            if span.get("end") is not None:
+                duracoes.setdefault(rotulo(span), []).append(span["end"] - span["start"])
+        filhos = filhos_por_pai(trace["spans"])
+        caminho = segmentos(filhos, None, "história", 0.0, trace["total"])
+        for _, _, chave, segundos in caminho:
+            if chave is not None:
+                critico.setdefault(chave, []).append(segundos)
+        historias.append({"origem": origem, "titulo": titulo, "total": trace["total"], "caminho": caminho})
+
+    tempo_total = sum(h["total"] for h in historias) or 1.0
+    return {
+        "historias": len(historias),
+        "total": {"p50": percentil([h["total"] for h in historias], 50),
+                  "p95": percentil([h["total"] for h in historias], 95),
+                  "max": max(h["total"] for h in historias)},
+        "spans": {
+            chave: {"count": len(v), "p50": percentil(v, 50), "p95": percentil(v, 95),
+                    "p99": percentil(v, 99), "max": max(v), "mean": statistics.mean(v)}
+            for chave, v in sorted(duracoes.items())
+        },
+        "caminhoCritico": {
+            chave: {"count": len(v), "seconds": sum(v), "share": sum(v) / tempo_total}
+            for chave, v in sorted(critico.items(), key=lambda item: -sum(item[1]))
+        },
+        "maisLentas": sorted(historias, key=lambda h: -h["total"])
+    }
+
+def imprimir(relatorio, top):
+    total = relatorio["total"]
+    print(f"\n📚 {relatorio['historias']} histórias com rastro | total p50 {total['p50']:.1f}s, "
+          f"p95 {total['p95']:.1f}s, máx {total['max']:.1f}s")
+
+    print("\n⏱️ DURAÇÃO POR TIPO DE SPAN (s)")
+    print(f"{'span':<44}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'máx':>9}")
+    for chave, r in relatorio["spans"].items():
+        print(f"{chave:<44}{r['count']:>6}{r['p50']:>9.2f}{r['p95']:>9.2f}{r['p99']:>9.2f}{r['max']:>9.2f}")
+
+    print("\n🧭 CAMINHO CRÍTICO (soma de todas as histórias)")
+    print(f"{'span':<44}{'vezes':>6}{'segundos':>11}{'% do total':>12}")
+    for chave, r in relatorio["caminhoCritico"].items():
+        print(f"{chave:<44}{r['count']:>6}{r['seconds']:>11.1f}{r['share'] * 100:>11.1f}%")
+
+    print(f"\n🐢 {top} HISTÓRIAS MAIS LENTAS")
+    for historia in relatorio["maisLentas"][:top]:
+        print(f"\n{historia['total']:.1f}s  {historia['titulo']} [{historia['origem']}]")
+        for profundidade, texto, _, segundos in historia["caminho"]:
+            print(f"    {'  ' * profundidade}{segundos:7.2f}s  {texto}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relatório de tempos das histórias geradas")
+    parser.add_argument("--api", default=PASTA_API, help="pasta de histórias do storymaker-app (STORIES_DIR)")
+    parser.add_argument("--pastas", default=".", help="onde ficam as pastas historia_* do historia.py")
+    parser.add_argument("--top", type=int, default=3, help="quantas histórias lentas detalhar")
+    parser.add_argument("--json", metavar="ARQUIVO", help="salva também o relatório em JSON")
+    args = parser.parse_args()
+
+    rastros = carregar_rastros(args.api, args.pastas)
+    if not rastros:
+        print("Nenhuma história com rastro de tempos encontrada.")
+        raise SystemExit(0)
+    relatorio = gerar_relatorio(rastros)
+    imprimir(relatorio, args.top)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, indent=4, ensure_ascii=False)
+        print(f"\n📝 Relatório salvo em: {args.json}")
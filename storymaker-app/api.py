@@ -10,27 +10,85 @@ import asyncio
 import time
 import json
 import base64
+import copy
 import uuid
+import bisect
+import hashlib
+import random
+import sqlite3
+import gzip
+import stat
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
+from starlette.datastructures import Headers
+from starlette.responses import Response as StarletteResponse
+from starlette.staticfiles import NotModifiedResponse
+from pydantic import BaseModel, Field, ValidationError
+import httpx
 from google import genai
-from google.genai import types
+from google.genai import types, errors as genai_errors
 from dotenv import load_dotenv
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
 from io import BytesIO
 
+try:
+    import brotli  # opcional: sem ele, story.json é pré-comprimido só em gzip
+except ImportError:
+    brotli = None
+
 load_dotenv()  # Tenta local primeiro
 load_dotenv(dotenv_path="../.env")  # Tenta pasta pai (Scripts)
 
-app = FastAPI(title="Multiverso Particular API", version="1.0.0")
+# Pool de processos para codificar PNG e derivados responsivos fora do event loop
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", min(4, os.cpu_count() or 1)))
+WEBP_MAX_SIDE = 1200  # {id}.webp: versão web única, pronta junto com o PNG
+WEBP_QUALITY = 85
+DERIVATIVE_WIDTHS = (400, 800, 1200)
+DERIVATIVE_FORMATS = ("avif", "webp") if features.check("avif") else ("webp",)  # em ordem de preferência
+DERIVATIVE_QUALITY = {"avif": 60, "webp": 85}
+PLACEHOLDER_SIDE = 32  # miniatura embutida no image_done enquanto a imagem carrega
+encode_pool = ProcessPoolExecutor(max_workers=ENCODE_WORKERS)
+
+def _baixar_prioridade():
+    if hasattr(os, "nice"):
+        os.nice(10)
+
+# Derivados responsivos ficam para depois do image_done, num pool próprio com
+# prioridade menor: não atrasam o PNG e a prévia das imagens seguintes
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", max(1, ENCODE_WORKERS // 2)))
+derivative_pool = ProcessPoolExecutor(max_workers=DERIVATIVE_WORKERS, initializer=_baixar_prioridade)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicialização e encerramento da API"""
+    catalog.load()
+    result_cache.load()
+    character_store.load()
+    jobs.open()
+    aquecimento = asyncio.create_task(warm_up()) if API_WARMUP else None
+    yield
+    if aquecimento is not None:
+        aquecimento.cancel()
+    await jobs.close()
+    catalog.flush()
+    encode_pool.shutdown(wait=False, cancel_futures=True)
+    derivative_pool.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(title="Multiverso Particular API", version="1.0.0", lifespan=lifespan)
 
 # Pasta para salvar histórias
-STORIES_DIR = os.path.join(os.path.dirname(__file__), "historias")
+STORIES_DIR = os.getenv("STORIES_DIR", os.path.join(os.path.dirname(__file__), "historias"))
 os.makedirs(STORIES_DIR, exist_ok=True)
 
 # CORS para permitir requisições do frontend
@@ -43,9 +101,121 @@ app.add_middleware(
 )
 
 # Servir arquivos estáticos das histórias
-app.mount("/historias", StaticFiles(directory=STORIES_DIR), name="historias")
+IMMUTABLE_EXTENSIONS = (".png", ".webp", ".avif")
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))  # em ordem de preferência
+STATIC_ETAG_CACHE_SIZE = 4096
+
+def accepts_encoding(accept_encoding: str, codificacao: str) -> bool:
+    """O cabeçalho Accept-Encoding aceita a codificação (e não com q=0)?"""
+    for item in accept_encoding.split(","):
+        nome, _, parametros = item.strip().partition(";")
+        if nome.strip() in (codificacao, "*"):
+            return parametros.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+class StoryStaticFiles(StaticFiles):
+    """
+    Arquivos das histórias com cache HTTP:
+    - ETag forte (sha256 do conteúdo), calculado uma vez por arquivo
+    - imagens com Cache-Control immutable: nunca mudam depois de criadas
+      (uma imagem refeita ganha outro nome); o resto revalida (304)
+    - story.json servido pré-comprimido (.br/.gz) se o cliente aceitar
+    Range e If-Range ficam com o FileResponse do Starlette.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._etags = OrderedDict()  # (caminho, mtime_ns, tamanho) -> etag
+
+    def _etag(self, caminho: str, info: os.stat_result) -> str:
+        chave = (caminho, info.st_mtime_ns, info.st_size)
+        etag = self._etags.get(chave)
+        if etag is None:
+            with open(caminho, "rb") as f:
+                etag = f'"{hashlib.file_digest(f, "sha256").hexdigest()[:32]}"'
+            self._etags[chave] = etag
+            if len(self._etags) > STATIC_ETAG_CACHE_SIZE:
+                self._etags.popitem(last=False)
+        else:
+            self._etags.move_to_end(chave)
+        return etag
+
+    def _variante(self, caminho: str, info: os.stat_result, scope) -> tuple[str, os.stat_result, Optional[str]]:
+        """Versão pré-comprimida aceita pelo cliente (e não mais antiga que o original), se houver"""
+        if not caminho.endswith(".json"):
+            return caminho, info, None
+        aceitos = Headers(scope=scope).get("accept-encoding", "")
+        for codificacao, extensao in PRECOMPRESSED:
+            if not accepts_encoding(aceitos, codificacao):
+                continue
+            try:
+                info_comprimido = os.stat(caminho + extensao)
+            except FileNotFoundError:
+                continue
+            if info_comprimido.st_mtime_ns >= info.st_mtime_ns:
+                return caminho + extensao, info_comprimido, codificacao
+        return caminho, info, None
 
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    async def get_response(self, path: str, scope) -> StarletteResponse:
+        # Hash do conteúdo fora do event loop (file_response é síncrono)
+        try:
+            caminho, info = await asyncio.to_thread(self.lookup_path, path)
+        except (OSError, ValueError):
+            caminho, info = None, None
+        if info is not None and stat.S_ISREG(info.st_mode):
+            arquivo, info_arquivo, _ = self._variante(caminho, info, scope)
+            await asyncio.to_thread(self._etag, arquivo, info_arquivo)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> StarletteResponse:
+        arquivo, info, codificacao = self._variante(str(full_path), stat_result, scope)
+        headers = {"etag": self._etag(arquivo, info)}
+        if arquivo.endswith(IMMUTABLE_EXTENSIONS):
+            headers["cache-control"] = "public, max-age=31536000, immutable"
+        else:
+            headers["cache-control"] = "no-cache"
+        if str(full_path).endswith(".json"):
+            headers["vary"] = "Accept-Encoding"
+        if codificacao:
+            headers["content-encoding"] = codificacao
+        
+        response = FileResponse(
+            arquivo, status_code=status_code, headers=headers, stat_result=info,
+            media_type="application/json" if codificacao else None
+        )
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+app.mount("/historias", StoryStaticFiles(directory=STORIES_DIR), name="historias")
+
+# Conexões com o Gemini: pool do tamanho da concorrência máxima e keep-alive
+# longo (o padrão do httpx fecha a conexão após 5s ociosa, menos que uma
+# imagem leva), para não refazer TCP + TLS entre as chamadas de uma história.
+# O transporte explícito também mantém o SDK no httpx mesmo com aiohttp instalado.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 48))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", 120))
+client = genai.Client(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    http_options=types.HttpOptions(async_client_args={"transport": httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                            keepalive_expiry=HTTP_KEEPALIVE_SECONDS),
+    )}),
+)
+TEXT_MODEL = "gemini-3-flash-preview"
+IMAGE_MODEL = "gemini-3-pro-image-preview"
+
+# Modo progressivo (StoryRequest.progressive): rascunhos num modelo rápido
+# primeiro, trocados depois pela versão final em 2K gerada em segundo plano.
+# qualidade -> (modelo, image_size); None usa o tamanho padrão do modelo
+DRAFT_IMAGE_MODEL = os.getenv("DRAFT_IMAGE_MODEL", "gemini-2.5-flash-image")
+FINAL_IMAGE_SIZE = os.getenv("FINAL_IMAGE_SIZE", "2K")
+IMAGE_QUALITIES = {
+    "standard": (IMAGE_MODEL, None),
+    "draft": (DRAFT_IMAGE_MODEL, None),
+    "final": (IMAGE_MODEL, FINAL_IMAGE_SIZE),
+}
 
 # --- MODELOS ---
 class Story(BaseModel):
@@ -57,6 +227,8 @@ class Story(BaseModel):
         max_length=5
     )
 
+STORY_SCHEMA = Story.model_json_schema()  # calculado uma vez, não a cada história
+
 class Character(BaseModel):
     id: str
     name: str
@@ -68,55 +240,760 @@ class Universe(BaseModel):
     style: str
 
 class StoryRequest(BaseModel):
-    characters: List[Character]
+    characters: List[Character] = []
+    character_ids: List[str] = []  # personagens já enviados por POST /api/characters
     universe: Universe
     description: Optional[str] = None
+    use_cache: bool = True  # False força gerar tudo de novo, ignorando o cache de resultados
+    progressive: bool = False  # rascunhos rápidos primeiro, versões finais em 2K depois
+
+# --- AQUECIMENTO ---
+# Depois de subir (ou reiniciar um worker), a primeira história pagaria a
+# criação dos processos de codificação e o DNS + TCP + TLS com o Gemini.
+# O aquecimento roda em segundo plano no lifespan e não atrasa o startup.
+API_WARMUP = os.getenv("API_WARMUP", "1") == "1"
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", 4))  # conexões abertas de antemão
+
+def _preload_worker():
+    """Carrega os plugins do Pillow no processo do pool"""
+    Image.init()
+    return os.getpid()
+
+async def warm_up():
+    inicio = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    # Um envio por processo: o pool só cria processos quando há trabalho esperando
+    pids = await asyncio.gather(*(loop.run_in_executor(encode_pool, _preload_worker) for _ in range(ENCODE_WORKERS)))
+    abertas = 0
+    if os.getenv("GEMINI_API_KEY"):
+        # Chamadas simultâneas de metadados (sem cota de geração) abrem uma conexão
+        # cada, que fica no pool por HTTP_KEEPALIVE_SECONDS
+        modelos = [TEXT_MODEL, IMAGE_MODEL] * WARMUP_CONNECTIONS
+        respostas = await asyncio.gather(*(client.aio.models.get(model=m) for m in modelos[:WARMUP_CONNECTIONS]),
+                                         return_exceptions=True)
+        falhas = [r for r in respostas if isinstance(r, Exception)]
+        abertas = len(respostas) - len(falhas)
+        if falhas:
+            print(f"⚠️ Aquecimento das conexões com o Gemini falhou: {falhas[0]}")
+    print(f"🔥 Aquecimento em {time.perf_counter() - inicio:.1f}s: {len(set(pids))} processo(s) de codificação, "
+          f"{abertas} conexão(ões) com o Gemini")
+
+# --- MÉTRICAS (formato texto do Prometheus) ---
+
+# Limites dos buckets de latência, em segundos
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+
+def _labels_texto(labels: tuple) -> str:
+    """Formata os labels como {nome="valor",...}, com o escape do Prometheus"""
+    if not labels:
+        return ""
+    escapar = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{nome}="{escapar(valor)}"' for nome, valor in labels) + "}"
+
+class Counter:
+    """Contador monotônico com labels. Só é tocado pelo event loop, então dispensa lock."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series = {}  # labels (tupla ordenada) -> valor
+
+    def inc(self, valor: float = 1, **labels):
+        chave = tuple(sorted(labels.items()))
+        self._series[chave] = self._series.get(chave, 0) + valor
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels_texto(k)} {v}" for k, v in self._series.items()]
+
+class Histogram:
+    """
+    Histograma de buckets fixos com labels. observe() custa um bisect e
+    três somas; os acumulados do Prometheus só são montados na leitura.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [contagens por bucket (+Inf no fim), soma, total]
+
+    def observe(self, valor: float, **labels):
+        chave = tuple(sorted(labels.items()))
+        serie = self._series.get(chave)
+        if serie is None:
+            serie = self._series[chave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        serie[0][bisect.bisect_left(self.buckets, valor)] += 1
+        serie[1] += valor
+        serie[2] += 1
+
+    def render(self) -> List[str]:
+        linhas = []
+        for chave, (contagens, soma, total) in self._series.items():
+            acumulado = 0
+            for limite, contagem in zip(self.buckets + ("+Inf",), contagens):
+                acumulado += contagem
+                linhas.append(f"{self.name}_bucket{_labels_texto(chave + (('le', limite),))} {acumulado}")
+            linhas.append(f"{self.name}_sum{_labels_texto(chave)} {soma}")
+            linhas.append(f"{self.name}_count{_labels_texto(chave)} {total}")
+        return linhas
+
+class Gauge:
+    """Valor instantâneo lido de uma função no momento da coleta"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def render(self) -> List[str]:
+        return [f"{self.name} {self.func()}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metricas = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._registrar(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._registrar(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, func) -> Gauge:
+        return self._registrar(Gauge(name, help, func))
+
+    def _registrar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def render(self) -> str:
+        linhas = []
+        for metrica in self._metricas:
+            linhas.append(f"# HELP {metrica.name} {metrica.help}")
+            linhas.append(f"# TYPE {metrica.name} {metrica.kind}")
+            linhas.extend(metrica.render())
+        return "\n".join(linhas) + "\n"
+
+metrics = MetricsRegistry()
+TEXT_SECONDS = metrics.histogram(
+    "storymaker_text_generation_seconds", "Tempo para gerar o texto da história, com retentativas")
+IMAGE_SECONDS = metrics.histogram(
+    "storymaker_image_generation_seconds", "Tempo da chamada ao modelo de imagem, sem a espera na fila")
+QUEUE_SECONDS = metrics.histogram(
+    "storymaker_scheduler_wait_seconds", "Espera por uma vaga no agendador de chamadas ao Gemini",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+ENCODE_SECONDS = metrics.histogram(
+    "storymaker_image_encode_seconds", "Tempo para gravar o PNG, a versão web e a prévia",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+DERIVATIVE_SECONDS = metrics.histogram(
+    "storymaker_image_derivatives_seconds", "Tempo para gerar os derivados responsivos em segundo plano",
+    buckets=(0.5, 1, 2.5, 5, 10, 25, 50, 100))
+STORY_SECONDS = metrics.histogram(
+    "storymaker_story_seconds", "Tempo total de uma história, do início do job ao fim")
+RETRIES = metrics.counter("storymaker_retries_total", "Novas tentativas de chamadas ao Gemini, por classe de erro")
+IMAGES = metrics.counter("storymaker_images_total", "Imagens concluídas, por origem (modelo ou cache)")
+IMAGES_FAILED = metrics.counter("storymaker_images_failed_total", "Imagens que falharam em definitivo")
+IMAGE_REGENERATIONS = metrics.counter(
+    "storymaker_image_regenerations_total", "Imagens refeitas a pedido (POST .../regenerate), por resultado")
+IMAGE_UPGRADES = metrics.counter(
+    "storymaker_image_upgrades_total", "Rascunhos trocados pela versão final (modo progressivo), por resultado")
+STORIES = metrics.counter("storymaker_stories_total", "Histórias finalizadas, por resultado")
 
 # --- FUNÇÕES AUXILIARES ---
 
-# Configuração de retry
-MAX_RETRIES = 5
-BASE_DELAY = 1  # segundos
-MAX_DELAY = 5   # segundos
+# Contexto da história em execução (herdado pelas tasks criadas a partir dela):
+# {"id", "useCache", "retryBudget", "retries", "hedges", "trace", "deadline"}
+contexto_historia: ContextVar[Optional[dict]] = ContextVar("contexto_historia", default=None)
+
+# Configuração de retry por classe de erro: tentativas e backoff exponencial
+# com jitter completo (espera sorteada entre 0 e min(cap, base * 2^n))
+RETRY_POLICY = {
+    "rate_limit": {"attempts": 6, "base": 2.0, "cap": 60.0},
+    "transient": {"attempts": 4, "base": 1.0, "cap": 20.0},
+    "validation": {"attempts": 2, "base": 0.0, "cap": 0.0},  # 1 nova tentativa, sem espera
+    "safety": {"attempts": 1, "base": 0.0, "cap": 0.0},      # bloqueio de segurança: não repete
+    "deadline": {"attempts": 1, "base": 0.0, "cap": 0.0},    # prazo da história esgotado: não repete
+}
+# Total de novas tentativas permitidas por história (todas as chamadas somadas)
+STORY_RETRY_BUDGET = int(os.getenv("STORY_RETRY_BUDGET", 12))
+# Prazo total de uma história (texto + imagens) e limite de cada chamada ao modelo.
+# Passado o prazo, a história termina com as imagens que já existem (degradada).
+STORY_DEADLINE_SECONDS = float(os.getenv("STORY_DEADLINE_SECONDS", 300))
+TEXT_CALL_TIMEOUT = float(os.getenv("TEXT_CALL_TIMEOUT", 90))
+IMAGE_CALL_TIMEOUT = float(os.getenv("IMAGE_CALL_TIMEOUT", 120))
+
+class SafetyBlockError(ValueError):
+    """Resposta bloqueada pelos filtros de segurança do modelo"""
+
+class RetryBudgetExceeded(Exception):
+    """A história esgotou seu orçamento de novas tentativas"""
+
+class DeadlineExceeded(Exception):
+    """O prazo da história acabou"""
+
+def classify_error(e: Exception) -> str:
+    """Classifica o erro em rate_limit, transient, safety, validation ou deadline"""
+    if isinstance(e, SafetyBlockError):
+        return "safety"
+    if isinstance(e, DeadlineExceeded):
+        return "deadline"
+    code = getattr(e, "code", None)
+    if code == 429 or "RESOURCE_EXHAUSTED" in str(e):
+        return "rate_limit"
+    if isinstance(e, (ValidationError, json.JSONDecodeError)):
+        return "validation"
+    if isinstance(e, genai_errors.ClientError):
+        # 4xx (exceto 429): a mesma requisição vai falhar de novo
+        return "validation"
+    return "transient"
+
+def retry_hint(e: Exception) -> Optional[float]:
+    """Tempo de espera sugerido pelo servidor (RetryInfo.retryDelay ou Retry-After)"""
+    detalhes = getattr(e, "details", None)
+    if isinstance(detalhes, dict):
+        for item in detalhes.get("error", {}).get("details", []) or []:
+            delay = item.get("retryDelay") if isinstance(item, dict) else None
+            if delay:
+                try:
+                    return float(str(delay).rstrip("s"))
+                except ValueError:
+                    pass
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+def retry_delay(classe: str, attempt: int, hint: Optional[float] = None) -> float:
+    """Espera antes da próxima tentativa: backoff exponencial com jitter completo"""
+    politica = RETRY_POLICY[classe]
+    delay = random.uniform(0, min(politica["cap"], politica["base"] * 2 ** (attempt - 1)))
+    if hint is not None:
+        # Respeita a dica do servidor, com um pouco de jitter para dessincronizar
+        delay = hint + random.uniform(0, politica["base"])
+    return delay
+
+def time_left() -> Optional[float]:
+    """Segundos até o prazo da história atual (None fora de uma história)"""
+    contexto = contexto_historia.get()
+    if contexto is None:
+        return None
+    return contexto["deadline"] - time.monotonic()
+
+@asynccontextmanager
+async def call_timeout(limite: float, operation_name: str):
+    """
+    Limita uma chamada ao modelo a `limite` segundos, sem passar do prazo da
+    história. Estourar o limite é transitório (repete); estourar o prazo, não.
+    """
+    restante = time_left()
+    if restante is not None and restante <= 0:
+        raise DeadlineExceeded(f"{operation_name}: prazo da história esgotado")
+    segundos = limite if restante is None else min(limite, restante)
+    try:
+        async with asyncio.timeout(segundos):
+            yield
+    except TimeoutError as e:
+        if segundos < limite:
+            raise DeadlineExceeded(f"{operation_name}: prazo da história esgotado") from e
+        raise TimeoutError(f"{operation_name}: sem resposta em {segundos:.0f}s") from e
 
 async def retry_with_backoff(func, *args, operation_name="operação", **kwargs):
     """
-    Executa uma função async com retry e backoff exponencial.
-    Tenta até MAX_RETRIES vezes, esperando de 1 a 5 segundos entre tentativas.
+    Executa uma função async com retry conforme a classe do erro (RETRY_POLICY),
+    respeitando dicas de espera do servidor e o orçamento de retentativas e o
+    prazo da história atual.
     """
-    last_exception = None
+    attempt = 0
     
-    for attempt in range(1, MAX_RETRIES + 1):
+    while True:
+        attempt += 1
         try:
-            return await func(*args, **kwargs)
+            with span("attempt", operation=operation_name, attempt=attempt):
+                return await func(*args, **kwargs)
         except Exception as e:
-            last_exception = e
-            if attempt < MAX_RETRIES:
-                # Backoff exponencial: 1s, 2s, 3s, 4s, 5s (limitado a MAX_DELAY)
-                delay = min(BASE_DELAY * attempt, MAX_DELAY)
-                print(f"⚠️ Tentativa {attempt}/{MAX_RETRIES} falhou para {operation_name}: {e}")
-                print(f"   Aguardando {delay}s antes da próxima tentativa...")
+            classe = classify_error(e)
+            max_attempts = RETRY_POLICY[classe]["attempts"]
+            contexto = contexto_historia.get()
+            
+            if attempt >= max_attempts:
+                print(f"❌ Falha definitiva após {attempt} tentativa(s) para {operation_name} [{classe}]: {e}")
+                raise
+            
+            delay = retry_delay(classe, attempt, retry_hint(e))
+            restante = time_left()
+            if restante is not None and delay >= restante:
+                # Não adianta esperar: a próxima tentativa começaria depois do prazo
+                print(f"❌ Prazo da história esgotado em {operation_name} [{classe}]: {e}")
+                raise DeadlineExceeded(f"{operation_name}: {e}") from e
+            
+            if contexto is not None:
+                if contexto["retryBudget"] <= 0:
+                    print(f"❌ Orçamento de retentativas da história esgotado em {operation_name} [{classe}]: {e}")
+                    raise RetryBudgetExceeded(f"{operation_name}: {e}") from e
+                contexto["retryBudget"] -= 1
+                contexto["retries"][classe] = contexto["retries"].get(classe, 0) + 1
+            RETRIES.inc(**{"class": classe})
+            
+            print(f"⚠️ Tentativa {attempt}/{max_attempts} falhou para {operation_name} [{classe}]: {e}")
+            print(f"   Aguardando {delay:.1f}s antes da próxima tentativa...")
+            with span("backoff", operation=operation_name, attempt=attempt):
                 await asyncio.sleep(delay)
-            else:
-                print(f"❌ Falha definitiva após {MAX_RETRIES} tentativas para {operation_name}: {e}")
-    
-    raise last_exception
+
+class Trace:
+    """
+    Registro leve dos trechos (spans) de uma história: etapas, tentativas,
+    chamadas ao modelo, codificação e gravações, com início e fim em segundos
+    desde o começo da história. Mesmo formato do dados.json do historia.py.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.spans = []
+
+    def open(self, name: str, parent: Optional[int], **attrs) -> dict:
+        registro = {"id": len(self.spans), "parent": parent, "name": name,
+                    "start": round(time.perf_counter() - self.t0, 3), "end": None, **attrs}
+        self.spans.append(registro)
+        return registro
+
+    def close(self, registro: dict, **attrs):
+        registro["end"] = round(time.perf_counter() - self.t0, 3)
+        registro.update(attrs)
+
+    def add(self, name: str, parent: Optional[int], start: float, end: float, **attrs) -> dict:
+        """Span já medido (início e fim em perf_counter), por exemplo em outro processo"""
+        registro = {"id": len(self.spans), "parent": parent, "name": name,
+                    "start": round(start - self.t0, 3), "end": round(end - self.t0, 3), **attrs}
+        self.spans.append(registro)
+        return registro
+
+    def to_dict(self) -> dict:
+        return {"total": round(time.perf_counter() - self.t0, 3), "spans": self.spans}
+
+# Span aberto na task atual: os spans criados dentro dele (inclusive em tasks
+# filhas, que herdam o contexto) apontam para ele como pai
+span_atual: ContextVar[Optional[int]] = ContextVar("span_atual", default=None)
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Mede o bloco como um span da história atual (não faz nada fora de uma
+    história). Erros e cancelamentos ficam marcados no span.
+    """
+    contexto = contexto_historia.get()
+    if contexto is None:
+        yield
+        return
+    trace = contexto["trace"]
+    registro = trace.open(name, span_atual.get(), **attrs)
+    token = span_atual.set(registro["id"])
+    try:
+        yield
+    except asyncio.CancelledError:
+        trace.close(registro, cancelled=True)
+        raise
+    except Exception as e:
+        trace.close(registro, error=classify_error(e))
+        raise
+    else:
+        trace.close(registro)
+    finally:
+        span_atual.reset(token)
+
+def record_steps(etapas: List[tuple]):
+    """
+    Registra como filhos do span atual as etapas (nome, início, fim) de uma
+    tarefa do pool de processos, relativas ao começo dela. A tarefa acabou de
+    terminar: as etapas são posicionadas terminando agora.
+    """
+    contexto = contexto_historia.get()
+    if contexto is None or not etapas:
+        return
+    base = time.perf_counter() - max(fim for _, _, fim in etapas)
+    for nome, inicio, fim in etapas:
+        contexto["trace"].add(nome, span_atual.get(), base + inicio, base + fim)
+
+def new_story_context(use_cache: bool = True, deadline: float = STORY_DEADLINE_SECONDS) -> dict:
+    """Cria o contexto de execução de uma história (prazo em segundos a partir de agora)"""
+    return {
+        "id": uuid.uuid4().hex,
+        "useCache": use_cache,
+        "retryBudget": STORY_RETRY_BUDGET,
+        "retries": {},
+        "hedges": {"sent": 0, "won": 0, "savedTime": 0.0},
+        "trace": Trace(),
+        "deadline": time.monotonic() + deadline
+    }
+
+def check_safety_block(response, operation_name: str):
+    """Levanta SafetyBlockError se a resposta veio bloqueada por segurança"""
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        raise SafetyBlockError(f"{operation_name} bloqueada: {feedback.block_reason}")
+    for candidate in getattr(response, "candidates", None) or []:
+        motivo = str(candidate.finish_reason or "")
+        if any(m in motivo for m in ("SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII")):
+            raise SafetyBlockError(f"{operation_name} bloqueada: {motivo}")
 
 def send_event(event_type: str, data: dict) -> str:
     """Formata evento SSE"""
     payload = json.dumps({"type": event_type, **data}, ensure_ascii=False)
     return f"data: {payload}\n\n"
 
-def decode_base64_images(base64_images: List[str]) -> List[Image.Image]:
-    """Decodifica imagens Base64 para objetos PIL"""
-    images = []
-    for b64 in base64_images:
+# Fotos de referência normalizadas (rotação EXIF + redução + JPEG), reaproveitadas
+# por todas as imagens de uma história e por histórias seguintes
+REFERENCE_MAX_SIDE = 1024
+REFERENCE_JPEG_QUALITY = 90
+REFERENCE_CACHE_MB = int(os.getenv("REFERENCE_CACHE_MB", 64))
+
+def _normalizar_foto(dados: bytes, max_lado: int, qualidade: int) -> bytes:
+    """Corrige a rotação EXIF, reduz e recodifica a foto. Executa no pool de processos."""
+    with Image.open(BytesIO(dados)) as img:
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGB")
+        img.thumbnail((max_lado, max_lado), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=qualidade, optimize=True)
+        return buffer.getvalue()
+
+class ReferencePhotoCache:
+    """
+    Cache LRU de fotos de referência normalizadas, indexado pelo hash do
+    conteúdo. Guarda os bytes já prontos para envio (types.Part), então o SDK
+    não precisa serializar a mesma foto a cada chamada de imagem.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._fotos = OrderedDict()  # hash -> types.Part
+        self._total_bytes = 0
+        self._em_andamento = {}  # hash -> Future da normalização em curso
+
+    @staticmethod
+    def _payload(b64: str) -> str:
         # Remove o prefixo data:image/xxx;base64, se existir
-        if ',' in b64:
-            b64 = b64.split(',')[1]
-        image_data = base64.b64decode(b64)
-        images.append(Image.open(BytesIO(image_data)))
-    return images
+        return b64.split(',', 1)[1] if ',' in b64 else b64
+
+    @classmethod
+    def key(cls, b64: str) -> str:
+        """Hash do conteúdo da foto (calculado sobre o Base64, sem decodificar)"""
+        return hashlib.sha256(cls._payload(b64).encode("ascii")).hexdigest()
+
+    def _guardar(self, chave: str, foto: types.Part):
+        self._fotos[chave] = foto
+        self._total_bytes += len(foto.inline_data.data)
+        while self._total_bytes > self.max_bytes and len(self._fotos) > 1:
+            _, removida = self._fotos.popitem(last=False)
+            self._total_bytes -= len(removida.inline_data.data)
+
+    async def get_file(self, chave: str, caminho: str) -> tuple[str, types.Part]:
+        """Foto já normalizada em disco (personagens registrados), indexada pelo hash do arquivo"""
+        return await self._obter(chave, lambda: asyncio.to_thread(_ler_arquivo, caminho))
+
+    async def _obter(self, chave: str, carregar) -> tuple[str, types.Part]:
+        while True:
+            foto = self._fotos.get(chave)
+            if foto is not None:
+                self._fotos.move_to_end(chave)
+                return chave, foto
+
+            # Mesma foto sendo normalizada por outra requisição: aguarda o resultado
+            em_andamento = self._em_andamento.get(chave)
+            if em_andamento is None:
+                break
+            try:
+                return chave, await asyncio.shield(em_andamento)
+            except asyncio.CancelledError:
+                # Só repete se quem foi cancelado era a outra requisição, não esta
+                if not em_andamento.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._em_andamento[chave] = future
+        try:
+            dados = await carregar()
+            foto = types.Part.from_bytes(data=dados, mime_type="image/jpeg")
+            self._guardar(chave, foto)
+            future.set_result(foto)
+            return chave, foto
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # evita aviso de exceção não recuperada
+            raise
+        finally:
+            # Cancelada no meio da carga: libera quem aguardava para tentar de novo
+            if not future.done():
+                future.cancel()
+            del self._em_andamento[chave]
+
+    async def get_files(self, fotos: List[tuple[str, str]]) -> List[types.Part]:
+        """Várias fotos já normalizadas em disco: [(hash, caminho)]"""
+        resultados = await asyncio.gather(*(self.get_file(chave, caminho) for chave, caminho in fotos))
+        return [foto for _, foto in resultados]
+
+photo_cache = ReferencePhotoCache(REFERENCE_CACHE_MB * 1024 * 1024)
+
+def _ler_arquivo(caminho: str) -> bytes:
+    with open(caminho, "rb") as f:
+        return f.read()
+
+# --- PERSONAGENS (upload de fotos) ---
+
+# Personagens enviados uma vez por POST /api/characters (multipart gravado em
+# disco enquanto chega) e usados depois por id em create-story, sem Base64
+CHARACTERS_DIR = os.getenv("CHARACTERS_DIR", os.path.join(os.path.dirname(__file__), "characters"))
+MAX_CHARACTER_PHOTOS = int(os.getenv("MAX_CHARACTER_PHOTOS", 10))
+MAX_PHOTO_MB = int(os.getenv("MAX_PHOTO_MB", 20))
+MAX_FORM_FIELD_BYTES = 1024
+CHARACTER_ID_RE = re.compile(r"^[0-9a-f]{24}$")
+
+def _normalizar_arquivo(origem: str, pasta: str, max_lado: int, qualidade: int) -> dict:
+    """
+    Normaliza a foto enviada e grava como {sha256}.jpg na mesma pasta.
+    Executa no pool de processos.
+    """
+    with open(origem, "rb") as f:
+        dados = _normalizar_foto(f.read(), max_lado, qualidade)
+    sha = hashlib.sha256(dados).hexdigest()
+    with open(os.path.join(pasta, f"{sha}.jpg"), "wb") as f:
+        f.write(dados)
+    return {"file": f"{sha}.jpg", "sha256": sha, "bytes": len(dados)}
+
+class MultipartPhotoUpload:
+    """
+    Parser de multipart/form-data em streaming: cada arquivo vai para o disco
+    à medida que os pedaços chegam (com o hash calculado no caminho), e o
+    corpo inteiro nunca fica em memória. Campos de texto são guardados em fields.
+    """
+
+    def __init__(self, boundary: bytes, pasta: str, max_photos: int, max_photo_bytes: int):
+        self.pasta = pasta
+        self.max_photos = max_photos
+        self.max_photo_bytes = max_photo_bytes
+        self.fields = {}
+        self.photos = []   # {"path", "sha256", "bytes"} de cada arquivo recebido
+        self.error = None  # (status, detalhe) do primeiro problema encontrado
+        self._headers = {}
+        self._campo = bytearray()
+        self._valor = bytearray()
+        self._parte = None
+        self._pendentes = []  # (parte, bytes ou None para fechar) a gravar fora do event loop
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._inicio_parte,
+            "on_header_field": lambda dados, ini, fim: self._campo.extend(dados[ini:fim]),
+            "on_header_value": lambda dados, ini, fim: self._valor.extend(dados[ini:fim]),
+            "on_header_end": self._fim_cabecalho,
+            "on_headers_finished": self._cabecalhos_prontos,
+            "on_part_data": self._dados_parte,
+            "on_part_end": self._fim_parte,
+        })
+
+    def _falhar(self, status: int, detalhe: str):
+        if self.error is None:
+            self.error = (status, detalhe)
+
+    def _inicio_parte(self):
+        self._headers = {}
+
+    def _fim_cabecalho(self):
+        self._headers[bytes(self._campo).lower()] = bytes(self._valor)
+        self._campo.clear()
+        self._valor.clear()
+
+    def _cabecalhos_prontos(self):
+        _, opcoes = parse_options_header(self._headers.get(b"content-disposition", b""))
+        nome = opcoes.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" not in opcoes:
+            self._parte = {"field": nome, "value": bytearray()}
+            return
+        if len(self.photos) >= self.max_photos:
+            self._falhar(413, f"No máximo {self.max_photos} fotos por personagem")
+            self._parte = None
+            return
+        caminho = os.path.join(self.pasta, f"upload_{len(self.photos)}")
+        self._parte = {"path": caminho, "file": None, "hash": hashlib.sha256(), "bytes": 0}
+        self.photos.append(self._parte)
+
+    def _dados_parte(self, dados, inicio, fim):
+        parte = self._parte
+        if parte is None or self.error is not None:
+            return
+        pedaco = bytes(dados[inicio:fim])
+        if "field" in parte:
+            parte["value"].extend(pedaco)
+            if len(parte["value"]) > MAX_FORM_FIELD_BYTES:
+                self._falhar(413, f"Campo {parte['field']} grande demais")
+            return
+        parte["bytes"] += len(pedaco)
+        if parte["bytes"] > self.max_photo_bytes:
+            self._falhar(413, f"Cada foto pode ter no máximo {self.max_photo_bytes // (1024 * 1024)}MB")
+            return
+        parte["hash"].update(pedaco)
+        self._pendentes.append((parte, pedaco))
+
+    def _fim_parte(self):
+        parte, self._parte = self._parte, None
+        if parte is None:
+            return
+        if "field" in parte:
+            self.fields[parte["field"]] = parte["value"].decode("utf-8", "replace")
+        else:
+            parte["sha256"] = parte.pop("hash").hexdigest()
+            self._pendentes.append((parte, None))
+
+    @staticmethod
+    def _gravar(pendentes):
+        for parte, pedaco in pendentes:
+            if parte["file"] is None:
+                parte["file"] = open(parte["path"], "wb")
+            if pedaco is None:
+                parte["file"].close()
+            else:
+                parte["file"].write(pedaco)
+
+    async def feed(self, pedaco: bytes):
+        """Processa mais um pedaço do corpo e grava o que chegou dos arquivos"""
+        try:
+            self._parser.write(pedaco)
+        except MultipartParseError as e:
+            self._falhar(400, f"Multipart inválido: {e}")
+            return
+        if self._pendentes and self.error is None:
+            pendentes, self._pendentes = self._pendentes, []
+            await asyncio.to_thread(self._gravar, pendentes)
+
+    async def finish(self):
+        try:
+            self._parser.finalize()
+        except MultipartParseError as e:
+            self._falhar(400, f"Multipart inválido: {e}")
+            return
+        await self.feed(b"")
+        if any(p["file"] is None or not p["file"].closed for p in self.photos) and self.error is None:
+            self._falhar(400, "Upload incompleto")
+
+    def close(self):
+        for parte in self.photos:
+            if parte.get("file") is not None and not parte["file"].closed:
+                parte["file"].close()
+
+class CharacterStore:
+    """
+    Personagens em disco: {id}/character.json e as fotos já normalizadas
+    ({sha256}.jpg). O id é o hash do nome e das fotos, então reenviar o mesmo
+    personagem devolve o mesmo id sem duplicar arquivos.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._personagens = {}  # id -> metadados (pequenos, só o que já foi lido)
+        self._por_base64 = {}   # hash do nome + fotos em base64 -> id já registrado
+
+    def load(self):
+        """Cria a pasta e apaga uploads interrompidos por um reinício"""
+        os.makedirs(self.directory, exist_ok=True)
+        for pasta in glob.glob(os.path.join(self.directory, ".upload-*")):
+            shutil.rmtree(pasta, ignore_errors=True)
+
+    def upload_dir(self) -> str:
+        """Pasta temporária para um upload em andamento (dentro do diretório final, para o rename ser atômico)"""
+        pasta = os.path.join(self.directory, f".upload-{uuid.uuid4().hex}")
+        os.makedirs(pasta)
+        return pasta
+
+    async def register(self, name: str, pasta_upload: str, photos: List[dict]) -> dict:
+        """Normaliza as fotos no pool de processos e publica o personagem"""
+        loop = asyncio.get_running_loop()
+        try:
+            normalizadas = await asyncio.gather(*(
+                loop.run_in_executor(encode_pool, _normalizar_arquivo, foto["path"], pasta_upload,
+                                     REFERENCE_MAX_SIDE, REFERENCE_JPEG_QUALITY)
+                for foto in photos
+            ))
+        except (UnidentifiedImageError, OSError) as e:
+            raise HTTPException(status_code=422, detail=f"Arquivo não é uma imagem válida: {e}")
+        
+        # A mesma foto enviada duas vezes vira uma só
+        normalizadas = list({foto["sha256"]: foto for foto in normalizadas}.values())
+        identidade = json.dumps({"name": name, "photos": [f["sha256"] for f in normalizadas]}, ensure_ascii=False)
+        character_id = hashlib.sha256(identidade.encode("utf-8")).hexdigest()[:24]
+        personagem = {"id": character_id, "name": name, "photos": normalizadas,
+                      "createdAt": datetime.now().isoformat()}
+        
+        def publicar():
+            destino = os.path.join(self.directory, character_id)
+            if os.path.exists(destino):
+                return  # já registrado (mesmo nome e fotos)
+            for foto in photos:
+                os.remove(foto["path"])
+            with open(os.path.join(pasta_upload, "character.json"), "w", encoding="utf-8") as f:
+                json.dump(personagem, f, indent=2, ensure_ascii=False)
+            try:
+                os.replace(pasta_upload, destino)
+            except OSError:
+                pass  # outro upload idêntico publicou primeiro
+        
+        await asyncio.to_thread(publicar)
+        return self.get(character_id) or personagem
+
+    async def register_base64(self, name: str, images: List[str]) -> dict:
+        """
+        Registra um personagem enviado em base64 no POST /api/create-story: as
+        fotos ficam em disco e a história pode ser refeita depois de um
+        reinício. O mesmo personagem reenviado não é normalizado de novo.
+        """
+        identidade = json.dumps({"name": name, "photos": [ReferencePhotoCache.key(b64) for b64 in images]}, ensure_ascii=False)
+        chave = hashlib.sha256(identidade.encode("utf-8")).hexdigest()
+        if (character_id := self._por_base64.get(chave)) and (personagem := self.get(character_id)):
+            return personagem
+        
+        def gravar():
+            pasta = self.upload_dir()
+            fotos = []
+            for i, b64 in enumerate(images):
+                caminho = os.path.join(pasta, f"foto_{i}")
+                with open(caminho, "wb") as f:
+                    f.write(base64.b64decode(ReferencePhotoCache._payload(b64)))
+                fotos.append({"path": caminho})
+            return pasta, fotos
+        
+        pasta_upload, fotos = await asyncio.to_thread(gravar)
+        try:
+            personagem = await self.register(name, pasta_upload, fotos)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, pasta_upload, True)
+        self._por_base64[chave] = personagem["id"]
+        return personagem
+
+    def get(self, character_id: str) -> Optional[dict]:
+        if not CHARACTER_ID_RE.match(character_id):
+            return None
+        personagem = self._personagens.get(character_id)
+        if personagem is None:
+            caminho = os.path.join(self.directory, character_id, "character.json")
+            try:
+                with open(caminho, "r", encoding="utf-8") as f:
+                    personagem = json.load(f)
+            except FileNotFoundError:
+                return None
+            self._personagens[character_id] = personagem
+        return personagem
+
+    def photo_paths(self, personagem: dict) -> List[tuple[str, str]]:
+        """[(hash, caminho)] das fotos normalizadas, para o cache de fotos de referência"""
+        pasta = os.path.join(self.directory, personagem["id"])
+        return [(foto["sha256"], os.path.join(pasta, foto["file"])) for foto in personagem["photos"]]
+
+character_store = CharacterStore(CHARACTERS_DIR)
 
 def sanitize_filename(name: str) -> str:
     """Remove caracteres inválidos de nomes de arquivo"""
@@ -131,11 +1008,967 @@ def create_story_folder(title: str) -> tuple[str, str]:
     os.makedirs(folder_path, exist_ok=True)
     return folder_path, story_id, folder_name
 
-async def _gerar_json_historia_interno(characters: List[Character], universe: Universe, description: str):
-    """Função interna que gera a estrutura da história."""
+STORY_BROTLI_QUALITY = 5  # bem mais rápido que 11 e quase o mesmo tamanho num JSON pequeno
+
+def _gravar_story_json(pasta: str, dados: bytes) -> str:
+    """Comprime e grava o story.json e as versões comprimidas. Executa numa thread."""
+    json_path = os.path.join(pasta, "story.json")
+    variantes = [(json_path, dados), (json_path + ".gz", gzip.compress(dados, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variantes.append((json_path + ".br", brotli.compress(dados, quality=STORY_BROTLI_QUALITY)))
+    for caminho, conteudo in variantes:
+        with open(caminho + ".tmp", "wb") as f:
+            f.write(conteudo)
+        os.replace(caminho + ".tmp", caminho)
+    return json_path
+
+_gravacoes_story = {}  # pasta -> {"lock", "users"}: gravações do mesmo story.json em ordem
+
+async def save_story_json(pasta: str, story: dict) -> str:
+    """
+    Grava o story.json (troca atômica) e as versões pré-comprimidas servidas
+    em /historias. As comprimidas vão depois: enquanto forem mais antigas que
+    o story.json, o servidor as ignora.
+    Derivados responsivos já prontos em segundo plano entram na história.
+    O JSON é serializado na hora (a história pode mudar depois); compressão e
+    gravação rodam numa thread, uma por vez para cada pasta.
+    """
+    derivative_builder.apply(pasta, story)
+    dados = json.dumps(story, indent=2, ensure_ascii=False).encode("utf-8")
+    gravacao = _gravacoes_story.setdefault(pasta, {"lock": asyncio.Lock(), "users": 0})
+    gravacao["users"] += 1
+    try:
+        async with gravacao["lock"]:
+            return await asyncio.to_thread(_gravar_story_json, pasta, dados)
+    finally:
+        gravacao["users"] -= 1
+        if not gravacao["users"]:
+            del _gravacoes_story[pasta]
+
+# --- CACHE DE RESULTADOS ---
+
+# Cache em disco de histórias (JSON) e imagens geradas, endereçado pelo hash
+# de modelo + prompt + fotos de referência + formato
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".cache"))
+RESULT_CACHE_MB = int(os.getenv("RESULT_CACHE_MB", 2048))
+MIME_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "application/json": "json"}
+
+class ResultCache:
+    """
+    Cache de resultados em disco com limite de tamanho e remoção LRU.
+    O mtime de cada arquivo marca o último uso, então a ordem LRU
+    sobrevive a reinícios da API.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()  # chave -> (nome do arquivo, tamanho), em ordem de uso
+        self._total_bytes = 0
+
+    @staticmethod
+    def key(**partes) -> str:
+        """Hash estável das partes que determinam o resultado"""
+        texto = json.dumps(partes, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+    def load(self):
+        """Indexa o conteúdo da pasta de cache (uma vez, na inicialização)"""
+        os.makedirs(self.directory, exist_ok=True)
+        arquivos = []
+        for nome in os.listdir(self.directory):
+            if nome.endswith(".tmp"):
+                continue
+            info = os.stat(os.path.join(self.directory, nome))
+            arquivos.append((info.st_mtime, nome, info.st_size))
+        for _, nome, tamanho in sorted(arquivos):
+            self._registrar(nome.split(".")[0], nome, tamanho)
+        self._remover_excedente()
+
+    def _registrar(self, chave: str, nome: str, tamanho: int):
+        anterior = self._entradas.pop(chave, None)
+        if anterior is not None:
+            self._total_bytes -= anterior[1]
+        self._entradas[chave] = (nome, tamanho)
+        self._total_bytes += tamanho
+
+    def _remover_excedente(self):
+        while self._total_bytes > self.max_bytes and self._entradas:
+            _, (nome, tamanho) = self._entradas.popitem(last=False)
+            self._total_bytes -= tamanho
+            try:
+                os.remove(os.path.join(self.directory, nome))
+            except FileNotFoundError:
+                pass
+
+    def _ler(self, nome: str) -> bytes:
+        caminho = os.path.join(self.directory, nome)
+        with open(caminho, "rb") as f:
+            dados = f.read()
+        os.utime(caminho)  # marca o uso para a ordem LRU
+        return dados
+
+    def _gravar(self, nome: str, dados: bytes):
+        caminho = os.path.join(self.directory, nome)
+        tmp_path = f"{caminho}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(dados)
+        os.replace(tmp_path, caminho)
+
+    async def get(self, chave: str) -> Optional[tuple[bytes, str]]:
+        """Retorna (bytes, mime_type) ou None se não estiver no cache"""
+        entrada = self._entradas.get(chave)
+        if entrada is None:
+            return None
+        self._entradas.move_to_end(chave)
+        nome = entrada[0]
+        try:
+            with span("cache_read", bytes=entrada[1]):
+                dados = await asyncio.to_thread(self._ler, nome)
+        except FileNotFoundError:
+            self._total_bytes -= self._entradas.pop(chave)[1]
+            return None
+        extensao = nome.rsplit(".", 1)[-1]
+        mime_type = next((m for m, ext in MIME_EXTENSIONS.items() if ext == extensao), "application/octet-stream")
+        return dados, mime_type
+
+    async def put(self, chave: str, dados: bytes, mime_type: str):
+        nome = f"{chave}.{MIME_EXTENSIONS.get(mime_type, 'bin')}"
+        with span("cache_write", bytes=len(dados)):
+            await asyncio.to_thread(self._gravar, nome, dados)
+        self._registrar(chave, nome, len(dados))
+        self._remover_excedente()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entradas), "bytes": self._total_bytes, "maxBytes": self.max_bytes}
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MB * 1024 * 1024)
+
+def cache_enabled() -> bool:
+    """O cache de resultados vale para a história atual? (opt-out por requisição)"""
+    contexto = contexto_historia.get()
+    return contexto is None or contexto["useCache"]
+
+# --- CATÁLOGO DE HISTÓRIAS ---
+
+# Pastas seguem o padrão de create_story_folder: {timestamp}_{uuid8}_{titulo}
+STORY_FOLDER_RE = re.compile(r"^(\d{8}_\d{6}_[0-9a-f]{8})(?:_|$)")
+STORY_INDEX_FILE = "_index.json"
+STORY_CACHE_SIZE = 256  # story.json mantidos em memória (LRU)
+STORY_INDEX_DEBOUNCE = 1.0  # _index.json gravado no máximo uma vez por segundo
+
+# Campos do story.json que entram na listagem (GET /api/stories)
+STORY_SUMMARY_FIELDS = ("id", "folder", "createdAt", "title", "universe", "characters",
+                        "imageQuality", "upgrading", "missingImages", "totalTime")
+
+class StoryCatalog:
+    """
+    Índice das histórias salvas: mapa id -> pasta ordenado por data de criação,
+    persistido em historias/_index.json. O conteúdo dos story.json fica num
+    LRU limitado, então buscas por id não listam diretórios nem leem o disco
+    para as histórias mais acessadas.
+    create_story registra as novas histórias e mudanças feitas por outros
+    processos são detectadas pelo mtime da pasta de histórias.
+    """
+
+    def __init__(self, stories_dir: str, cache_size: int = STORY_CACHE_SIZE):
+        self.stories_dir = stories_dir
+        self.index_path = os.path.join(stories_dir, STORY_INDEX_FILE)
+        self.cache_size = cache_size
+        self._entradas = {}      # story_id -> {"folder", "createdAt"}
+        self._pastas = {}        # nome da pasta -> story_id
+        self._ordem = []         # [(createdAt, story_id)] em ordem crescente
+        self._cache = OrderedDict()  # story_id -> conteúdo do story.json
+        self._pendentes = set()  # pastas ainda sem story.json
+        self._dir_mtime = None
+        self._indice_agendado = None  # TimerHandle da próxima gravação do índice
+
+    def _ler_pasta(self, folder_name: str) -> Optional[dict]:
+        json_path = os.path.join(self.stories_dir, folder_name, "story.json")
+        if not os.path.exists(json_path):
+            return None
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Erro ao ler {json_path}: {e}")
+            return None
+
+    def _cachear(self, story_id: str, story: dict):
+        self._cache[story_id] = story
+        self._cache.move_to_end(story_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _indexar(self, story_id: str, folder_name: str, created_at: str):
+        if story_id in self._entradas:
+            self._remover(story_id)
+        self._entradas[story_id] = {"folder": folder_name, "createdAt": created_at}
+        self._pastas[folder_name] = story_id
+        bisect.insort(self._ordem, (created_at, story_id))
+        self._pendentes.discard(folder_name)
+
+    def _adicionar(self, folder_name: str, story: dict):
+        match = STORY_FOLDER_RE.match(folder_name)
+        story_id = story.get("id") or (match.group(1) if match else folder_name)
+        self._indexar(story_id, folder_name, story.get("createdAt", ""))
+        self._cachear(story_id, story)
+
+    def _remover(self, story_id: str):
+        entrada = self._entradas.pop(story_id, None)
+        if entrada is None:
+            return
+        self._cache.pop(story_id, None)
+        self._pastas.pop(entrada["folder"], None)
+        chave = (entrada["createdAt"], story_id)
+        i = bisect.bisect_left(self._ordem, chave)
+        if i < len(self._ordem) and self._ordem[i] == chave:
+            del self._ordem[i]
+
+    def _sincronizar(self) -> bool:
+        """
+        Compara a listagem da pasta com o índice e aplica só as diferenças.
+        Retorna True se o índice mudou.
+        """
+        pastas = {
+            f for f in os.listdir(self.stories_dir)
+            if os.path.isdir(os.path.join(self.stories_dir, f))
+        }
+        removidas = set(self._pastas) - pastas
+        novas = pastas - set(self._pastas)
+        for folder_name in removidas:
+            self._remover(self._pastas[folder_name])
+        self._pendentes &= pastas
+        for folder_name in novas:
+            story = self._ler_pasta(folder_name)
+            if story is None:
+                self._pendentes.add(folder_name)
+            else:
+                self._adicionar(folder_name, story)
+        return bool(removidas) or bool(novas - self._pendentes)
+
+    def _carregar_indice(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                dados = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Erro ao ler {self.index_path}: {e}")
+            return
+        for story_id, entrada in dados.get("stories", {}).items():
+            self._indexar(story_id, entrada["folder"], entrada.get("createdAt", ""))
+
+    def _salvar_indice(self):
+        """Grava o índice de forma atômica (arquivo temporário + rename)."""
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stories": self._entradas}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+        # A própria gravação altera o mtime da pasta; não é mudança externa
+        self._dir_mtime = os.stat(self.stories_dir).st_mtime_ns
+
+    def _agendar_indice(self):
+        """
+        Agrupa as mudanças do índice numa gravação a cada STORY_INDEX_DEBOUNCE;
+        fora do event loop grava na hora.
+        """
+        if self._indice_agendado is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._salvar_indice()
+            return
+        self._indice_agendado = loop.call_later(STORY_INDEX_DEBOUNCE, self.flush)
+
+    def flush(self):
+        """Grava já o índice, se houver gravação agendada (usado no encerramento)"""
+        if self._indice_agendado is None:
+            return
+        self._indice_agendado.cancel()
+        self._indice_agendado = None
+        self._salvar_indice()
+
+    def load(self):
+        """
+        Carrega o índice persistido e reconcilia com o disco uma única vez
+        (na inicialização); só pastas ausentes do índice têm o story.json lido.
+        """
+        self._carregar_indice()
+        self._dir_mtime = os.stat(self.stories_dir).st_mtime_ns
+        if self._sincronizar() or not os.path.exists(self.index_path):
+            self._salvar_indice()
+        print(f"📚 Catálogo carregado: {len(self._entradas)} histórias")
+
+    def refresh(self):
+        """Atualiza o índice se outro processo alterou a pasta de histórias."""
+        mudou = False
+        mtime = os.stat(self.stories_dir).st_mtime_ns
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            mudou = self._sincronizar()
+        # Pastas criadas sem story.json: o arquivo pode aparecer depois
+        # sem alterar o mtime da pasta pai
+        for folder_name in list(self._pendentes):
+            story = self._ler_pasta(folder_name)
+            if story is not None:
+                self._adicionar(folder_name, story)
+                mudou = True
+        if mudou:
+            self._agendar_indice()
+
+    def add(self, folder_name: str, story: dict):
+        """Registra uma história recém-salva por este processo."""
+        self._adicionar(folder_name, story)
+        self._agendar_indice()
+
+    def get(self, story_id: str) -> Optional[dict]:
+        """Busca uma história pelo id exato: O(1), sem listar diretórios."""
+        story = self._cache.get(story_id)
+        if story is not None:
+            self._cache.move_to_end(story_id)
+            return story
+        entrada = self._entradas.get(story_id)
+        if entrada is None:
+            return None
+        story = self._ler_pasta(entrada["folder"])
+        if story is None:
+            # Pasta removida por fora: descarta a entrada
+            self._remover(story_id)
+            self._agendar_indice()
+            return None
+        self._cachear(story_id, story)
+        return story
+
+    def get_folder(self, folder_name: str) -> Optional[dict]:
+        """Busca uma história pelo nome da pasta (None se ainda não tem story.json)"""
+        story_id = self._pastas.get(folder_name)
+        return self.get(story_id) if story_id is not None else None
+
+    @staticmethod
+    def summary(story: dict) -> dict:
+        """
+        Resumo da história para listagens: sem partes, prompts, derivados e
+        trace, que são a maior parte do story.json (a íntegra está em get).
+        """
+        resumo = {campo: story[campo] for campo in STORY_SUMMARY_FIELDS if campo in story}
+        if "capa" in story.get("images", {}):
+            resumo["cover"] = story["images"]["capa"]
+            resumo["coverPreview"] = story.get("previews", {}).get("capa")
+        return resumo
+
+    def page(self, limit: int, after: Optional[str] = None) -> tuple[List[dict], Optional[str]]:
+        """
+        Retorna (resumos das histórias, próximo_cursor) da mais recente para a
+        mais antiga. `after` é o id da última história da página anterior.
+        """
+        fim = len(self._ordem)
+        if after is not None:
+            entrada = self._entradas.get(after)
+            if entrada is None:
+                raise KeyError(after)
+            fim = bisect.bisect_left(self._ordem, (entrada["createdAt"], after))
+        inicio = max(0, fim - limit)
+        ids = [story_id for _, story_id in reversed(self._ordem[inicio:fim])]
+        next_cursor = ids[-1] if ids and inicio > 0 else None
+        stories = [self.summary(story) for story in map(self.get, ids) if story is not None]
+        return stories, next_cursor
+
+catalog = StoryCatalog(STORIES_DIR)
+
+# --- AGENDADOR DE CHAMADAS AO GEMINI ---
+
+# Limites globais (processo inteiro) de chamadas simultâneas por tipo.
+# São valores iniciais: o limitador adaptativo (AIMD) ajusta entre MIN e MAX.
+TEXT_CONCURRENCY = int(os.getenv("TEXT_CONCURRENCY", 4))
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", 6))
+TEXT_MAX_CONCURRENCY = int(os.getenv("TEXT_MAX_CONCURRENCY", 16))
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", 24))
+MIN_CONCURRENCY = 1
+AIMD_BACKOFF_RATE_LIMIT = 0.5   # corte multiplicativo em 429
+AIMD_BACKOFF_LATENCY = 0.8      # corte multiplicativo em pico de latência
+AIMD_LATENCY_SPIKE = 2.0        # pico = latência > 2x a mediana da janela
+AIMD_WINDOW = 50                # últimas latências usadas como referência
+AIMD_MIN_SAMPLES = 5            # amostras antes de começar a detectar picos
+AIMD_COOLDOWN = 5.0             # no máximo um corte a cada 5s
+# Controle de admissão: histórias rodando ao mesmo tempo e tamanho da fila
+MAX_ACTIVE_STORIES = int(os.getenv("MAX_ACTIVE_STORIES", 4))
+MAX_QUEUED_STORIES = int(os.getenv("MAX_QUEUED_STORIES", 20))
+
+class AdaptiveLimit:
+    """
+    Limite de concorrência AIMD (aumento aditivo, redução multiplicativa):
+    cresce ~1 vaga por "janela" de chamadas saudáveis e é cortado em erros
+    de limite de taxa ou picos de latência.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.value = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_avg = None  # média móvel exponencial das latências
+        self._janela = deque(maxlen=AIMD_WINDOW)  # latências recentes, inclusive picos
+        self._ultimo_corte = 0.0
+
+    @property
+    def current(self) -> int:
+        return int(self.value)
+
+    def _cortar(self, fator: float, motivo: str):
+        agora = time.time()
+        if agora - self._ultimo_corte < AIMD_COOLDOWN:
+            return
+        self._ultimo_corte = agora
+        anterior = self.current
+        self.value = max(self.minimum, self.value * fator)
+        print(f"📉 Limite de concorrência {anterior} -> {self.current} ({motivo})")
+
+    @property
+    def baseline(self) -> Optional[float]:
+        """Mediana das latências recentes; None até haver amostras suficientes"""
+        if len(self._janela) < AIMD_MIN_SAMPLES:
+            return None
+        ordenadas = sorted(self._janela)
+        return ordenadas[len(ordenadas) // 2]
+
+    def on_success(self, latency: float):
+        referencia = self.baseline
+        # Toda latência entra na janela e na média: se a mudança persistir,
+        # ela vira a nova referência em vez de prender o limite no mínimo
+        self._janela.append(latency)
+        self.latency_avg = latency if self.latency_avg is None else 0.8 * self.latency_avg + 0.2 * latency
+        if referencia is not None and latency > referencia * AIMD_LATENCY_SPIKE:
+            self._cortar(AIMD_BACKOFF_LATENCY, f"latência {latency:.1f}s")
+            return
+        self.value = min(self.maximum, self.value + 1 / self.value)
+
+    def on_rate_limit(self):
+        self._cortar(AIMD_BACKOFF_RATE_LIMIT, "limite de taxa")
+
+class FairLane:
+    """
+    Limite de chamadas simultâneas com fila justa entre histórias: as vagas
+    são distribuídas em round-robin, então as 6 imagens de uma história não
+    atrasam a primeira imagem de outra.
+    """
+
+    def __init__(self, limit: AdaptiveLimit):
+        self.adaptive = limit
+        self.in_flight = 0
+        self._filas = OrderedDict()  # chave da história -> deque[Future]
+
+    @property
+    def limit(self) -> int:
+        return self.adaptive.current
+
+    def on_success(self, latency: float):
+        self.adaptive.on_success(latency)
+        # O limite pode ter subido: libera quem estiver esperando
+        self._despachar()
+
+    def on_rate_limit(self):
+        self.adaptive.on_rate_limit()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(fila) for fila in self._filas.values())
+
+    async def acquire(self, chave: str):
+        if self.in_flight < self.limit and not self._filas:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._filas.setdefault(chave, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # A vaga chegou junto com o cancelamento: devolve
+                self.release()
+            else:
+                fila = self._filas.get(chave)
+                if fila is not None and future in fila:
+                    fila.remove(future)
+                    if not fila:
+                        del self._filas[chave]
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._despachar()
+
+    def _despachar(self):
+        while self.in_flight < self.limit and self._filas:
+            chave, fila = next(iter(self._filas.items()))
+            future = fila.popleft()
+            # Round-robin: a história atendida vai para o fim da fila
+            if fila:
+                self._filas.move_to_end(chave)
+            else:
+                del self._filas[chave]
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+class GeminiScheduler:
+    """
+    Agendador global das chamadas ao Gemini, com uma faixa para texto e uma
+    por qualidade de imagem: um final em 2K leva bem mais que um rascunho e,
+    na mesma faixa, pareceria um pico de latência para o limite adaptativo.
+    """
+
+    def __init__(self):
+        self.lanes = {
+            "text": FairLane(AdaptiveLimit(TEXT_CONCURRENCY, MIN_CONCURRENCY, TEXT_MAX_CONCURRENCY)),
+            **{
+                f"image:{quality}": FairLane(AdaptiveLimit(IMAGE_CONCURRENCY, MIN_CONCURRENCY, IMAGE_MAX_CONCURRENCY))
+                for quality in IMAGE_QUALITIES
+            }
+        }
+
+    @asynccontextmanager
+    async def slot(self, tipo: str, quality: Optional[str] = None):
+        """
+        Aguarda uma vaga do tipo pedido (e da qualidade, para imagens) na vez
+        da história atual e alimenta o limitador adaptativo com a latência ou
+        o erro da chamada.
+        """
+        contexto = contexto_historia.get()
+        chave = contexto["id"] if contexto else "_"
+        nome = f"{tipo}:{quality}" if quality else tipo
+        lane = self.lanes[nome]
+        start = time.time()
+        with span("queue", lane=nome):
+            await lane.acquire(chave)
+        QUEUE_SECONDS.observe(time.time() - start, lane=nome)
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            if classify_error(e) == "rate_limit":
+                lane.on_rate_limit()
+            raise
+        else:
+            lane.on_success(time.time() - start)
+        finally:
+            lane.release()
+
+    def stats(self) -> dict:
+        return {
+            tipo: {
+                "limit": lane.limit,
+                "inFlight": lane.in_flight,
+                "waiting": lane.waiting,
+                "latencyAvg": round(lane.adaptive.latency_avg, 2) if lane.adaptive.latency_avg else None,
+                "latencyP50": round(lane.adaptive.baseline, 2) if lane.adaptive.baseline else None
+            }
+            for tipo, lane in self.lanes.items()
+        }
+
+scheduler = GeminiScheduler()
+
+# --- FILA DE JOBS (SQLite) ---
+
+# Cada história é um job persistido: os workers executam o pipeline e gravam
+# cada evento SSE, e os clientes acompanham (ou reconectam) por GET /api/jobs/{id}/events
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(os.path.dirname(__file__), "jobs.db"))
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", 24))
+JOB_KEEPALIVE = 15.0  # segundos sem eventos até mandar um comentário SSE
+# Job sem ninguém acompanhando por este tempo é cancelado (0 desliga). A folga
+# cobre as reconexões do EventSource; jobs que já mandaram "complete" não entram.
+JOB_ABANDON_SECONDS = float(os.getenv("JOB_ABANDON_SECONDS", 60))
+
+def story_request_key(request: StoryRequest) -> str:
+    """Hash canônico do pedido: fotos (pelo hash), nomes, universo e descrição"""
+    partes = {
+        "characters": [
+            {"name": c.name, "images": [ReferencePhotoCache.key(b64) for b64 in c.images]}
+            for c in request.characters
+        ],
+        "characterIds": request.character_ids,
+        "universe": request.universe.model_dump(),
+        "description": request.description,
+        "useCache": request.use_cache,
+        "progressive": request.progressive
+    }
+    texto = json.dumps(partes, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+class JobQueue:
+    """
+    Fila persistente de histórias com um pool fixo de workers.
+    - Até `workers` histórias rodam ao mesmo tempo; as demais esperam em ordem
+      de chegada (recebendo eventos "queued" com a posição) até `max_queued`.
+    - Pedidos idênticos a um job ainda não concluído reaproveitam o mesmo job.
+    - Jobs interrompidos por um reinício voltam para a fila; o cache de
+      resultados evita refazer o que já tinha sido gerado.
+    - Jobs cancelados (DELETE ou sem ninguém acompanhando) param todas as
+      gerações em andamento e terminam com status 'cancelled'.
+    """
+
+    def __init__(self, path: str, workers: int, max_queued: int):
+        self.path = path
+        self.workers = workers
+        self.max_queued = max_queued
+        self.active = 0
+        self._db = None
+        self._tarefas = []
+        self._trabalho = asyncio.Event()
+        self._novos: dict[str, asyncio.Event] = {}  # job_id -> aviso de novo evento
+        self._posicoes: dict[str, int] = {}          # última posição anunciada por job
+        self._execucoes: dict[str, asyncio.Task] = {}  # job_id -> task do pipeline em execução
+        self._cancelados: dict[str, str] = {}        # job_id -> motivo do cancelamento pedido
+        self._concluidos: set[str] = set()           # jobs em execução que já mandaram "complete"
+        self._ouvintes: dict[str, int] = {}          # job_id -> conexões acompanhando os eventos
+        self._abandono: dict[str, asyncio.TimerHandle] = {}
+
+    def open(self):
+        """Abre o banco, recupera jobs interrompidos e inicia os workers"""
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                request TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+            CREATE TABLE IF NOT EXISTS events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+        """)
+        limite = time.time() - JOB_RETENTION_HOURS * 3600
+        antigos = [r[0] for r in self._db.execute(
+            "SELECT id FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?", (limite,)
+        )]
+        self._db.executemany("DELETE FROM events WHERE job_id = ?", [(i,) for i in antigos])
+        self._db.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in antigos])
+        retomados = [r[0] for r in self._db.execute(
+            "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' RETURNING id", (time.time(),)
+        ).fetchall()]
+        for job_id in retomados:
+            self._reiniciar_eventos(job_id)
+        self._db.commit()
+        if retomados:
+            print(f"♻️ {len(retomados)} job(s) interrompido(s) voltaram para a fila")
+        self._tarefas = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _reiniciar_eventos(self, job_id: str):
+        """
+        Job recomeçando do zero: apaga os eventos da execução interrompida e
+        deixa só um "requeued", com o próximo seq. Quem reconecta com
+        Last-Event-ID recebe o aviso e os eventos novos, sem repetir image_start
+        e image_done da execução anterior.
+        """
+        ultimo = self.last_seq(job_id)
+        self._db.execute("DELETE FROM events WHERE job_id = ?", (job_id,))
+        self._db.execute(
+            "INSERT INTO events (job_id, seq, data) VALUES (?, ?, ?)",
+            (job_id, ultimo + 1, send_event("requeued", {
+                "stage": 1,
+                "title": "♻️ Recomeçando",
+                "message": "O servidor reiniciou: sua história voltou para a fila e vai recomeçar",
+                "progress": 0
+            }))
+        )
+
+    async def close(self):
+        for handle in self._abandono.values():
+            handle.cancel()
+        for tarefa in self._tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*self._tarefas, return_exceptions=True)
+        self._db.close()
+
+    def _contar(self, status: str) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def find(self, chave: str) -> Optional[str]:
+        """Job ainda não concluído com a mesma chave, se houver"""
+        linha = self._db.execute(
+            "SELECT id FROM jobs WHERE key = ? AND status IN ('queued', 'running') LIMIT 1", (chave,)
+        ).fetchone()
+        return linha[0] if linha else None
+
+    def is_full(self) -> bool:
+        return self._contar("queued") >= self.max_queued
+
+    def submit(self, chave: str, request: StoryRequest) -> str:
+        job_id = uuid.uuid4().hex
+        agora = time.time()
+        self._db.execute(
+            "INSERT INTO jobs (id, key, request, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+            (job_id, chave, request.model_dump_json(), agora, agora)
+        )
+        self._db.commit()
+        self._anunciar_posicoes()
+        self._trabalho.set()
+        return job_id
+
+    def status(self, job_id: str) -> Optional[str]:
+        linha = self._db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return linha[0] if linha else None
+
+    def append(self, job_id: str, evento: str):
+        """Grava um evento SSE (já formatado) e acorda quem acompanha o job"""
+        self._db.execute(
+            "INSERT INTO events (job_id, seq, data) VALUES "
+            "(?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM events WHERE job_id = ?), ?)",
+            (job_id, job_id, evento)
+        )
+        self._db.commit()
+        aviso = self._novos.pop(job_id, None)
+        if aviso is not None:
+            aviso.set()
+
+    def _anunciar_posicoes(self):
+        """Envia "queued" aos jobs em espera cuja posição mudou"""
+        fila = [r[0] for r in self._db.execute(
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+        )]
+        # Os primeiros da fila vão direto para os workers livres
+        livres = max(0, self.workers - self.active)
+        for posicao, job_id in enumerate(fila[livres:], 1):
+            if self._posicoes.get(job_id) == posicao:
+                continue
+            self._posicoes[job_id] = posicao
+            self.append(job_id, send_event("queued", {
+                "stage": 1,
+                "title": "⏳ Na fila",
+                "message": f"Muitas histórias sendo criadas agora. Você é o {posicao}º da fila...",
+                "position": posicao,
+                "progress": 0
+            }))
+
+    def _claim(self) -> Optional[tuple[str, str]]:
+        linha = self._db.execute(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ("
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ") RETURNING id, request", (time.time(),)
+        ).fetchone()
+        self._db.commit()
+        return linha
+
+    def _finish(self, job_id: str, status: str):
+        # O pedido (com as fotos em base64) não é mais necessário
+        self._db.execute(
+            "UPDATE jobs SET status = ?, request = NULL, updated_at = ? WHERE id = ?",
+            (status, time.time(), job_id)
+        )
+        self._db.commit()
+        aviso = self._novos.pop(job_id, None)
+        if aviso is not None:
+            aviso.set()
+
+    async def _worker(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                self._trabalho.clear()
+                await self._trabalho.wait()
+                continue
+            job_id, request_json = job
+            self._posicoes.pop(job_id, None)
+            self.active += 1
+            self._anunciar_posicoes()
+            # Task própria por job, para poder cancelar um job sem derrubar o worker
+            execucao = asyncio.create_task(self._executar(job_id, StoryRequest.model_validate_json(request_json)))
+            self._execucoes[job_id] = execucao
+            try:
+                await execucao
+            finally:
+                self._execucoes.pop(job_id, None)
+                self._cancelados.pop(job_id, None)
+                self._concluidos.discard(job_id)
+                self.active -= 1
+
+    async def _executar(self, job_id: str, request: StoryRequest):
+        concluido = False
+        try:
+            async for evento in story_pipeline(request):
+                self.append(job_id, evento)
+                # No modo progressivo, image_upgraded ainda chega depois do "complete"
+                if not concluido and json.loads(evento[len("data: "):])["type"] == "complete":
+                    concluido = True
+                    self._concluidos.add(job_id)
+        except asyncio.CancelledError:
+            if job_id not in self._cancelados:
+                raise  # servidor desligando: o job volta para a fila no próximo início
+            if not concluido:
+                self.append(job_id, self._evento_cancelado(self._cancelados[job_id]))
+            self._finish(job_id, "done" if concluido else "cancelled")
+            return
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.append(job_id, send_event("error", {
+                "stage": -1,
+                "title": "❌ Erro",
+                "message": str(e),
+                "progress": 0
+            }))
+        self._finish(job_id, "done" if concluido else "failed")
+
+    @staticmethod
+    def _evento_cancelado(motivo: str) -> str:
+        return send_event("cancelled", {
+            "stage": -1,
+            "title": "🛑 Cancelada",
+            "message": motivo,
+            "progress": 0
+        })
+
+    def cancel(self, job_id: str, motivo: str) -> Optional[str]:
+        """
+        Cancela um job: na fila, sai dela; em execução, o pipeline é cancelado
+        e leva junto todas as gerações em andamento. Retorna o novo status
+        ("cancelling" enquanto o pipeline para), ou None se o job não existe.
+        """
+        status = self.status(job_id)
+        if status == "queued":
+            self.append(job_id, self._evento_cancelado(motivo))
+            self._finish(job_id, "cancelled")
+            self._posicoes.pop(job_id, None)
+            self._anunciar_posicoes()
+            print(f"🛑 Job {job_id} cancelado na fila: {motivo}")
+        elif status == "running" and job_id in self._execucoes and job_id not in self._cancelados:
+            self._cancelados[job_id] = motivo
+            self._execucoes[job_id].cancel()
+            print(f"🛑 Job {job_id} cancelado: {motivo}")
+        if job_id in self._cancelados:
+            return "cancelling"
+        return self.status(job_id)
+
+    def _conectar(self, job_id: str):
+        self._ouvintes[job_id] = self._ouvintes.get(job_id, 0) + 1
+        handle = self._abandono.pop(job_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _desconectar(self, job_id: str):
+        self._ouvintes[job_id] -= 1
+        if self._ouvintes[job_id] > 0:
+            return
+        del self._ouvintes[job_id]
+        if (JOB_ABANDON_SECONDS > 0 and job_id not in self._concluidos
+                and self.status(job_id) in ("queued", "running")):
+            self._abandono[job_id] = asyncio.get_running_loop().call_later(
+                JOB_ABANDON_SECONDS, self._abandonar, job_id
+            )
+
+    def _abandonar(self, job_id: str):
+        self._abandono.pop(job_id, None)
+        if job_id not in self._ouvintes and job_id not in self._concluidos:
+            self.cancel(job_id, f"Ninguém acompanhou a história por {JOB_ABANDON_SECONDS:.0f}s")
+
+    async def events(self, job_id: str, after: int):
+        """Eventos do job a partir de `after` (replay) e depois ao vivo, no formato SSE com id"""
+        self._conectar(job_id)
+        try:
+            while True:
+                aviso = self._novos.setdefault(job_id, asyncio.Event())
+                linhas = self._db.execute(
+                    "SELECT seq, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                    (job_id, after)
+                ).fetchall()
+                for seq, data in linhas:
+                    yield f"id: {seq}\n{data}"
+                    after = seq
+                if linhas:
+                    continue
+                if self.status(job_id) not in ("queued", "running"):
+                    return
+                try:
+                    await asyncio.wait_for(aviso.wait(), timeout=JOB_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            # Cliente desconectou (ou o job terminou)
+            self._desconectar(job_id)
+
+    def last_seq(self, job_id: str) -> int:
+        return self._db.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM events WHERE job_id = ?", (job_id,)
+        ).fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"active": self.active, "queued": self._contar("queued"),
+                "workers": self.workers, "maxQueued": self.max_queued}
+
+jobs = JobQueue(JOBS_DB, MAX_ACTIVE_STORIES, MAX_QUEUED_STORIES)
+metrics.gauge("storymaker_stories_active", "Histórias em execução agora", lambda: jobs.active)
+metrics.gauge("storymaker_stories_queued", "Histórias aguardando um worker", lambda: jobs.stats()["queued"])
+
+class IncrementalJSONParser:
+    """
+    Parser de JSON em pedaços (streaming): chama on_string(caminho, valor)
+    assim que cada valor string termina de chegar, ex. ("cover_prompt",) ou
+    ("parts", 2, 1), sem esperar o documento inteiro.
+    """
+
+    def __init__(self, on_string):
+        self.on_string = on_string
+        self._pilha = []  # [tipo ("obj"/"arr"), chave ou índice atual, esperando chave?]
+        self._em_string = False
+        self._escape = False
+        self._eh_chave = False
+        self._buffer = []
+
+    def feed(self, texto: str):
+        for c in texto:
+            if self._em_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._fechar_string()
+                    continue
+                self._buffer.append(c)
+            elif c == '"':
+                self._em_string = True
+                self._eh_chave = bool(self._pilha) and self._pilha[-1][0] == "obj" and self._pilha[-1][2]
+                self._buffer = []
+            elif c == "{":
+                self._pilha.append(["obj", None, True])
+            elif c == "[":
+                self._pilha.append(["arr", 0, False])
+            elif c in "}]":
+                if self._pilha:
+                    self._pilha.pop()
+            elif c == ":":
+                if self._pilha:
+                    self._pilha[-1][2] = False
+            elif c == ",":
+                if self._pilha and self._pilha[-1][0] == "obj":
+                    self._pilha[-1][1] = None
+                    self._pilha[-1][2] = True
+                elif self._pilha:
+                    self._pilha[-1][1] += 1
+
+    def _fechar_string(self):
+        self._em_string = False
+        valor = json.loads('"' + "".join(self._buffer) + '"', strict=False)
+        if self._eh_chave:
+            self._pilha[-1][1] = valor
+        else:
+            self.on_string(tuple(frame[1] for frame in self._pilha), valor)
+
+def montar_prompt_historia(characters: List[Character], universe: Universe, description: str) -> str:
+    """Monta o prompt de geração da estrutura da história"""
     nomes = ", ".join([c.name for c in characters])
     
-    prompt_historia = f"""
+    return f"""
     Crie uma história épica e imersiva dividida em EXATAMENTE 5 PARTES.
     PROTAGONISTAS: {nomes}
     TEMA/DESCRIÇÃO: {description}
@@ -144,104 +1977,606 @@ async def _gerar_json_historia_interno(characters: List[Character], universe: Un
     SAÍDA: Um título, um prompt para a capa (formato wide 16:9) e uma lista de 5 listas [texto_historia, prompt_imagem].
     Os protagonistas devem ser {nomes}.
     """
+
+async def _gerar_json_historia_interno(prompt_historia: str, on_field=None):
+    """
+    Função interna que gera a estrutura da história em streaming.
+    on_field(caminho, valor) é chamado a cada campo string concluído,
+    antes de a resposta completa chegar.
+    """
+    texto = []
+    parser = IncrementalJSONParser(on_field) if on_field else None
+    async with scheduler.slot("text"):
+        # O limite vale para o streaming inteiro, não só para o primeiro pedaço
+        async with call_timeout(TEXT_CALL_TIMEOUT, "geração de história"):
+            with span("model", model=TEXT_MODEL):
+                stream = await client.aio.models.generate_content_stream(
+                    model=TEXT_MODEL,
+                    contents=prompt_historia,
+                    config={
+                        "response_mime_type": "application/json",
+                        "response_json_schema": STORY_SCHEMA,
+                    },
+                )
+                async for chunk in stream:
+                    check_safety_block(chunk, "História")
+                    if chunk.text:
+                        texto.append(chunk.text)
+                        if parser:
+                            parser.feed(chunk.text)
     
-    response = await client.aio.models.generate_content(
-        model="gemini-3-flash-preview",
-        contents=prompt_historia,
-        config={
-            "response_mime_type": "application/json",
-            "response_json_schema": Story.model_json_schema(),
-        },
-    )
-    
-    if not response or not response.text:
+    if not texto:
         raise ValueError("Resposta vazia da API")
     
-    return Story.model_validate_json(response.text)
+    return Story.model_validate_json("".join(texto))
 
-async def gerar_json_historia(characters: List[Character], universe: Universe, description: str):
-    """Gera a estrutura da história usando Gemini com retry."""
-    return await retry_with_backoff(
+async def gerar_json_historia(
+    characters: List[Character],
+    universe: Universe,
+    description: str,
+    on_field=None
+):
+    """Gera a estrutura da história usando Gemini com retry (ou do cache de resultados)."""
+    prompt_historia = montar_prompt_historia(characters, universe, description)
+    chave = ResultCache.key(model=TEXT_MODEL, prompt=prompt_historia)
+    
+    start = time.time()
+    if cache_enabled() and (cached := await result_cache.get(chave)):
+        print("💾 História encontrada no cache de resultados")
+        texto = cached[0].decode("utf-8")
+        if on_field:
+            IncrementalJSONParser(on_field).feed(texto)
+        story = Story.model_validate_json(texto)
+        TEXT_SECONDS.observe(time.time() - start, model=TEXT_MODEL, cached="true")
+        return story
+    
+    story = await retry_with_backoff(
         _gerar_json_historia_interno,
-        characters, universe, description,
+        prompt_historia, on_field,
         operation_name="geração de história"
     )
+    TEXT_SECONDS.observe(time.time() - start, model=TEXT_MODEL, cached="false")
+    await result_cache.put(chave, story.model_dump_json().encode("utf-8"), "application/json")
+    return story
+
+def _encode_web(dados: bytes, mime_type: str, pasta: str, id_imagem: str,
+                max_lado: int, qualidade: int, lado_previa: int) -> dict:
+    """
+    PNG em resolução total, versão web única ({id}.webp) e prévia a partir de
+    uma só decodificação da imagem. Executa no pool de processos.
+    Retorna {"webp", "preview", "steps"}, com (nome, início, fim) de cada etapa
+    em segundos desde o começo da tarefa, para o trace.
+    """
+    t0 = time.perf_counter()
+    etapas = []
+    
+    def etapa(nome, inicio):
+        etapas.append((nome, inicio - t0, time.perf_counter() - t0))
+    
+    inicio = time.perf_counter()
+    with Image.open(BytesIO(dados)) as img:
+        img.load()
+        etapa("decode", inicio)
+        
+        inicio = time.perf_counter()
+        caminho_png = os.path.join(pasta, f"{id_imagem}.png")
+        if mime_type == "image/png":
+            # Já veio em PNG: grava os bytes direto, sem codificar de novo
+            with open(caminho_png, "wb") as f:
+                f.write(dados)
+        else:
+            img.save(caminho_png, "PNG")
+        etapa("write_png", inicio)
+        
+        inicio = time.perf_counter()
+        caminho_webp = os.path.join(pasta, f"{id_imagem}.webp")
+        web = img.copy()
+        web.thumbnail((max_lado, max_lado), Image.Resampling.LANCZOS)
+        web.save(caminho_webp, "WEBP", quality=qualidade)
+        webp = {"file": os.path.basename(caminho_webp), "width": web.width, "height": web.height,
+                "format": "webp", "bytes": os.path.getsize(caminho_webp)}
+        etapa("write_webp", inicio)
+        
+        inicio = time.perf_counter()
+        preview = _build_preview(web, img.size, lado_previa)
+        etapa("preview", inicio)
+    return {"webp": webp, "preview": preview, "steps": etapas}
+
+def _build_derivatives(dados: bytes, pasta: str, id_imagem: str, widths, formats, qualities) -> List[dict]:
+    """
+    Gera as versões responsivas ({id}-{largura}.{formato}) para srcset.
+    Mesmo esquema de historia.py. Executa no pool de processos.
+    """
+    variantes = []
+    with Image.open(BytesIO(dados)) as img:
+        img.load()
+        # Nunca amplia: larguras maiores que a original viram a própria original
+        for largura in sorted({min(w, img.width) for w in widths}):
+            altura = round(img.height * largura / img.width)
+            reduzida = img if largura == img.width else img.resize((largura, altura), Image.Resampling.LANCZOS)
+            for formato in formats:
+                nome = f"{id_imagem}-{largura}.{formato}"
+                caminho = os.path.join(pasta, nome)
+                reduzida.save(caminho, formato.upper(), quality=qualities[formato])
+                variantes.append({"file": nome, "width": largura, "height": altura,
+                                  "format": formato, "bytes": os.path.getsize(caminho)})
+    return variantes
+
+def _build_preview(img: Image.Image, tamanho: tuple[int, int], lado: int) -> dict:
+    """
+    Prévia leve da imagem: miniatura WebP em base64, cor dominante e
+    dimensões finais (`tamanho`, da imagem original). Parte de uma imagem já
+    decodificada, normalmente a versão web, que é menor.
+    """
+    largura, altura = tamanho
+    miniatura = img.convert("RGB")
+    miniatura.thumbnail((lado, lado), Image.Resampling.BILINEAR)
+    buffer = BytesIO()
+    miniatura.save(buffer, "WEBP", quality=40)
+    
+    # Cor dominante: a mais frequente entre 8 cores da miniatura
+    paleta = miniatura.quantize(colors=8)
+    _, indice = max(paleta.getcolors())
+    r, g, b = paleta.getpalette()[indice * 3:indice * 3 + 3]
+    return {
+        "placeholder": "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode("ascii"),
+        "color": f"#{r:02x}{g:02x}{b:02x}",
+        "width": largura,
+        "height": altura
+    }
+
+def derivative_urls(folder: str, variantes: List[dict]) -> List[dict]:
+    """Variantes com a URL pública, no formato de story["derivatives"]"""
+    return [
+        {"url": f"/historias/{folder}/{v['file']}", **{k: v[k] for k in ("width", "height", "format")}}
+        for v in variantes
+    ]
+
+class DerivativeBuilder:
+    """
+    Gera os derivados responsivos (larguras x formatos) em segundo plano,
+    depois do image_done. Quando ficam prontos, entram no story.json da
+    pasta, se ele já existir; senão, na próxima gravação (save_story_json).
+    """
+
+    def __init__(self, max_pending: int = 512):
+        self.max_pending = max_pending
+        self._prontos = OrderedDict()  # (pasta, arquivo) -> variantes
+        self._tarefas = set()
+
+    def schedule(self, dados: bytes, pasta: str, arquivo: str):
+        tarefa = asyncio.create_task(self._gerar(dados, pasta, arquivo))
+        self._tarefas.add(tarefa)
+        tarefa.add_done_callback(self._tarefas.discard)
+
+    async def _gerar(self, dados: bytes, pasta: str, arquivo: str):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            por_largura = await asyncio.gather(*(
+                loop.run_in_executor(
+                    derivative_pool, _build_derivatives,
+                    dados, pasta, arquivo, (largura,), DERIVATIVE_FORMATS, DERIVATIVE_QUALITY
+                )
+                for largura in DERIVATIVE_WIDTHS
+            ))
+        except Exception as e:
+            # Fica a versão web única
+            print(f"⚠️ Derivados de {arquivo} falharam: {e}")
+            return
+        # Imagens menores que alguma largura geram a mesma variante mais de uma vez
+        variantes = {(v["width"], v["format"]): v for lista in por_largura for v in lista}
+        self._prontos[(pasta, arquivo)] = sorted(variantes.values(), key=lambda v: (v["format"], v["width"]))
+        while len(self._prontos) > self.max_pending:
+            self._prontos.popitem(last=False)
+        DERIVATIVE_SECONDS.observe(time.time() - start)
+        
+        story = catalog.get_folder(os.path.basename(pasta))
+        if story is not None and self.apply(pasta, story):
+            catalog.add(story["folder"], story)
+            await save_story_json(pasta, story)
+
+    def apply(self, pasta: str, story: dict) -> bool:
+        """Troca a versão web única pelos derivados prontos. Retorna True se mudou algo."""
+        mudou = False
+        for id_img, url in story.get("images", {}).items():
+            variantes = self._prontos.get((pasta, os.path.splitext(os.path.basename(url))[0]))
+            if variantes is None:
+                continue
+            derivatives = derivative_urls(os.path.basename(pasta), variantes)
+            if story.setdefault("derivatives", {}).get(id_img) != derivatives:
+                story["derivatives"][id_img] = derivatives
+                mudou = True
+        return mudou
+
+derivative_builder = DerivativeBuilder()
+
+async def codificar_imagem(dados: bytes, mime_type: str, id_imagem: str, pasta_destino: str) -> dict:
+    """
+    Grava o PNG, a versão web única ({id}.webp) e a prévia numa só tarefa do
+    pool de processos (a imagem é decodificada uma vez), sem bloquear o event
+    loop. Os derivados responsivos ficam com o DerivativeBuilder, em segundo plano.
+    Retorna {"encodeTime", "derivatives", "preview"}.
+    """
+    loop = asyncio.get_running_loop()
+    start = time.time()
+    with span("encode", image=id_imagem):
+        codificada = await loop.run_in_executor(
+            encode_pool, _encode_web,
+            dados, mime_type, pasta_destino, id_imagem, WEBP_MAX_SIDE, WEBP_QUALITY, PLACEHOLDER_SIDE
+        )
+        record_steps(codificada["steps"])
+    encode_time = time.time() - start
+    ENCODE_SECONDS.observe(encode_time)
+    derivative_builder.schedule(dados, pasta_destino, id_imagem)
+    return {
+        "encodeTime": encode_time,
+        "derivatives": [codificada["webp"]],
+        "preview": codificada["preview"]
+    }
+
+# --- HEDGING DE IMAGENS ---
+
+# Requisição duplicada quando a imagem passa do percentil de latência recente
+IMAGE_HEDGING = os.getenv("IMAGE_HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.9))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", 0.1))  # máx. 10% das chamadas duplicadas
+HEDGE_MIN_SAMPLES = 10  # amostras de latência antes de começar a duplicar
+
+class HedgePolicy:
+    """Latências recentes das chamadas de imagem e limite da taxa de duplicação"""
+
+    def __init__(self, window: int = 200):
+        self._latencias = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+
+    def record(self, latency: float):
+        self._latencias.append(latency)
+
+    def threshold(self) -> Optional[float]:
+        """Latência a partir da qual vale duplicar (None se ainda sem amostras)"""
+        if len(self._latencias) < HEDGE_MIN_SAMPLES:
+            return None
+        amostras = sorted(self._latencias)
+        return amostras[min(len(amostras) - 1, int(len(amostras) * HEDGE_PERCENTILE))]
+
+    def allow(self) -> bool:
+        return self.hedged < HEDGE_MAX_RATE * self.requests
+
+    def expected_remaining(self, elapsed: float) -> float:
+        """Quanto a chamada original ainda levaria, dado que já passou de `elapsed`"""
+        maiores = [l for l in self._latencias if l > elapsed]
+        return sum(maiores) / len(maiores) - elapsed if maiores else 0.0
+
+# Uma política por qualidade: rascunhos e finais em 2K têm latências bem diferentes
+hedge_policies = {quality: HedgePolicy() for quality in IMAGE_QUALITIES}
+
+async def call_with_hedge(call_factory, operation_name: str, hedge_policy: HedgePolicy):
+    """
+    Executa call_factory(despachada), que chama despachada() quando a requisição
+    sai da fila do scheduler e retorna (resultado, latência do modelo). Se a
+    chamada passar do percentil configurado depois de despachada e a taxa de
+    duplicação permitir, dispara uma cópia e fica com a que terminar primeiro.
+    Retorna o (resultado, latência) vencedor.
+    """
+    hedge_policy.requests += 1
+    limiar = hedge_policy.threshold() if IMAGE_HEDGING else None
+    if limiar is None:
+        resultado, latencia = await call_factory(lambda: None)
+        hedge_policy.record(latencia)
+        return resultado, latencia
+    
+    contexto = contexto_historia.get()
+    despachos = {}  # task -> instante em que saiu da fila do scheduler
+    
+    def disparar():
+        saiu_da_fila = asyncio.Event()
+        task = None
+        def despachada():
+            despachos[task] = time.time()
+            saiu_da_fila.set()
+        task = asyncio.create_task(call_factory(despachada))
+        return task, saiu_da_fila
+    
+    original, saiu_da_fila = disparar()
+    pendentes = {original}
+    try:
+        # O relógio do hedge só começa quando a original sai da fila: espera na fila não é lentidão do modelo
+        espera = asyncio.create_task(saiu_da_fila.wait())
+        await asyncio.wait({original, espera}, return_when=asyncio.FIRST_COMPLETED)
+        espera.cancel()
+        done, _ = await asyncio.wait(pendentes, timeout=limiar)
+        if not done and hedge_policy.allow():
+            hedge_policy.hedged += 1
+            if contexto is not None:
+                contexto["hedges"]["sent"] += 1
+            print(f"🔀 {operation_name} passou de {limiar:.1f}s: enviando requisição duplicada")
+            pendentes.add(disparar()[0])
+        
+        erro = None
+        while pendentes:
+            done, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    erro = erro or task.exception()
+                    continue
+                resultado, latencia = task.result()
+                hedge_policy.record(latencia)
+                # A perdedora já despachada entra como "pelo menos isto": sem ela o percentil só cairia
+                agora = time.time()
+                for perdedora in pendentes:
+                    if perdedora in despachos:
+                        hedge_policy.record(agora - despachos[perdedora])
+                if task is not original:
+                    # A cópia venceu: estima quanto a original ainda levaria
+                    economia = hedge_policy.expected_remaining(agora - despachos[original])
+                    if contexto is not None:
+                        contexto["hedges"]["won"] += 1
+                        contexto["hedges"]["savedTime"] += economia
+                    print(f"🔀 Requisição duplicada venceu em {operation_name} (~{economia:.1f}s economizados)")
+                return resultado, latencia
+        raise erro
+    finally:
+        for task in pendentes:
+            task.cancel()
 
 async def _gerar_imagem_interno(
     id_imagem: str, 
     prompt: str, 
-    fotos_personagens: List[Image.Image], 
+    fotos_personagens: List[types.Part], 
     nomes: str, 
     universo: str,
     pasta_destino: str,
-    ratio: str = "2:3"
-) -> str:
-    """Função interna que gera uma imagem. Levanta exceção se falhar."""
+    ratio: str = "2:3",
+    quality: str = "standard",
+    arquivo: Optional[str] = None
+) -> dict:
+    """
+    Função interna que gera uma imagem. Levanta exceção se falhar.
+    `quality` escolhe modelo e tamanho (IMAGE_QUALITIES); `arquivo` é o nome
+    base do PNG e dos derivados (padrão: o id da imagem).
+    Retorna {"filename", "modelTime", "encodeTime", "derivatives", "preview", "cached"}.
+    """
     instrucao = f"\n\nIMPORTANTE: Os personagens principais desta imagem devem ser exatamente as mesmas pessoas que aparecem nas fotos anexadas ({nomes}). Mantenha as características faciais. Universo: {universo}."
     prompt_final = prompt + instrucao
+    modelo, tamanho = IMAGE_QUALITIES[quality]
+    arquivo = arquivo or id_imagem
+    filename = f"{arquivo}.png"
     
-    response = await client.aio.models.generate_content(
-        model="gemini-3-pro-image-preview",
-        contents=[prompt_final] + fotos_personagens,
-        config=types.GenerateContentConfig(
-            response_modalities=['IMAGE'],
-            image_config=types.ImageConfig(aspect_ratio=ratio),
-        )
+    chave = ResultCache.key(
+        model=modelo,
+        prompt=prompt_final,
+        photos=[hashlib.sha256(foto.inline_data.data).hexdigest() for foto in fotos_personagens],
+        ratio=ratio,
+        size=tamanho
     )
+    if cache_enabled() and (cached := await result_cache.get(chave)):
+        codificada = await codificar_imagem(cached[0], cached[1], arquivo, pasta_destino)
+        print(f"💾 Imagem {id_imagem} reaproveitada do cache de resultados (codificação {codificada['encodeTime']:.1f}s)")
+        return {"filename": filename, "modelTime": 0.0, **codificada, "cached": True}
+    
+    async def chamar_modelo(despachada):
+        """Retorna (resposta, tempo do modelo): o tempo começa depois da espera na fila"""
+        async with scheduler.slot("image", quality):
+            despachada()
+            model_start = time.time()
+            async with call_timeout(IMAGE_CALL_TIMEOUT, f"imagem {id_imagem}"):
+                with span("model", model=modelo):
+                    response = await client.aio.models.generate_content(
+                        model=modelo,
+                        contents=[prompt_final] + fotos_personagens,
+                        config=types.GenerateContentConfig(
+                            response_modalities=['IMAGE'],
+                            image_config=types.ImageConfig(aspect_ratio=ratio, image_size=tamanho),
+                        )
+                    )
+            return response, time.time() - model_start
+    
+    # Só a chamada ao modelo é duplicada; a gravação acontece uma única vez
+    response, model_time = await call_with_hedge(chamar_modelo, f"imagem {id_imagem}", hedge_policies[quality])
+    IMAGE_SECONDS.observe(model_time, model=modelo)
 
-    for part in response.parts:
+    for part in response.parts or []:
         if image := part.as_image():
-            # Salvar imagem em disco
-            filename = f"{id_imagem}.png"
-            filepath = os.path.join(pasta_destino, filename)
-            image.save(filepath)
-            
-            # Também criar versão WebP otimizada
-            webp_filename = f"{id_imagem}.webp"
-            webp_filepath = os.path.join(pasta_destino, webp_filename)
-            
-            # Otimizar para web
-            with Image.open(filepath) as img:
-                img.thumbnail((1200, 1200), Image.Resampling.LANCZOS)
-                img.save(webp_filepath, "WEBP", quality=85, optimize=True)
-            
-            print(f"✅ Imagem salva: {filepath}")
-            return filename
+            mime_type = image.mime_type or "image/png"
+            # Salvar PNG + derivados responsivos fora do event loop (e no cache de resultados)
+            codificada, _ = await asyncio.gather(
+                codificar_imagem(image.image_bytes, mime_type, arquivo, pasta_destino),
+                result_cache.put(chave, image.image_bytes, mime_type)
+            )
+            
+            print(f"✅ Imagem salva: {os.path.join(pasta_destino, filename)} (modelo {model_time:.1f}s, codificação {codificada['encodeTime']:.1f}s)")
+            return {
+                "filename": filename,
+                "modelTime": model_time,
+                **codificada,
+                "cached": False
+            }
     
+    check_safety_block(response, f"Imagem {id_imagem}")
     raise ValueError(f"A resposta não continha uma imagem válida para {id_imagem}.")
 
 async def gerar_imagem_async(
     id_imagem: str, 
     prompt: str, 
-    fotos_personagens: List[Image.Image], 
+    fotos_personagens: List[types.Part], 
     nomes: str, 
     universo: str,
     pasta_destino: str,
-    ratio: str = "2:3"
-) -> Optional[str]:
+    ratio: str = "2:3",
+    quality: str = "standard",
+    arquivo: Optional[str] = None
+) -> Optional[dict]:
     """Gera uma imagem com retry e backoff. Retorna None se falhar após todas as tentativas."""
     try:
         return await retry_with_backoff(
             _gerar_imagem_interno,
-            id_imagem, prompt, fotos_personagens, nomes, universo, pasta_destino, ratio,
+            id_imagem, prompt, fotos_personagens, nomes, universo, pasta_destino, ratio, quality, arquivo,
             operation_name=f"imagem {id_imagem}"
         )
     except Exception as e:
-        print(f"❌ Falha definitiva na imagem {id_imagem} após {MAX_RETRIES} tentativas: {e}")
+        print(f"❌ Falha definitiva na imagem {id_imagem} [{classify_error(e)}]: {e}")
         return None
 
+# --- REGENERAÇÃO DE IMAGENS ---
+
+# Refaz uma única imagem de uma história já salva: o prompt vem do story.json e
+# as fotos de referência do disco (personagens registrados, inclusive os
+# enviados em base64). Uma chamada ao modelo em vez das sete de uma história nova.
+regenerating: set[tuple[str, str]] = set()  # (story_id, id_img) sendo refeitas agora
+running_stories: set[str] = set()  # histórias com o pipeline rodando neste processo
+
+def pending_upgrades(story: dict) -> List[str]:
+    """
+    Versões finais ainda a caminho. Um `upgrading` deixado por um job que já
+    morreu (reinício, erro) não conta: ninguém mais vai gerar essas imagens.
+    """
+    return (story.get("upgrading") or []) if story.get("id") in running_stories else []
+
+def client_story(story: dict) -> dict:
+    """
+    História como vai para o cliente no evento complete e na regeneração: sem
+    o trace (só para o story.json e o relatorio_tempos.py), que o front
+    guardaria inteiro no localStorage.
+    """
+    return {campo: valor for campo, valor in story.items() if campo != "trace"}
+
+def next_image_version(pasta: str, id_imagem: str) -> str:
+    """Próximo nome livre ({id}_v2, {id}_v3...): as imagens são servidas como imutáveis"""
+    versoes = [1]
+    for caminho in glob.glob(os.path.join(glob.escape(pasta), f"{glob.escape(id_imagem)}_v*.png")):
+        sufixo = os.path.basename(caminho)[len(id_imagem) + 2:-len(".png")]
+        if sufixo.isdigit():
+            versoes.append(int(sufixo))
+    return f"{id_imagem}_v{max(versoes) + 1}"
+
+async def load_story_photos(story: dict) -> List[types.Part]:
+    """Fotos de referência da história, na ordem usada na criação"""
+    arquivos = {}  # hash -> caminho das fotos dos personagens registrados
+    for personagem in story.get("characters", []):
+        registrado = character_store.get(personagem.get("id") or "")
+        if registrado is not None:
+            arquivos.update(character_store.photo_paths(registrado))
+    
+    fotos = []
+    for chave in story.get("referencePhotos") or list(arquivos):
+        if chave in arquivos:
+            fotos.append((await photo_cache.get_file(chave, arquivos[chave]))[1])
+        else:
+            fotos = []
+            break
+    if not fotos:
+        raise HTTPException(
+            status_code=409,
+            detail="As fotos de referência desta história não estão mais disponíveis. "
+                   "Registre os personagens por POST /api/characters e crie a história de novo."
+        )
+    return fotos
+
+async def regenerate_image(story_id: str, id_img: str) -> dict:
+    """
+    Gera de novo uma imagem (com outro nome de arquivo), troca no story.json e
+    no catálogo e devolve a imagem nova junto com a história atualizada.
+    """
+    story = catalog.get(story_id)
+    if story is None:
+        catalog.refresh()
+        story = catalog.get(story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+    
+    if id_img == "capa":
+        prompt = story.get("cover_prompt")
+    else:
+        numero = int(id_img.split("_")[1])
+        partes = story.get("parts") or []
+        if not 1 <= numero <= len(partes):
+            raise HTTPException(status_code=404, detail="Capítulo não encontrado")
+        prompt = partes[numero - 1][1]
+    if not prompt:
+        raise HTTPException(status_code=409, detail=f"A história não tem o prompt de {id_img} salvo")
+    if pending_upgrades(story):
+        # O pipeline ainda regrava o story.json a cada versão final
+        raise HTTPException(status_code=409, detail="As versões finais desta história ainda estão sendo geradas")
+    if (story_id, id_img) in regenerating:
+        raise HTTPException(status_code=409, detail=f"{id_img} já está sendo refeita")
+    
+    pasta = os.path.join(STORIES_DIR, story["folder"])
+    # Histórias do modo progressivo usam a qualidade final; as demais, a padrão
+    quality = "final" if set(story.get("imageQuality", {}).values()) & {"draft", "final"} else "standard"
+    nomes = ", ".join(c["name"] for c in story.get("characters", []))
+    ratio = "16:9" if id_img == "capa" else "2:3"
+    
+    regenerating.add((story_id, id_img))
+    # Sem o cache de resultados: o mesmo prompt devolveria a mesma imagem
+    token = contexto_historia.set(new_story_context(use_cache=False))
+    try:
+        fotos = await load_story_photos(story)
+        arquivo = next_image_version(pasta, id_img)
+        start = time.time()
+        try:
+            with span("image", image=id_img, quality=quality):
+                resultado = await retry_with_backoff(
+                    _gerar_imagem_interno,
+                    id_img, prompt, fotos, nomes, story["universe"]["style"], pasta, ratio, quality, arquivo,
+                    operation_name=f"imagem {id_img}"
+                )
+        except Exception as e:
+            IMAGE_REGENERATIONS.inc(status="error")
+            print(f"❌ Falha ao refazer {id_img} de {story_id} [{classify_error(e)}]: {e}")
+            raise HTTPException(status_code=502, detail=f"Falha ao refazer {id_img}: {e}")
+        IMAGE_REGENERATIONS.inc(status="ok")
+    finally:
+        contexto_historia.reset(token)
+        regenerating.discard((story_id, id_img))
+    
+    # Relê a versão mais recente (outra imagem pode ter sido refeita enquanto
+    # esta era gerada) e registra no catálogo sem pausas no meio, antes de
+    # gravar: uma regravação concorrente já parte desta versão
+    atual = copy.deepcopy(catalog.get(story_id) or story)
+    url = f"/historias/{atual['folder']}/{resultado['filename']}"
+    derivatives = derivative_urls(atual["folder"], resultado["derivatives"])
+    atual.setdefault("images", {})[id_img] = url
+    atual.setdefault("derivatives", {})[id_img] = derivatives
+    atual.setdefault("previews", {})[id_img] = resultado["preview"]
+    atual.setdefault("imageQuality", {})[id_img] = quality
+    atual["upgrading"] = pending_upgrades(atual)
+    atual["missingImages"] = [i for i in atual.get("missingImages", []) if i != id_img]
+    catalog.add(atual["folder"], atual)
+    await save_story_json(pasta, atual)
+    print(f"🔄 {id_img} refeita em {time.time() - start:.1f}s: {url}")
+    
+    return {
+        "storyId": story_id,
+        "imageId": id_img,
+        "imageUrl": url,
+        "derivatives": derivatives,
+        **resultado["preview"],
+        "quality": quality,
+        "elapsed": round(time.time() - start, 1),
+        "modelElapsed": round(resultado["modelTime"], 1),
+        "encodeElapsed": round(resultado["encodeTime"], 2),
+        "story": client_story(atual)
+    }
+
 # --- ENDPOINTS ---
 
-@app.post("/api/create-story")
-async def create_story(request: StoryRequest):
+def story_pipeline(request: StoryRequest):
     """
     Cria uma história completa com imagens.
-    Retorna eventos SSE em tempo real para o frontend acompanhar o progresso.
+    Gera os eventos SSE (já formatados) que o worker da fila grava para o job.
     """
     async def event_generator():
         start_time = time.time()
         pasta_historia = None
+        story_id = None
         folder_name = None
+        contexto = new_story_context(request.use_cache)
+        contexto_historia.set(contexto)
+        tarefas = {}            # id_img -> (prompt, task)
+        upgrades = {}           # id_img -> (prompt, task) da versão final (modo progressivo)
+        historia_task = None
         
         try:
             # ========== ETAPA 1: INICIALIZAÇÃO ==========
@@ -254,14 +2589,24 @@ async def create_story(request: StoryRequest):
             await asyncio.sleep(0.5)
             
             # Preparar dados dos personagens
-            nomes = ", ".join([c.name for c in request.characters])
-            description = request.description or f"Uma aventura épica com {nomes}"
+            registrados = [character_store.get(cid) for cid in request.character_ids]
+            if None in registrados:
+                raise ValueError("Personagem não encontrado: envie as fotos de novo por POST /api/characters")
             
-            # Coletar todas as fotos dos personagens
-            todas_fotos = []
-            for char in request.characters:
-                fotos = decode_base64_images(char.images)
-                todas_fotos.extend(fotos)
+            # Coletar todas as fotos dos personagens (normalizadas uma única vez).
+            # Os enviados em base64 viram personagens registrados, com as fotos
+            # em disco: refazer uma imagem depois não depende do cache em memória
+            with span("photos"):
+                registrados = list(await asyncio.gather(*(
+                    character_store.register_base64(char.name, char.images) for char in request.characters
+                ))) + registrados
+                fotos_registradas = [foto for r in registrados for foto in character_store.photo_paths(r)]
+                todas_fotos = await photo_cache.get_files(fotos_registradas)
+            # Os hashes vão para o story.json, para refazer uma imagem depois
+            chaves_fotos = [chave for chave, _ in fotos_registradas]
+            personagens = [Character(id=r["id"], name=r["name"], images=[]) for r in registrados]
+            nomes = ", ".join([c.name for c in personagens])
+            description = request.description or f"Uma aventura épica com {nomes}"
             
             yield send_event("stage", {
                 "stage": 1,
@@ -270,7 +2615,7 @@ async def create_story(request: StoryRequest):
                 "progress": 10
             })
             
-            # ========== ETAPA 2: GERANDO HISTÓRIA ==========
+            # ========== ETAPA 2: GERANDO HISTÓRIA (STREAMING) ==========
             yield send_event("stage", {
                 "stage": 2,
                 "title": "📜 Escrevendo a História",
@@ -278,110 +2623,253 @@ async def create_story(request: StoryRequest):
                 "progress": 15
             })
             
-            stage2_start = time.time()
-            
-            story_data = await gerar_json_historia(
-                request.characters, 
-                request.universe, 
-                description
-            )
-            
-            stage2_time = time.time() - stage2_start
-            
-            # Criar pasta para esta história
-            pasta_historia, story_id, folder_name = create_story_folder(story_data.title)
-            
-            yield send_event("story_created", {
-                "stage": 2,
-                "title": "📜 História Criada!",
-                "message": f"Título: {story_data.title}",
-                "progress": 25,
-                "elapsed": round(stage2_time, 1),
-                "data": {
-                    "title": story_data.title,
-                    "parts": story_data.parts,
-                    "storyId": story_id,
-                    "folder": folder_name
-                }
-            })
-            
             # ========== ETAPA 3: GERANDO IMAGENS EM PARALELO ==========
+            # As imagens começam assim que cada prompt chega no streaming do texto
             total_images = 6  # 1 capa + 5 partes
             generated_images = {}
+            generated_derivatives = {}  # id_img -> variantes responsivas (srcset)
+            generated_previews = {}     # id_img -> miniatura, cor dominante e dimensões
+            image_quality = {}          # id_img -> "standard", "draft" ou "final"
             
-            yield send_event("stage", {
-                "stage": 3,
-                "title": "🎨 Gerando Imagens",
-                "message": f"Criando {total_images} ilustrações em paralelo...",
-                "progress": 30
-            })
+            # Fila única de eventos: história pronta, imagens iniciadas e concluídas
+            eventos = asyncio.Queue()
+            resultados = {}         # id_img -> resultado da task atual
+            prompts_sem_pasta = {}  # prompts que chegaram antes do título
+            img_start = None
+            quality_inicial = "draft" if request.progressive else "standard"
             
-            # Enviar eventos de início para TODAS as imagens
-            yield send_event("image_start", {
-                "stage": 3,
-                "imageId": "capa",
-                "message": "Iniciando geração da capa...",
-                "currentImage": 1,
-                "totalImages": total_images
-            })
+            async def proximo_evento():
+                """Próximo evento da fila, ou None quando o prazo da história acaba"""
+                if not eventos.empty():
+                    return eventos.get_nowait()
+                try:
+                    return await asyncio.wait_for(eventos.get(), timeout=time_left())
+                except asyncio.TimeoutError:
+                    return None
             
-            for i in range(1, 6):
-                yield send_event("image_start", {
-                    "stage": 3,
-                    "imageId": f"parte_{i}",
-                    "message": f"Iniciando capítulo {i}...",
-                    "currentImage": i + 1,
-                    "totalImages": total_images
-                })
+            def numero_imagem(id_img):
+                return 1 if id_img == "capa" else int(id_img.split("_")[1]) + 1
             
-            # Usar Queue para receber resultados em tempo real
-            result_queue = asyncio.Queue()
-            img_start = time.time()
+            def ratio_imagem(id_img):
+                return "16:9" if id_img == "capa" else "2:3"
             
-            async def gerar_e_notificar(id_img, prompt, ratio):
-                """Gera imagem e coloca resultado na queue"""
+            async def gerar_e_notificar(id_img, prompt, quality, arquivo=None):
+                """Gera imagem e coloca resultado na fila de eventos ("upgrade" para a versão final)"""
+                # Pode ter sido agendada de dentro do streaming do texto: a imagem
+                # é um span de primeiro nível, não filho da chamada de texto
+                span_atual.set(None)
+                tipo = "upgrade" if quality == "final" else "image"
                 start = time.time()
                 try:
-                    filename = await gerar_imagem_async(
-                        id_img, prompt, todas_fotos, nomes,
-                        request.universe.style, pasta_historia, ratio=ratio
-                    )
+                    with span("image", image=id_img, quality=quality):
+                        resultado = await gerar_imagem_async(
+                            id_img, prompt, todas_fotos, nomes, request.universe.style,
+                            pasta_historia, ratio_imagem(id_img), quality, arquivo
+                        )
+                    if resultado is None:
+                        raise ValueError(f"Falha definitiva ao gerar {id_img}")
                     elapsed = time.time() - start
-                    await result_queue.put({
+                    eventos.put_nowait((tipo, {
                         "id": id_img, 
-                        "filename": filename, 
+                        "prompt": prompt,
+                        "quality": quality,
+                        "filename": resultado["filename"], 
                         "elapsed": round(elapsed, 1),
+                        "modelElapsed": round(resultado["modelTime"], 1),
+                        "encodeElapsed": round(resultado["encodeTime"], 2),
+                        "derivatives": resultado["derivatives"],
+                        "preview": resultado["preview"],
+                        "cached": resultado["cached"],
                         "error": None
-                    })
+                    }))
                 except Exception as e:
                     elapsed = time.time() - start
-                    await result_queue.put({
+                    eventos.put_nowait((tipo, {
                         "id": id_img, 
+                        "prompt": prompt,
+                        "quality": quality,
                         "filename": None, 
                         "elapsed": round(elapsed, 1),
+                        "modelElapsed": None,
+                        "encodeElapsed": None,
+                        "derivatives": [],
+                        "preview": None,
+                        "cached": False,
                         "error": str(e)
-                    })
+                    }))
             
-            # Iniciar todas as tasks em paralelo (sem await)
-            tasks = []
-            tasks.append(asyncio.create_task(
-                gerar_e_notificar("capa", story_data.cover_prompt, "16:9")
-            ))
-            for i, (texto, prompt) in enumerate(story_data.parts, 1):
-                tasks.append(asyncio.create_task(
-                    gerar_e_notificar(f"parte_{i}", prompt, "2:3")
-                ))
-            
-            # Processar resultados conforme vão chegando (tempo real)
-            images_done = 0
-            images_failed = 0
-            
-            for _ in range(total_images):
-                # Aguarda próximo resultado (qualquer imagem que terminar)
-                result = await result_queue.get()
+            def agendar_imagem(id_img, prompt):
+                """Inicia a geração de uma imagem (ou reinicia, se o prompt mudou)"""
+                nonlocal img_start
+                anterior = tarefas.get(id_img)
+                if anterior is not None:
+                    if anterior[0] == prompt:
+                        return
+                    anterior[1].cancel()
+                    if id_img in upgrades:
+                        upgrades.pop(id_img)[1].cancel()
+                    resultados.pop(id_img, None)
+                    generated_images.pop(id_img, None)
+                    generated_derivatives.pop(id_img, None)
+                    generated_previews.pop(id_img, None)
+                    image_quality.pop(id_img, None)
+                if img_start is None:
+                    img_start = time.time()
+                tarefas[id_img] = (prompt, asyncio.create_task(gerar_e_notificar(id_img, prompt, quality_inicial)))
+                eventos.put_nowait(("image_start", id_img))
+            
+            def registrar_imagem(result):
+                """Guarda URL, derivados e prévia de uma imagem concluída; devolve os derivados com URL"""
+                generated_images[result["id"]] = f"/historias/{folder_name}/{result['filename']}"
+                derivatives = derivative_urls(folder_name, result["derivatives"])
+                generated_derivatives[result["id"]] = derivatives
+                generated_previews[result["id"]] = result["preview"]
+                image_quality[result["id"]] = result["quality"]
+                return derivatives
+            
+            def aplicar_upgrade(result):
+                """
+                Troca o rascunho pela versão final. Devolve os dados do evento
+                image_upgraded, ou None se a versão final falhou (fica o rascunho)
+                ou é de um prompt substituído.
+                """
+                atual = upgrades.get(result["id"])
+                if atual is None or atual[0] != result["prompt"]:
+                    return None
+                del upgrades[result["id"]]
+                if result["error"]:
+                    IMAGE_UPGRADES.inc(status="error")
+                    print(f"⚠️ Versão final de {result['id']} falhou, fica o rascunho: {result['error']}")
+                    return None
+                IMAGE_UPGRADES.inc(status="ok")
+                derivatives = registrar_imagem(result)
+                return {
+                    "stage": 3,
+                    "imageId": result["id"],
+                    "message": f"Versão final de {result['id']} pronta",
+                    "quality": result["quality"],
+                    "elapsed": result["elapsed"],
+                    "modelElapsed": result["modelElapsed"],
+                    "encodeElapsed": result["encodeElapsed"],
+                    "cached": result["cached"],
+                    "imageUrl": generated_images[result["id"]],
+                    "derivatives": derivatives,
+                    **result["preview"],
+                    "pendingUpgrades": len(upgrades)
+                }
+            
+            def on_field(caminho, valor):
+                """Recebe cada campo do JSON da história assim que ele fica completo"""
+                nonlocal pasta_historia, story_id, folder_name
+                if caminho == ("title",):
+                    if pasta_historia is None:
+                        pasta_historia, story_id, folder_name = create_story_folder(valor)
+                        running_stories.add(story_id)
+                        for id_img, prompt in prompts_sem_pasta.items():
+                            agendar_imagem(id_img, prompt)
+                        prompts_sem_pasta.clear()
+                    return
+                if caminho == ("cover_prompt",):
+                    id_img = "capa"
+                elif len(caminho) == 3 and caminho[0] == "parts" and caminho[2] == 1 and caminho[1] < 5:
+                    id_img = f"parte_{caminho[1] + 1}"
+                else:
+                    return
+                if pasta_historia is None:
+                    prompts_sem_pasta[id_img] = valor
+                else:
+                    agendar_imagem(id_img, valor)
+            
+            async def gerar_historia():
+                try:
+                    with span("text"):
+                        story = await gerar_json_historia(
+                            personagens,
+                            request.universe,
+                            description,
+                            on_field
+                        )
+                    eventos.put_nowait(("story", story))
+                except Exception as e:
+                    eventos.put_nowait(("story_error", e))
+            
+            stage2_start = time.time()
+            historia_task = asyncio.create_task(gerar_historia())
+            story_data = None
+            stage3_announced = False
+            prazo_esgotado = False
+            
+            # Processar eventos conforme vão chegando (tempo real)
+            while story_data is None or len(resultados) < total_images:
+                evento = await proximo_evento()
+                if evento is None:
+                    prazo_esgotado = True
+                    break
+                tipo, dados = evento
+                
+                if tipo == "story_error":
+                    raise dados
+                
+                if tipo == "story":
+                    story_data = dados
+                    stage2_time = time.time() - stage2_start
+                    if pasta_historia is None:
+                        pasta_historia, story_id, folder_name = create_story_folder(story_data.title)
+                    
+                    # Garante que cada imagem usa o prompt final
+                    # (o texto pode ter sido refeito numa nova tentativa)
+                    agendar_imagem("capa", story_data.cover_prompt)
+                    for i, (texto, prompt) in enumerate(story_data.parts, 1):
+                        agendar_imagem(f"parte_{i}", prompt)
+                    
+                    yield send_event("story_created", {
+                        "stage": 2,
+                        "title": "📜 História Criada!",
+                        "message": f"Título: {story_data.title}",
+                        "progress": 25,
+                        "elapsed": round(stage2_time, 1),
+                        "data": {
+                            "title": story_data.title,
+                            "parts": story_data.parts,
+                            "storyId": story_id,
+                            "folder": folder_name
+                        }
+                    })
+                    continue
+                
+                if tipo == "upgrade":
+                    if evento := aplicar_upgrade(dados):
+                        yield send_event("image_upgraded", evento)
+                    continue
+                
+                if tipo == "image_start":
+                    if not stage3_announced:
+                        stage3_announced = True
+                        yield send_event("stage", {
+                            "stage": 3,
+                            "title": "🎨 Gerando Imagens",
+                            "message": f"Criando {total_images} ilustrações em paralelo...",
+                            "progress": 30
+                        })
+                    cap_num = numero_imagem(dados) - 1
+                    yield send_event("image_start", {
+                        "stage": 3,
+                        "imageId": dados,
+                        "message": "Iniciando geração da capa..." if dados == "capa" else f"Iniciando capítulo {cap_num}...",
+                        "currentImage": cap_num + 1,
+                        "totalImages": total_images
+                    })
+                    continue
+                
+                result = dados
+                atual = tarefas.get(result["id"])
+                if atual is None or atual[0] != result["prompt"]:
+                    continue  # resultado de uma tarefa substituída
+                resultados[result["id"]] = result
+                concluidas = len(resultados)
                 
                 if result["error"]:
-                    images_failed += 1
+                    IMAGES_FAILED.inc()
                     print(f"❌ Erro em imagem {result['id']}: {result['error']}")
                     # Enviar evento de erro para essa imagem específica
                     yield send_event("image_error", {
@@ -391,51 +2879,83 @@ async def create_story(request: StoryRequest):
                         "error": result["error"]
                     })
                     continue
-                    
-                if result["filename"]:
-                    images_done += 1
-                    image_url = f"/historias/{folder_name}/{result['filename']}"
-                    generated_images[result["id"]] = image_url
-                    
-                    # Determinar número do capítulo para mensagem
-                    if result["id"] == "capa":
-                        msg = "Capa criada!"
-                        current_num = 1
-                    else:
-                        cap_num = int(result["id"].split("_")[1])
-                        msg = f"Capítulo {cap_num} ilustrado!"
-                        current_num = cap_num + 1
-                    
-                    # ENVIAR EVENTO IMEDIATAMENTE (tempo real!)
-                    yield send_event("image_done", {
+                
+                IMAGES.inc(source="cache" if result["cached"] else "model")
+                derivatives = registrar_imagem(result)
+                if result["quality"] == "draft":
+                    # Versão final com outro nome: as imagens são servidas como imutáveis
+                    upgrades[result["id"]] = (result["prompt"], asyncio.create_task(
+                        gerar_e_notificar(result["id"], result["prompt"], "final", f"{result['id']}_v2")
+                    ))
+                
+                # Determinar número do capítulo para mensagem
+                current_num = numero_imagem(result["id"])
+                msg = "Capa criada!" if result["id"] == "capa" else f"Capítulo {current_num - 1} ilustrado!"
+                
+                # ENVIAR EVENTO IMEDIATAMENTE (tempo real!)
+                yield send_event("image_done", {
+                    "stage": 3,
+                    "imageId": result["id"],
+                    "message": msg,
+                    "elapsed": result["elapsed"],
+                    "modelElapsed": result["modelElapsed"],
+                    "encodeElapsed": result["encodeElapsed"],
+                    "cached": result["cached"],
+                    "quality": result["quality"],
+                    "imageUrl": generated_images[result["id"]],
+                    "derivatives": derivatives,
+                    **result["preview"],
+                    "currentImage": current_num,
+                    "totalImages": total_images,
+                    "progress": 30 + (concluidas / total_images * 60)
+                })
+            
+            if prazo_esgotado:
+                if story_data is None:
+                    raise DeadlineExceeded(f"O prazo de {STORY_DEADLINE_SECONDS:.0f}s acabou antes de a história ficar pronta")
+                # Termina com o que já existe: as imagens em andamento e as
+                # versões finais ainda não prontas são abandonadas
+                print(f"⏰ Prazo da história esgotado: {total_images - len(resultados)} imagem(ns) abandonada(s)")
+                for _, task in upgrades.values():
+                    task.cancel()
+                upgrades.clear()
+                for id_img, (_, task) in tarefas.items():
+                    if id_img in resultados:
+                        continue
+                    task.cancel()
+                    resultados[id_img] = {"id": id_img, "error": "Prazo da história esgotado"}
+                    IMAGES_FAILED.inc()
+                    yield send_event("image_error", {
                         "stage": 3,
-                        "imageId": result["id"],
-                        "message": msg,
-                        "elapsed": result["elapsed"],
-                        "imageUrl": image_url,
-                        "currentImage": current_num,
-                        "totalImages": total_images,
-                        "progress": 30 + ((images_done + images_failed) / total_images * 60)
+                        "imageId": id_img,
+                        "message": f"Prazo esgotado para {id_img}",
+                        "error": resultados[id_img]["error"]
                     })
             
             # Garantir que todas as tasks terminaram
-            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(historia_task, *(task for _, task in tarefas.values()), return_exceptions=True)
             
+            images_done = sum(1 for r in resultados.values() if not r["error"])
+            images_failed = total_images - images_done
+            total_encode_time = sum(r["encodeElapsed"] for r in resultados.values() if not r["error"])
             total_img_time = time.time() - img_start
-            print(f"⚡ Imagens: {images_done} ✓, {images_failed} ✗ em {total_img_time:.1f}s (paralelo)")
+            print(f"⚡ Imagens: {images_done} ✓, {images_failed} ✗ em {total_img_time:.1f}s (paralelo), codificação {total_encode_time:.1f}s")
             
             # Verificar se houve falhas demais
             if images_failed > 0 and images_done == 0:
+                STORIES.inc(status="error")
+                STORY_SECONDS.observe(time.time() - start_time, status="error")
                 yield send_event("error", {
                     "stage": 3,
                     "title": "❌ Erro na Geração",
-                    "message": f"Não foi possível gerar nenhuma imagem após {MAX_RETRIES} tentativas. Por favor, tente novamente.",
+                    "message": "Não foi possível gerar nenhuma imagem após várias tentativas. Por favor, tente novamente.",
                     "progress": 0
                 })
                 return
             
             # ========== ETAPA 4: SALVAR E FINALIZAR ==========
             total_time = time.time() - start_time
+            status = "degraded" if prazo_esgotado else "complete"
             
             # Montar objeto final da história
             final_story = {
@@ -446,42 +2966,184 @@ async def create_story(request: StoryRequest):
                 "cover_prompt": story_data.cover_prompt,
                 "parts": story_data.parts,
                 "images": generated_images,
+                "derivatives": generated_derivatives,
+                "previews": generated_previews,
+                "imageQuality": image_quality,
+                "upgrading": sorted(upgrades),  # imagens ainda em rascunho, com a versão final a caminho
                 "universe": {
                     "id": request.universe.id,
                     "name": request.universe.name,
                     "style": request.universe.style
                 },
-                "characters": [{"id": c.id, "name": c.name} for c in request.characters],
-                "totalTime": round(total_time, 1)
+                "characters": [{"id": c.id, "name": c.name} for c in personagens],
+                "referencePhotos": chaves_fotos,
+                "missingImages": sorted(set(tarefas) - set(generated_images)),
+                "totalTime": round(total_time, 1),
+                "retries": contexto["retries"]
             }
             
             # Salvar JSON da história
-            json_path = os.path.join(pasta_historia, "story.json")
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(final_story, f, indent=2, ensure_ascii=False)
+            final_story["trace"] = contexto["trace"].to_dict()
+            json_path = await save_story_json(pasta_historia, final_story)
             print(f"✅ JSON salvo: {json_path}")
+            catalog.add(folder_name, final_story)
+            STORIES.inc(status=status)
+            STORY_SECONDS.observe(total_time, status=status)
             
+            if prazo_esgotado:
+                mensagem = f"O tempo acabou: sua história ficou pronta em {round(total_time, 1)} segundos com {images_done} de {total_images} ilustrações."
+            else:
+                mensagem = f"Sua história foi criada em {round(total_time, 1)} segundos!"
             yield send_event("complete", {
                 "stage": 4,
                 "title": "✨ História Completa!",
-                "message": f"Sua história foi criada em {round(total_time, 1)} segundos!",
+                "message": mensagem,
                 "progress": 100,
                 "totalTime": round(total_time, 1),
-                "data": final_story
+                "degraded": prazo_esgotado,
+                "hedging": {
+                    "sent": contexto["hedges"]["sent"],
+                    "won": contexto["hedges"]["won"],
+                    "savedTime": round(contexto["hedges"]["savedTime"], 1)
+                },
+                "data": client_story(final_story)
             })
             
+            # Modo progressivo: o livro já está completo com os rascunhos; cada
+            # versão final atualiza o story.json e o catálogo quando fica pronta
+            # (até o prazo da história ou um cancelamento: depois, ficam os rascunhos)
+            try:
+                while upgrades:
+                    evento = await proximo_evento()
+                    if evento is None:
+                        print(f"⏰ Prazo da história esgotado: {len(upgrades)} imagem(ns) ficam em rascunho")
+                        for _, task in upgrades.values():
+                            task.cancel()
+                        upgrades.clear()
+                    elif evento[0] != "upgrade":
+                        continue
+                    else:
+                        evento = aplicar_upgrade(evento[1])
+                    final_story["upgrading"] = sorted(upgrades)
+                    final_story["trace"] = contexto["trace"].to_dict()
+                    await save_story_json(pasta_historia, final_story)
+                    catalog.add(folder_name, final_story)
+                    if evento:
+                        yield send_event("image_upgraded", evento)
+            except asyncio.CancelledError:
+                final_story["upgrading"] = []
+                await save_story_json(pasta_historia, final_story)
+                catalog.add(folder_name, final_story)
+                raise
+            if request.progressive:
+                finais = sum(1 for q in image_quality.values() if q == "final")
+                print(f"🖼️ Versões finais: {finais}/{len(image_quality)} em {time.time() - start_time:.1f}s")
+            
         except Exception as e:
             import traceback
             traceback.print_exc()
+            STORIES.inc(status="error")
+            STORY_SECONDS.observe(time.time() - start_time, status="error")
             yield send_event("error", {
                 "stage": -1,
                 "title": "❌ Erro",
                 "message": str(e),
                 "progress": 0
             })
+        finally:
+            running_stories.discard(story_id)
+            # Erro, prazo, job cancelado ou servidor desligando: nenhuma geração fica órfã
+            pendentes = [
+                task for task in (historia_task, *(t for _, t in tarefas.values()), *(t for _, t in upgrades.values()))
+                if task is not None and not task.done()
+            ]
+            for task in pendentes:
+                task.cancel()
+            if pendentes:
+                await asyncio.gather(*pendentes, return_exceptions=True)
+    
+    return event_generator()
+
+@app.post("/api/characters", status_code=201)
+async def create_character(request: Request):
+    """
+    Registra um personagem a partir de um multipart/form-data com o campo
+    `name` e um ou mais arquivos em `photos`. As fotos são gravadas em disco
+    enquanto chegam. Retorna o id a usar em create-story (`character_ids`).
+    """
+    tipo, opcoes = parse_options_header(request.headers.get("content-type", ""))
+    if tipo != b"multipart/form-data" or not opcoes.get(b"boundary"):
+        raise HTTPException(status_code=415, detail="Envie as fotos como multipart/form-data")
+    
+    pasta_upload = character_store.upload_dir()
+    upload = MultipartPhotoUpload(opcoes[b"boundary"], pasta_upload, MAX_CHARACTER_PHOTOS, MAX_PHOTO_MB * 1024 * 1024)
+    try:
+        async for pedaco in request.stream():
+            await upload.feed(pedaco)
+            if upload.error is not None:
+                break
+        if upload.error is None:
+            await upload.finish()
+        if upload.error is not None:
+            raise HTTPException(status_code=upload.error[0], detail=upload.error[1])
+        
+        nome = upload.fields.get("name", "").strip()
+        if not nome:
+            raise HTTPException(status_code=422, detail="Informe o nome do personagem (campo name)")
+        if not upload.photos:
+            raise HTTPException(status_code=422, detail="Envie ao menos uma foto (campo photos)")
+        personagem = await character_store.register(nome, pasta_upload, upload.photos)
+    finally:
+        upload.close()
+        await asyncio.to_thread(shutil.rmtree, pasta_upload, True)
+    
+    return {"characterId": personagem["id"], "name": personagem["name"], "photos": len(personagem["photos"])}
+
+@app.post("/api/create-story", status_code=202)
+async def create_story(request: StoryRequest):
+    """
+    Enfileira a criação de uma história e retorna o id do job.
+    O progresso é acompanhado em GET /api/jobs/{id}/events.
+    """
+    if not request.characters and not request.character_ids:
+        raise HTTPException(status_code=422, detail="Informe ao menos um personagem")
+    desconhecidos = [cid for cid in request.character_ids if character_store.get(cid) is None]
+    if desconhecidos:
+        raise HTTPException(status_code=404, detail=f"Personagem não encontrado: {', '.join(desconhecidos)}")
+    
+    # Pedido idêntico ainda em andamento (clique duplo, reconexão): reaproveita o mesmo job
+    chave = story_request_key(request)
+    job_id = jobs.find(chave)
+    if job_id is not None:
+        print(f"🔁 Pedido idêntico em andamento: reaproveitando o job {job_id}")
+    else:
+        # Fila cheia: recusa logo em vez de aceitar uma espera sem fim
+        if jobs.is_full():
+            raise HTTPException(
+                status_code=503,
+                detail="Muitas histórias em produção no momento. Tente novamente em instantes.",
+                headers={"Retry-After": "30"}
+            )
+        job_id = jobs.submit(chave, request)
+    
+    return {"jobId": job_id, "eventsUrl": f"/api/jobs/{job_id}/events"}
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    """
+    Eventos SSE do job: repete os já gravados depois de Last-Event-ID
+    e continua ao vivo até o fim. Reconectar não perde nada.
+    """
+    if jobs.status(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    # Job já terminado e sem eventos novos: 204 faz o EventSource parar de reconectar
+    if jobs.status(job_id) not in ("queued", "running") and after >= jobs.last_seq(job_id):
+        return Response(status_code=204)
     
     return StreamingResponse(
-        event_generator(),
+        jobs.events(job_id, after),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -490,45 +3152,70 @@ async def create_story(request: StoryRequest):
         }
     )
 
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancela o job: as imagens em andamento param na hora. Um job que já
+    terminou não muda; um que já mandou "complete" (modo progressivo) fica
+    com os rascunhos.
+    """
+    status = jobs.cancel(job_id, "História cancelada")
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return {"jobId": job_id, "status": status}
+
 @app.get("/api/stories")
-async def list_stories():
-    """Lista todas as histórias salvas"""
-    stories = []
-    
-    if os.path.exists(STORIES_DIR):
-        for folder_name in os.listdir(STORIES_DIR):
-            folder_path = os.path.join(STORIES_DIR, folder_name)
-            json_path = os.path.join(folder_path, "story.json")
-            
-            if os.path.isdir(folder_path) and os.path.exists(json_path):
-                try:
-                    with open(json_path, "r", encoding="utf-8") as f:
-                        story = json.load(f)
-                        stories.append(story)
-                except Exception as e:
-                    print(f"Erro ao ler {json_path}: {e}")
-    
-    # Ordenar por data de criação (mais recente primeiro)
-    stories.sort(key=lambda x: x.get("createdAt", ""), reverse=True)
+async def list_stories(
+    limit: int = Query(50, ge=1, le=200),
+    after: Optional[str] = None
+):
+    """Lista as histórias salvas (mais recentes primeiro), paginadas por cursor"""
+    catalog.refresh()
+    try:
+        stories, next_cursor = catalog.page(limit, after)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
     
-    return {"stories": stories}
+    return {"stories": stories, "nextCursor": next_cursor}
 
 @app.get("/api/stories/{story_id}")
 async def get_story(story_id: str):
     """Busca uma história específica pelo ID"""
-    if os.path.exists(STORIES_DIR):
-        for folder_name in os.listdir(STORIES_DIR):
-            if folder_name.startswith(story_id):
-                json_path = os.path.join(STORIES_DIR, folder_name, "story.json")
-                if os.path.exists(json_path):
-                    with open(json_path, "r", encoding="utf-8") as f:
-                        return json.load(f)
-    
-    raise HTTPException(status_code=404, detail="História não encontrada")
+    story = catalog.get(story_id)
+    if story is None:
+        catalog.refresh()
+        story = catalog.get(story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="História não encontrada")
+    if story.get("upgrading") and not pending_upgrades(story):
+        # Job que morreu com versões finais pendentes: o leitor não fica esperando
+        story = {**story, "upgrading": []}
+    return story
+
+@app.post("/api/stories/{story_id}/parts/{n}/regenerate")
+async def regenerate_part(story_id: str, n: int):
+    """Refaz só a imagem do capítulo n (1 a 5), com o prompt e as fotos da história"""
+    return await regenerate_image(story_id, f"parte_{n}")
+
+@app.post("/api/stories/{story_id}/cover/regenerate")
+async def regenerate_cover(story_id: str):
+    """Refaz só a imagem da capa, com o prompt e as fotos da história"""
+    return await regenerate_image(story_id, "capa")
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Métricas no formato texto do Prometheus"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "ok",
+        "timestamp": datetime.now().isoformat(),
+        "scheduler": scheduler.stats(),
+        "resultCache": result_cache.stats(),
+        "stories": jobs.stats()
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -11,6 +11,23 @@ import './App.css';
 // Simulated user for demo (placeholder for Google Auth)
 const DEMO_USER = null;
 
+// Só o que a galeria e o leitor mostram vai para o localStorage: o trace e as
+// miniaturas em base64 das prévias ficam no servidor (story.json)
+const STORED_STORY_FIELDS = ['id', 'folder', 'createdAt', 'title', 'universe', 'characters', 'parts', 'images', 'derivatives', 'upgrading'];
+
+function storedStory(story) {
+  const stored = {};
+  for (const field of STORED_STORY_FIELDS) {
+    if (story[field] !== undefined) stored[field] = story[field];
+  }
+  if (story.previews) {
+    stored.previews = Object.fromEntries(
+      Object.entries(story.previews).map(([id, { width, height, color }]) => [id, { width, height, color }])
+    );
+  }
+  return stored;
+}
+
 function App() {
   const [user, setUser] = useState(DEMO_USER);
   const [characters, setCharacters] = useState([]);
@@ -36,7 +53,7 @@ function App() {
 
   // Save stories
   useEffect(() => {
-    localStorage.setItem('storymaker-stories', JSON.stringify(savedStories));
+    localStorage.setItem('storymaker-stories', JSON.stringify(savedStories.map(storedStory)));
   }, [savedStories]);
 
   // Placeholder: Google Login
@@ -73,11 +90,17 @@ function App() {
       createdAt: new Date().toISOString(),
       ...storyData
     };
-    setSavedStories(prev => [newStory, ...prev]);
+    setSavedStories(prev => [storedStory(newStory), ...prev]);
     setCompletedStory(storyData);
     setView('viewing');
   };
 
+  // Modo progressivo: a versão final de cada imagem chega depois do livro completo
+  const handleStoryUpdate = (story) => {
+    setSavedStories(prev => prev.map(s => s.id === story.id ? storedStory({ ...s, ...story }) : s));
+    setCompletedStory(story);
+  };
+
   const handleCancelGeneration = () => {
     setCurrentStoryRequest(null);
     setView('home');
@@ -201,6 +224,7 @@ function App() {
         <main className="dashboard container">
           <StoryViewer
             story={completedStory}
+            onStoryUpdate={handleStoryUpdate}
             onClose={handleCloseViewer}
           />
         </main>
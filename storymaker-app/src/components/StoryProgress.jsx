@@ -10,6 +10,49 @@ const STAGES = {
     4: { icon: '✨', name: 'Finalizado' },
 };
 
+// Personagens já enviados ao servidor: id local -> id retornado por /api/characters
+const SERVER_IDS_KEY = 'storymaker-character-server-ids';
+
+// Envia as fotos do personagem como arquivos (multipart), sem Base64 no corpo
+async function uploadCharacter(character) {
+    const form = new FormData();
+    form.append('name', character.name);
+    for (const [i, image] of character.images.entries()) {
+        const blob = await (await fetch(image)).blob();
+        form.append('photos', blob, `foto_${i + 1}`);
+    }
+    const response = await fetch(`${API_BASE}/api/characters`, { method: 'POST', body: form });
+    if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.detail || `Erro ${response.status} ao enviar ${character.name}`);
+    }
+    return (await response.json()).characterId;
+}
+
+// Ids no servidor dos personagens da história, enviando só os que faltam
+async function getServerCharacterIds(characters, forceUpload = false) {
+    const saved = JSON.parse(localStorage.getItem(SERVER_IDS_KEY) || '{}');
+    const ids = [];
+    for (const character of characters) {
+        if (forceUpload || !saved[character.id]) {
+            saved[character.id] = await uploadCharacter(character);
+        }
+        ids.push(saved[character.id]);
+    }
+    localStorage.setItem(SERVER_IDS_KEY, JSON.stringify(saved));
+    return ids;
+}
+
+// Miniatura e cor dominante do image_done como fundo até a imagem carregar
+function previewStyle(preview) {
+    if (!preview) return undefined;
+    return {
+        backgroundColor: preview.color,
+        backgroundImage: `url(${preview.placeholder})`,
+        backgroundSize: 'cover'
+    };
+}
+
 export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
     const [currentStage, setCurrentStage] = useState(1);
     const [progress, setProgress] = useState(0);
@@ -23,13 +66,17 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
     const [imagesInProgress, setImagesInProgress] = useState({}); // {imageId: startTime}
     const [imageElapsedTimes, setImageElapsedTimes] = useState({}); // contadores em tempo real
     const [imageErrors, setImageErrors] = useState({}); // {imageId: errorMessage}
+    const [imagePreviews, setImagePreviews] = useState({}); // {imageId: {placeholder, color}}
     const [error, setError] = useState(null);
     const [isComplete, setIsComplete] = useState(false);
+    const [isDegraded, setIsDegraded] = useState(false); // prazo esgotado: faltam ilustrações
 
     const startTimeRef = useRef(Date.now());
     const eventSourceRef = useRef(null);
     const timerRef = useRef(null);
     const hasStartedRef = useRef(false); // Previne execução dupla (React StrictMode)
+    const jobIdRef = useRef(null);
+    const finishedRef = useRef(false); // job já mandou complete, error ou cancelled
 
     // Timer global + contadores individuais de imagens
     useEffect(() => {
@@ -55,6 +102,15 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
         };
     }, []);
 
+    // Sair da tela antes do fim (Cancelar, Voltar) cancela o job no servidor:
+    // as imagens em andamento param em vez de consumir cota à toa
+    useEffect(() => () => {
+        if (jobIdRef.current && !finishedRef.current) {
+            fetch(`${API_BASE}/api/jobs/${jobIdRef.current}`, { method: 'DELETE', keepalive: true })
+                .catch(() => {});
+        }
+    }, []);
+
     // Conexão SSE
     useEffect(() => {
         // Prevenir execução dupla causada pelo React StrictMode
@@ -66,47 +122,56 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
 
         const startGeneration = async () => {
             try {
-                const response = await fetch('http://localhost:8000/api/create-story', {
+                const createStory = async (forceUpload) => fetch(`${API_BASE}/api/create-story`, {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
                     },
                     body: JSON.stringify({
-                        characters: storyRequest.characters.map(c => ({
-                            id: c.id,
-                            name: c.name,
-                            images: c.images
-                        })),
+                        character_ids: await getServerCharacterIds(storyRequest.characters, forceUpload),
                         universe: {
                             id: storyRequest.universe.id,
                             name: storyRequest.universe.name,
                             style: storyRequest.universe.style
                         },
-                        description: storyRequest.description
+                        description: storyRequest.description,
+                        // Rascunhos rápidos primeiro; as versões finais chegam depois (image_upgraded)
+                        progressive: true
                     }),
                 });
 
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-
-                while (true) {
-                    const { done, value } = await reader.read();
-                    if (done) break;
+                setMessage('Enviando fotos dos personagens...');
+                let response = await createStory(false);
+                if (response.status === 404) {
+                    // O servidor não conhece mais algum personagem: reenvia as fotos
+                    response = await createStory(true);
+                }
 
-                    const text = decoder.decode(value);
-                    const lines = text.split('\n');
+                if (!response.ok) {
+                    const body = await response.json().catch(() => ({}));
+                    setError(body.detail || `Erro ${response.status}`);
+                    return;
+                }
 
-                    for (const line of lines) {
-                        if (line.startsWith('data: ')) {
-                            try {
-                                const data = JSON.parse(line.slice(6));
-                                handleEvent(data);
-                            } catch (e) {
-                                console.warn('Failed to parse SSE data:', line);
-                            }
+                // A história roda como job no servidor; o EventSource reconecta
+                // sozinho (com Last-Event-ID) se a conexão cair
+                const { jobId, eventsUrl } = await response.json();
+                jobIdRef.current = jobId;
+                const eventSource = new EventSource(`${API_BASE}${eventsUrl}`);
+                eventSourceRef.current = eventSource;
+
+                eventSource.onmessage = (event) => {
+                    try {
+                        const data = JSON.parse(event.data);
+                        handleEvent(data);
+                        if (['complete', 'error', 'cancelled'].includes(data.type)) {
+                            finishedRef.current = true;
+                            eventSource.close();
                         }
+                    } catch (e) {
+                        console.warn('Failed to parse SSE data:', event.data);
                     }
-                }
+                };
             } catch (err) {
                 console.error('SSE Error:', err);
                 setError(`Erro de conexão: ${err.message}`);
@@ -126,6 +191,27 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
         const { type } = data;
 
         switch (type) {
+            case 'queued':
+                setStageTitle(data.title);
+                setMessage(data.message);
+                break;
+
+            case 'requeued':
+                // Servidor reiniciou: o job recomeça e as imagens anteriores não valem mais
+                setCurrentStage(data.stage);
+                setStageTitle(data.title);
+                setMessage(data.message);
+                setProgress(data.progress);
+                setStoryData(null);
+                setCurrentImage(null);
+                setGeneratedImages({});
+                setImageTimes({});
+                setImagePreviews({});
+                setImagesInProgress({});
+                setImageElapsedTimes({});
+                setImageErrors({});
+                break;
+
             case 'stage':
                 setCurrentStage(data.stage);
                 setStageTitle(data.title);
@@ -167,6 +253,12 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                     ...prev,
                     [data.imageId]: data.elapsed
                 }));
+                if (data.placeholder) {
+                    setImagePreviews(prev => ({
+                        ...prev,
+                        [data.imageId]: { placeholder: data.placeholder, color: data.color }
+                    }));
+                }
                 // Remover da lista de em progresso
                 setImagesInProgress(prev => {
                     const updated = { ...prev };
@@ -177,6 +269,18 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                 setMessage(data.message);
                 break;
 
+            case 'image_upgraded':
+                // Versão final no lugar do rascunho (novo arquivo, mesma imagem)
+                setGeneratedImages(prev => ({
+                    ...prev,
+                    [data.imageId]: `${API_BASE}${data.imageUrl}`
+                }));
+                setImagePreviews(prev => ({
+                    ...prev,
+                    [data.imageId]: { placeholder: data.placeholder, color: data.color }
+                }));
+                break;
+
             case 'image_error':
                 // Marcar imagem como erro
                 setImageErrors(prev => ({
@@ -197,6 +301,7 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                 setMessage(data.message);
                 setProgress(100);
                 setIsComplete(true);
+                setIsDegraded(Boolean(data.degraded));
                 if (timerRef.current) clearInterval(timerRef.current);
 
                 // Passar dados completos para o callback
@@ -206,6 +311,7 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                 break;
 
             case 'error':
+            case 'cancelled':
                 setError(data.message);
                 if (timerRef.current) clearInterval(timerRef.current);
                 break;
@@ -299,7 +405,11 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                                     <span className="chapter-num">Cap. {idx + 1}</span>
                                     {isDone ? (
                                         <div className="chapter-image-done">
-                                            <img src={generatedImages[imageId]} alt={`Capítulo ${idx + 1}`} />
+                                            <img
+                                                src={generatedImages[imageId]}
+                                                alt={`Capítulo ${idx + 1}`}
+                                                style={previewStyle(imagePreviews[imageId])}
+                                            />
                                             <span className="image-time">{imageTimes[imageId]}s</span>
                                         </div>
                                     ) : hasError ? (
@@ -329,7 +439,7 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                     <h4>🎬 Capa da História</h4>
                     {generatedImages.capa ? (
                         <>
-                            <img src={generatedImages.capa} alt="Capa" />
+                            <img src={generatedImages.capa} alt="Capa" style={previewStyle(imagePreviews.capa)} />
                             {imageTimes.capa && <span className="image-time-badge">{imageTimes.capa}s</span>}
                         </>
                     ) : imageErrors.capa ? (
@@ -353,6 +463,7 @@ export default function StoryProgress({ storyRequest, onComplete, onCancel }) {
                         <span className="complete-icon">🎉</span>
                         <h2>História Criada com Sucesso!</h2>
                         <p>Tempo total: {formatTime(elapsedTime)}</p>
+                        {isDegraded && <p>{message}</p>}
                         <p className="complete-hint">Redirecionando para visualização...</p>
                     </div>
                 </div>
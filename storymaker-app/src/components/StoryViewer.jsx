@@ -1,7 +1,9 @@
-import { useState } from 'react';
+import { useState, useEffect } from 'react';
 import './StoryViewer.css';
 
 const API_BASE = 'http://localhost:8000';
+const UPGRADE_POLL_MS = 5000;          // intervalo entre buscas das versões finais
+const UPGRADE_POLL_LIMIT_MS = 600000;  // desiste depois de 10 minutos
 
 // Normaliza URL da imagem (pode vir do servidor ou já ser URL completa)
 function getImageUrl(url) {
@@ -11,6 +13,37 @@ function getImageUrl(url) {
     return url;
 }
 
+// Imagem responsiva: <picture> com srcset AVIF/WebP quando a história tem derivados
+function ResponsiveImage({ story, imageId, sizes, ...props }) {
+    const variants = story.derivatives?.[imageId] || [];
+    const preview = story.previews?.[imageId];
+    const srcSet = (format) => variants
+        .filter(v => v.format === format)
+        .map(v => `${getImageUrl(v.url)} ${v.width}w`)
+        .join(', ');
+
+    return (
+        <picture style={{ display: 'contents' }}>
+            {['avif', 'webp'].map(format => srcSet(format) && (
+                <source key={format} type={`image/${format}`} srcSet={srcSet(format)} sizes={sizes} />
+            ))}
+            <img
+                src={getImageUrl(story.images[imageId])}
+                width={preview?.width}
+                height={preview?.height}
+                style={preview && {
+                    // Prévia borrada e cor dominante até a imagem final carregar
+                    // (histórias salvas no navegador guardam só a cor, sem a miniatura)
+                    backgroundColor: preview.color,
+                    backgroundImage: preview.placeholder ? `url(${preview.placeholder})` : undefined,
+                    backgroundSize: 'cover'
+                }}
+                {...props}
+            />
+        </picture>
+    );
+}
+
 // Extrai nomes dos personagens (pode ser string[] ou {name}[])
 function getCharacterNames(characters) {
     if (!characters || !Array.isArray(characters)) return '';
@@ -23,11 +56,56 @@ function getUniverseName(universe) {
     return typeof universe === 'string' ? universe : universe.name;
 }
 
-export default function StoryViewer({ story, onClose }) {
+export default function StoryViewer({ story, onStoryUpdate, onClose }) {
     const [currentPage, setCurrentPage] = useState(0); // 0 = capa
+    const [regenerating, setRegenerating] = useState(false);
+    const [regenerateError, setRegenerateError] = useState(null);
+
+    // Modo progressivo: enquanto houver imagens em rascunho, busca a história
+    // no servidor até as versões finais (com novos nomes de arquivo) chegarem
+    const pendingUpgrades = story.upgrading?.length || 0;
+    useEffect(() => {
+        if (!pendingUpgrades || !story.id || !onStoryUpdate) return;
+        const startedAt = Date.now();
+        const timer = setInterval(async () => {
+            if (Date.now() - startedAt > UPGRADE_POLL_LIMIT_MS) {
+                clearInterval(timer);
+                return;
+            }
+            try {
+                const response = await fetch(`${API_BASE}/api/stories/${story.id}`);
+                if (!response.ok) return;
+                const fresh = await response.json();
+                if ((fresh.upgrading?.length || 0) !== pendingUpgrades) {
+                    onStoryUpdate(fresh);
+                }
+            } catch (err) {
+                console.warn('Falha ao buscar as versões finais:', err);
+            }
+        }, UPGRADE_POLL_MS);
+        return () => clearInterval(timer);
+    }, [story.id, pendingUpgrades, onStoryUpdate]);
 
     const totalPages = story.parts?.length || 0;
 
+    // Refaz só a ilustração da página atual (uma chamada ao modelo); a
+    // resposta traz a história já atualizada, com o novo nome de arquivo
+    const regenerateCurrentImage = async () => {
+        const path = currentPage === 0 ? 'cover' : `parts/${currentPage}`;
+        setRegenerating(true);
+        setRegenerateError(null);
+        try {
+            const response = await fetch(`${API_BASE}/api/stories/${story.id}/${path}/regenerate`, { method: 'POST' });
+            const body = await response.json().catch(() => ({}));
+            if (!response.ok) throw new Error(body.detail || `Erro ${response.status}`);
+            onStoryUpdate?.(body.story);
+        } catch (err) {
+            setRegenerateError(err.message);
+        } finally {
+            setRegenerating(false);
+        }
+    };
+
     const goToPage = (direction) => {
         setCurrentPage(prev => {
             const next = prev + direction;
@@ -50,6 +128,17 @@ export default function StoryViewer({ story, onClose }) {
                 </div>
                 <div className="viewer-meta">
                     <span className="badge badge-primary">{getUniverseName(story.universe)}</span>
+                    {story.id && (
+                        <button
+                            className="btn btn-secondary"
+                            onClick={regenerateCurrentImage}
+                            disabled={regenerating || pendingUpgrades > 0}
+                            title={pendingUpgrades > 0 ? 'Aguarde as versões finais das imagens' : undefined}
+                        >
+                            {regenerating ? '⏳ Refazendo...' : '🔄 Refazer ilustração'}
+                        </button>
+                    )}
+                    {regenerateError && <span className="regenerate-error">{regenerateError}</span>}
                 </div>
             </div>
 
@@ -64,7 +153,7 @@ export default function StoryViewer({ story, onClose }) {
                         <div className="cover-content">
                             <div className="cover-image-wrapper">
                                 {getImageUrl(story.images?.capa) ? (
-                                    <img src={getImageUrl(story.images.capa)} alt="Capa" className="cover-image" />
+                                    <ResponsiveImage story={story} imageId="capa" sizes="(max-width: 768px) 100vw, 50vw" alt="Capa" className="cover-image" />
                                 ) : (
                                     <div className="cover-placeholder">
                                         <span>📚</span>
@@ -90,8 +179,10 @@ export default function StoryViewer({ story, onClose }) {
                     <div className="book-page chapter-page animate-slide-up" key={currentPage}>
                         <div className="chapter-image-side">
                             {getImageUrl(story.images?.[`parte_${currentPage}`]) ? (
-                                <img
-                                    src={getImageUrl(story.images[`parte_${currentPage}`])}
+                                <ResponsiveImage
+                                    story={story}
+                                    imageId={`parte_${currentPage}`}
+                                    sizes="(max-width: 768px) 100vw, 50vw"
                                     alt={`Capítulo ${currentPage}`}
                                     className="chapter-image"
                                 />
@@ -0,0 +1,48 @@
+"""
+Configuração comum dos testes: coloca historia.py e storymaker-app/api.py no
+path e aponta todas as pastas da API para um diretório temporário antes do
+primeiro import, para os testes nunca tocarem nas histórias reais.
+"""
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "storymaker-app"))
+
+_PASTA_TESTES = tempfile.mkdtemp(prefix="storymaker_testes_")
+for variavel, nome in (
+    ("STORIES_DIR", "historias"),
+    ("JOBS_DB", "jobs.db"),
+    ("RESULT_CACHE_DIR", ".cache"),
+    ("CHARACTERS_DIR", "characters"),
+):
+    os.environ[variavel] = os.path.join(_PASTA_TESTES, nome)
+os.environ.setdefault("GEMINI_API_KEY", "teste")
+os.environ["API_WARMUP"] = "0"
+
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def api_isolada(tmp_path, monkeypatch):
+    """
+    API com histórias, catálogo, cache de resultados e personagens em tmp_path
+    e o FakeGemini do benchmark.py (imagens pequenas) no lugar do cliente real.
+    Carregue catalog e result_cache dentro do event loop do teste.
+    """
+    import api
+    import benchmark
+
+    monkeypatch.setattr(benchmark, "LADO_2K", 256)
+    monkeypatch.setattr(benchmark, "LADO_RASCUNHO", 128)
+    monkeypatch.setattr(api, "client", benchmark.FakeGemini(latencia_texto=0.1, latencia_imagem=0.05,
+                                                            latencia_rascunho=0.02, sigma=0))
+    monkeypatch.setattr(api, "STORIES_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "catalog", api.StoryCatalog(str(tmp_path)))
+    monkeypatch.setattr(api, "result_cache", api.ResultCache(str(tmp_path / ".cache"), 1 << 20))
+    monkeypatch.setattr(api, "character_store", api.CharacterStore(str(tmp_path / ".characters")))
+    api.character_store.load()
+    return tmp_path
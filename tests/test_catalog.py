@@ -0,0 +1,55 @@
+import asyncio
+
+import api
+
+
+def _salvar(catalog, pasta_raiz, n):
+    story_id = f"20260101_00000{n}_0000000{n}"
+    folder = f"{story_id}_Historia_{n}"
+    (pasta_raiz / folder).mkdir()
+    story = {
+        "id": story_id,
+        "folder": folder,
+        "createdAt": f"2026-01-01T00:00:0{n}",
+        "title": f"História {n}",
+        "parts": [["texto longo", "prompt longo"]] * 5,
+        "images": {"capa": f"/historias/{folder}/capa.png"},
+        "previews": {"capa": {"color": "#000000"}},
+        "trace": {"spans": [{"name": "model"}] * 100},
+    }
+    asyncio.run(api.save_story_json(str(pasta_raiz / folder), story))
+    catalog.add(folder, story)
+    return story_id
+
+
+def test_pagina_traz_resumos_sem_trace(tmp_path):
+    catalog = api.StoryCatalog(str(tmp_path))
+    catalog.load()
+    ids = [_salvar(catalog, tmp_path, n) for n in range(1, 4)]
+
+    pagina, cursor = catalog.page(2)
+    assert [s["id"] for s in pagina] == ids[:0:-1]
+    assert all("trace" not in s and "parts" not in s for s in pagina)
+    assert pagina[0]["cover"].endswith("/capa.png")
+    assert pagina[0]["coverPreview"] == {"color": "#000000"}
+
+    resto, fim = catalog.page(2, after=cursor)
+    assert [s["id"] for s in resto] == ids[:1] and fim is None
+    # A história completa continua disponível por id
+    assert "trace" in catalog.get(ids[0])
+
+
+def test_indice_e_gravado_uma_vez_por_rajada(tmp_path, monkeypatch):
+    catalog = api.StoryCatalog(str(tmp_path))
+    catalog.load()
+    gravacoes = []
+    monkeypatch.setattr(catalog, "_salvar_indice", lambda: gravacoes.append(1))
+
+    async def cenario():
+        for n in range(5):
+            catalog.add(f"20260101_00000{n}_0000000{n}_H", {"id": f"20260101_00000{n}_0000000{n}"})
+        assert gravacoes == []
+        catalog.flush()
+
+    asyncio.run(cenario())
+    assert gravacoes == [1]
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+from io import BytesIO
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import api
+
+BOUNDARY = "limite-de-teste"
+
+
+@pytest.fixture
+def personagens(tmp_path, monkeypatch):
+    store = api.CharacterStore(str(tmp_path / "characters"))
+    store.load()
+    monkeypatch.setattr(api, "character_store", store)
+    return store
+
+
+@pytest.fixture
+def cliente(personagens):
+    # Sem o `with`: o lifespan desligaria os pools de processos compartilhados pelos outros testes
+    return TestClient(api.app)
+
+
+def _foto(cor=(200, 30, 30), formato="PNG") -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (80, 60), cor).save(buffer, formato)
+    return buffer.getvalue()
+
+
+def _multipart(nome=None, fotos=(), boundary=BOUNDARY) -> bytes:
+    partes = []
+    if nome is not None:
+        partes.append(f'--{boundary}\r\nContent-Disposition: form-data; name="name"\r\n\r\n{nome}\r\n'.encode())
+    for i, foto in enumerate(fotos):
+        partes.append(f'--{boundary}\r\nContent-Disposition: form-data; name="photos"; filename="f{i}.png"\r\n'
+                      f'Content-Type: image/png\r\n\r\n'.encode() + foto + b"\r\n")
+    return b"".join(partes) + f"--{boundary}--\r\n".encode()
+
+
+def _post(cliente, corpo, content_type=f"multipart/form-data; boundary={BOUNDARY}"):
+    return cliente.post("/api/characters", content=corpo, headers={"Content-Type": content_type})
+
+
+def _post_em_pedacos(corpo: bytes, tamanho: int) -> tuple[int, dict]:
+    """POST direto no app ASGI com o corpo chegando em pedaços de `tamanho` bytes"""
+    pedacos = [corpo[i:i + tamanho] for i in range(0, len(corpo), tamanho)]
+    resposta = {"body": b""}
+
+    async def receive():
+        if pedacos:
+            pedaco = pedacos.pop(0)
+            return {"type": "http.request", "body": pedaco, "more_body": bool(pedacos)}
+        return {"type": "http.disconnect"}
+
+    async def send(mensagem):
+        if mensagem["type"] == "http.response.start":
+            resposta["status"] = mensagem["status"]
+        elif mensagem["type"] == "http.response.body":
+            resposta["body"] += mensagem.get("body", b"")
+
+    escopo = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+              "scheme": "http", "path": "/api/characters", "raw_path": b"/api/characters", "query_string": b"",
+              "root_path": "", "client": ("teste", 1), "server": ("teste", 80),
+              "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+                          (b"content-length", str(len(corpo)).encode())]}
+    asyncio.run(api.app(escopo, receive, send))
+    return resposta["status"], json.loads(resposta["body"])
+
+
+def test_registra_personagem(cliente, personagens):
+    resposta = _post(cliente, _multipart("Ana", [_foto(), _foto((0, 90, 200))]))
+    assert resposta.status_code == 201
+    dados = resposta.json()
+    assert dados["name"] == "Ana" and dados["photos"] == 2
+    personagem = personagens.get(dados["characterId"])
+    assert [os.path.exists(caminho) for _, caminho in personagens.photo_paths(personagem)] == [True, True]
+    # Nenhuma pasta de upload sobra
+    assert not [p for p in os.listdir(personagens.directory) if p.startswith(".upload-")]
+
+
+@pytest.mark.parametrize("tamanho", [1, 7, len(BOUNDARY) + 3, 1000])
+def test_boundary_dividido_entre_pedacos(personagens, tamanho):
+    corpo = _multipart("Ana", [_foto()])
+    inteiro, esperado = _post_em_pedacos(corpo, len(corpo))
+    status, dados = _post_em_pedacos(corpo, tamanho)
+    assert inteiro == status == 201
+    assert dados["characterId"] == esperado["characterId"]
+
+
+def test_mesmo_upload_devolve_o_mesmo_id(cliente, personagens):
+    corpo = _multipart("Ana", [_foto(), _foto()])  # foto repetida vira uma só
+    primeiro = _post(cliente, corpo).json()
+    segundo = _post(cliente, corpo).json()
+    assert primeiro["characterId"] == segundo["characterId"]
+    assert primeiro["photos"] == 1
+    assert [p for p in os.listdir(personagens.directory) if not p.startswith(".")] == [primeiro["characterId"]]
+    # Outro nome com as mesmas fotos é outro personagem
+    assert _post(cliente, _multipart("Bia", [_foto()])).json()["characterId"] != primeiro["characterId"]
+
+
+@pytest.mark.parametrize("content_type", [
+    "multipart/form-data",
+    "application/json",
+    "",
+])
+def test_sem_boundary_ou_sem_multipart(cliente, content_type):
+    assert _post(cliente, _multipart("Ana", [_foto()]), content_type).status_code == 415
+
+
+def test_boundary_diferente_do_corpo(cliente, personagens):
+    resposta = _post(cliente, _multipart("Ana", [_foto()], boundary="outro-limite"))
+    assert resposta.status_code == 400
+    assert not [p for p in os.listdir(personagens.directory) if not p.startswith(".")]
+
+
+def test_foto_acima_do_limite(cliente, personagens, monkeypatch):
+    monkeypatch.setattr(api, "MAX_PHOTO_MB", 1)
+    resposta = _post(cliente, _multipart("Ana", [b"\0" * (1024 * 1024 + 1)]))
+    assert resposta.status_code == 413
+    assert os.listdir(personagens.directory) == []
+
+
+def test_fotos_demais(cliente, monkeypatch):
+    monkeypatch.setattr(api, "MAX_CHARACTER_PHOTOS", 2)
+    resposta = _post(cliente, _multipart("Ana", [_foto((i, 0, 0)) for i in range(3)]))
+    assert resposta.status_code == 413
+
+
+def test_arquivo_que_nao_e_imagem(cliente, personagens):
+    resposta = _post(cliente, _multipart("Ana", [b"isto nao e uma imagem"]))
+    assert resposta.status_code == 422
+    assert os.listdir(personagens.directory) == []
+
+
+@pytest.mark.parametrize("corpo", [
+    _multipart("Ana", []),
+    _multipart(None, [b"x"]),
+    _multipart("   ", []),
+    b"",
+])
+def test_upload_vazio_ou_sem_nome(cliente, corpo):
+    assert _post(cliente, corpo).status_code in (400, 422)
@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+
+import api
+import benchmark
+from api import Character, StoryRequest, Universe
+
+
+class GeminiComImagensPresas(benchmark.FakeGemini):
+    """Imagens das partes 3 e 4 nunca terminam dentro do prazo"""
+
+    async def generate_content(self, model, contents, config=None):
+        if "parte 3 " in contents[0] or "parte 4 " in contents[0]:
+            await asyncio.sleep(60)
+        return await super().generate_content(model, contents, config)
+
+
+def _foto_b64() -> str:
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (10, 120, 200)).save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _eventos(sse):
+    return [json.loads(evento[len("data: "):]) for evento in sse]
+
+
+def test_prazo_esgotado_termina_com_as_imagens_prontas(tmp_path, monkeypatch):
+    monkeypatch.setattr(benchmark, "LADO_2K", 256)
+    monkeypatch.setattr(api, "client", GeminiComImagensPresas(latencia_texto=0.2, latencia_imagem=0.1, sigma=0))
+    monkeypatch.setattr(api, "STORIES_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "catalog", api.StoryCatalog(str(tmp_path)))
+    monkeypatch.setattr(api, "result_cache", api.ResultCache(str(tmp_path / ".cache"), 1 << 20))
+    criar_contexto = api.new_story_context
+    monkeypatch.setattr(api, "new_story_context", lambda use_cache=True: criar_contexto(use_cache, deadline=4.0))
+
+    request = StoryRequest(
+        characters=[Character(id="1", name="Ana", images=[_foto_b64()])],
+        universe=Universe(id="u", name="U", style="estilo"),
+        use_cache=False,
+    )
+
+    async def cenario():
+        api.catalog.load()
+        api.result_cache.load()
+        inicio = time.monotonic()
+        eventos = _eventos([evento async for evento in api.story_pipeline(request)])
+        return eventos, time.monotonic() - inicio
+
+    eventos, duracao = asyncio.run(cenario())
+    tipos = [e["type"] for e in eventos]
+    assert duracao < 15
+    assert tipos[-1] == "complete"
+    assert eventos[-1]["degraded"] is True
+
+    prontas = {e["imageId"] for e in eventos if e["type"] == "image_done"}
+    abandonadas = {e["imageId"] for e in eventos if e["type"] == "image_error"}
+    assert prontas == {"capa", "parte_1", "parte_2", "parte_5"}
+    assert abandonadas == {"parte_3", "parte_4"}
+
+    story = eventos[-1]["data"]
+    assert story["missingImages"] == ["parte_3", "parte_4"]
+    assert set(story["images"]) == prontas
+    with open(os.path.join(tmp_path, story["folder"], "story.json"), encoding="utf-8") as f:
+        assert json.load(f)["missingImages"] == ["parte_3", "parte_4"]
+
+
+def test_sem_historia_no_prazo_termina_com_erro(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "client", benchmark.FakeGemini(latencia_texto=30, sigma=0))
+    monkeypatch.setattr(api, "STORIES_DIR", str(tmp_path))
+    criar_contexto = api.new_story_context
+    monkeypatch.setattr(api, "new_story_context", lambda use_cache=True: criar_contexto(use_cache, deadline=1.5))
+
+    request = StoryRequest(universe=Universe(id="u", name="U", style="estilo"), use_cache=False)
+
+    async def cenario():
+        return _eventos([evento async for evento in api.story_pipeline(request)])
+
+    eventos = asyncio.run(cenario())
+    assert eventos[-1]["type"] == "error"
+    assert "prazo" in eventos[-1]["message"].lower()
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import os
+from io import BytesIO
+
+from PIL import Image
+
+import api
+
+
+def _png(largura=900, altura=600) -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (largura, altura), (200, 40, 40)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_image_done_nao_espera_os_derivados_responsivos(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "STORIES_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "catalog", api.StoryCatalog(str(tmp_path)))
+    monkeypatch.setattr(api, "derivative_builder", api.DerivativeBuilder())
+    pasta = tmp_path / "20260101_000000_abcd1234_Teste"
+    pasta.mkdir()
+
+    async def cenario():
+        api.catalog.load()
+        codificada = await api.codificar_imagem(_png(), "image/png", "capa", str(pasta))
+        # Já pronto para o image_done: PNG, versão web única e prévia
+        assert [v["file"] for v in codificada["derivatives"]] == ["capa.webp"]
+        assert codificada["preview"]["width"] == 900
+        story = {
+            "id": "20260101_000000_abcd1234",
+            "folder": pasta.name,
+            "createdAt": "2026-01-01T00:00:00",
+            "images": {"capa": f"/historias/{pasta.name}/capa.png"},
+            "derivatives": {"capa": api.derivative_urls(pasta.name, codificada["derivatives"])},
+        }
+        await api.save_story_json(str(pasta), story)
+        api.catalog.add(pasta.name, story)
+        await asyncio.gather(*api.derivative_builder._tarefas)
+
+    asyncio.run(cenario())
+    assert (pasta / "capa.png").exists() and (pasta / "capa.webp").exists()
+    with open(pasta / "story.json", encoding="utf-8") as f:
+        salvo = json.load(f)
+    larguras = sorted({v["width"] for v in salvo["derivatives"]["capa"]})
+    assert larguras == [400, 800, 900]
+    assert all(os.path.exists(pasta / os.path.basename(v["url"])) for v in salvo["derivatives"]["capa"])
+
+
+def test_codificacao_decodifica_a_imagem_uma_vez(tmp_path, monkeypatch):
+    abrir = api.Image.open
+    aberturas = []
+
+    def abrir_contando(*args, **kwargs):
+        aberturas.append(args[0])
+        return abrir(*args, **kwargs)
+
+    monkeypatch.setattr(api.Image, "open", abrir_contando)
+    codificada = api._encode_web(_png(), "image/png", str(tmp_path), "capa",
+                                 api.WEBP_MAX_SIDE, api.WEBP_QUALITY, api.PLACEHOLDER_SIDE)
+    assert len(aberturas) == 1
+    assert codificada["webp"]["file"] == "capa.webp"
+    assert codificada["preview"]["width"] == 900 and codificada["preview"]["height"] == 600
+    assert [nome for nome, _, _ in codificada["steps"]] == ["decode", "write_png", "write_webp", "preview"]
+    assert (tmp_path / "capa.png").read_bytes() == _png()
+
+
+def test_etapas_da_codificacao_entram_no_trace(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "derivative_builder", api.DerivativeBuilder())
+
+    async def cenario():
+        contexto = api.new_story_context()
+        api.contexto_historia.set(contexto)
+        await api.codificar_imagem(_png(), "image/png", "capa", str(tmp_path))
+        await asyncio.gather(*api.derivative_builder._tarefas)
+        return contexto["trace"].to_dict()["spans"]
+
+    spans = asyncio.run(cenario())
+    encode = next(s for s in spans if s["name"] == "encode")
+    filhos = [s for s in spans if s["parent"] == encode["id"]]
+    assert [s["name"] for s in filhos] == ["decode", "write_png", "write_webp", "preview"]
+    for filho in filhos:
+        assert encode["start"] - 0.01 <= filho["start"] <= filho["end"] <= encode["end"] + 0.01
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import pytest
+
+import api
+from api import HedgePolicy, call_with_hedge
+
+
+@pytest.fixture(autouse=True)
+def hedging_ligado(monkeypatch):
+    monkeypatch.setattr(api, "IMAGE_HEDGING", True)
+
+
+def _politica(latencia=0.05, amostras=api.HEDGE_MIN_SAMPLES):
+    politica = HedgePolicy()
+    for _ in range(amostras):
+        politica.record(latencia)
+    politica.requests = 100  # taxa de duplicação livre
+    return politica
+
+
+def _chamada(fila, modelo, chamadas, canceladas):
+    """Factory que espera `fila[n]` antes de despachar e `modelo[n]` no modelo"""
+    async def call_factory(despachada):
+        n = len(chamadas)
+        chamadas.append(n)
+        await asyncio.sleep(fila[n])
+        despachada()
+        inicio = time.time()
+        try:
+            await asyncio.sleep(modelo[n])
+        except asyncio.CancelledError:
+            canceladas.append(n)
+            raise
+        return f"resposta {n}", time.time() - inicio
+    return call_factory
+
+
+def test_limiar_usa_o_percentil_das_latencias():
+    politica = HedgePolicy()
+    for latencia in range(1, api.HEDGE_MIN_SAMPLES):
+        politica.record(float(latencia))
+    assert politica.threshold() is None
+    for latencia in range(api.HEDGE_MIN_SAMPLES, 101):
+        politica.record(float(latencia))
+    assert politica.threshold() == pytest.approx(91.0)
+
+
+def test_allow_respeita_a_taxa_maxima(monkeypatch):
+    monkeypatch.setattr(api, "HEDGE_MAX_RATE", 0.1)
+    politica = HedgePolicy()
+    assert not politica.allow()
+    politica.requests = 10
+    assert politica.allow()
+    politica.hedged = 1
+    assert not politica.allow()
+
+
+def test_sem_amostras_nao_duplica():
+    politica = HedgePolicy()
+    chamadas, canceladas = [], []
+    resultado = asyncio.run(call_with_hedge(_chamada([0], [0.01], chamadas, canceladas), "teste", politica))
+    assert resultado[0] == "resposta 0"
+    assert chamadas == [0]
+    assert list(politica._latencias) == [pytest.approx(resultado[1])]
+
+
+def test_espera_na_fila_nao_dispara_duplicacao():
+    politica = _politica()
+    chamadas, canceladas = [], []
+    resultado, latencia = asyncio.run(
+        call_with_hedge(_chamada([0.3], [0.01], chamadas, canceladas), "teste", politica))
+    assert resultado == "resposta 0"
+    assert chamadas == [0]
+    assert politica.hedged == 0
+    # Registra só o tempo do modelo, não os 0.3s na fila
+    assert latencia < 0.1
+    assert max(politica._latencias) < 0.1
+
+
+def test_copia_vence_e_original_e_cancelada():
+    politica = _politica()
+    chamadas, canceladas = [], []
+    resultado, latencia = asyncio.run(
+        call_with_hedge(_chamada([0, 0], [5, 0.01], chamadas, canceladas), "teste", politica))
+    assert resultado == "resposta 1"
+    assert chamadas == [0, 1]
+    assert canceladas == [0]
+    assert politica.hedged == 1
+    # As duas entram no percentil: a vencedora e a original com o que já tinha rodado
+    novas = list(politica._latencias)[api.HEDGE_MIN_SAMPLES:]
+    assert len(novas) == 2
+    assert novas[0] == pytest.approx(latencia)
+    assert novas[1] >= 0.05
+
+
+def test_original_vence_e_copia_e_cancelada():
+    politica = _politica()
+    chamadas, canceladas = [], []
+    resultado, _ = asyncio.run(
+        call_with_hedge(_chamada([0, 0], [0.15, 5], chamadas, canceladas), "teste", politica))
+    assert resultado == "resposta 0"
+    assert canceladas == [1]
+
+
+def test_sem_orcamento_nao_duplica():
+    politica = _politica()
+    politica.requests, politica.hedged = 0, 1
+    chamadas, canceladas = [], []
+    resultado, _ = asyncio.run(
+        call_with_hedge(_chamada([0], [0.2], chamadas, canceladas), "teste", politica))
+    assert resultado == "resposta 0"
+    assert chamadas == [0]
+    assert politica.hedged == 1
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import historia
+
+
+@pytest.fixture
+def pasta_de_trabalho(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(historia, "pastas_em_uso", set())
+    return tmp_path
+
+
+def _incompleta(titulo, entrada):
+    pasta = historia.criar_pasta_historia(titulo)
+    historia.salvar_manifesto(pasta, historia.novo_manifesto(*entrada))
+    return pasta
+
+
+def test_historias_iguais_no_lote_nao_retomam_a_mesma_pasta(pasta_de_trabalho):
+    entrada = ("Ana", "Uma aventura", "Marte")
+    pasta = _incompleta("Aventura", entrada)
+    assert historia.encontrar_historia_incompleta(*entrada) == pasta
+
+    reservadas = set()
+    historia.reservar_pasta(pasta, reservadas)
+    # A segunda história com a mesma entrada começa do zero
+    assert historia.encontrar_historia_incompleta(*entrada) is None
+    assert historia.criar_pasta_historia("Aventura") != pasta
+    with pytest.raises(ValueError):
+        historia.reservar_pasta(pasta, set())
+
+    historia.pastas_em_uso.difference_update(reservadas)
+    assert historia.encontrar_historia_incompleta(*entrada) == pasta
+
+
+def test_pipeline_libera_a_pasta_ao_terminar(pasta_de_trabalho, monkeypatch):
+    entrada = ("Ana", "Uma aventura", "Marte")
+    pasta = _incompleta("Aventura", entrada)
+    vistas = []
+
+    async def pipeline_falso(nome, descricao, universo, pasta_fotos, pasta_retomada, progressivo, prazo, reservadas):
+        pasta_retomada = historia.encontrar_historia_incompleta(nome, descricao, universo)
+        historia.reservar_pasta(pasta_retomada, reservadas)
+        vistas.append(set(historia.pastas_em_uso))
+        raise RuntimeError("falha no meio")
+
+    monkeypatch.setattr(historia, "_pipeline_principal", pipeline_falso)
+    with pytest.raises(RuntimeError):
+        asyncio.run(historia.pipeline_principal(*entrada))
+    assert vistas == [{pasta}]
+    assert historia.pastas_em_uso == set()
+
+
+def test_derivados_de_uma_historia_nao_param_o_lote(pasta_de_trabalho, monkeypatch):
+    derivando = {}
+    marcas_b = []
+
+    async def gerar_json_falso(nome, descricao, universo, ao_receber_campo=None):
+        if nome == "B":
+            # Texto lento da segunda história: cada volta precisa do event loop
+            for _ in range(30):
+                await asyncio.sleep(0.05)
+                marcas_b.append(time.monotonic())
+        return {"title": f"Aventura {nome}", "usuario": nome, "universo": universo,
+                "cover_prompt": "capa", "partes": [["texto", "prompt"]]}
+
+    async def imagens_falsas(dados_historia, pasta_fotos, iniciadas, pasta, manifesto, qualidade):
+        return pasta
+
+    def derivados_lentos(pasta, manifesto=None, pool=None):
+        inicio = time.monotonic()
+        time.sleep(0.6)
+        derivando[pasta] = (inicio, time.monotonic())
+        manifesto["web"] = {}
+        return {}
+
+    monkeypatch.setattr(historia, "gerar_json_historia", gerar_json_falso)
+    monkeypatch.setattr(historia, "executar_geracao_imagens", imagens_falsas)
+    monkeypatch.setattr(historia, "gerar_derivados", derivados_lentos)
+
+    async def lote():
+        return await asyncio.gather(
+            historia.pipeline_principal("A", "Uma aventura", "Marte", "fotos", progressivo=False, prazo=0),
+            historia.pipeline_principal("B", "Outra aventura", "Marte", "fotos", progressivo=False, prazo=0),
+        )
+
+    a, b = asyncio.run(lote())
+    inicio, fim = derivando[a["pasta"]]
+    # A segunda história continuou andando enquanto a primeira gerava os derivados
+    assert sum(inicio < t < fim for t in marcas_b) >= 3
+    assert os.path.exists(os.path.join(a["pasta"], "index.html"))
+    assert os.path.exists(os.path.join(b["pasta"], "index.html"))
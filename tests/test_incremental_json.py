@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import api
+import historia
+
+DOCUMENTO = {
+    "title": "O \"Grande\" Dia",
+    "cover_prompt": "Capa épica\ncom barra \\ e unicode ✨",
+    "parts": [[f"Texto {n}", f"Prompt {n}"] for n in range(1, 6)],
+}
+
+PARSERS = pytest.mark.parametrize("parser_cls", [api.IncrementalJSONParser, historia.IncrementalJSONParser],
+                                  ids=["api", "historia"])
+
+
+def _campos(parser_cls, pedacos):
+    recebidos = []
+    parser = parser_cls(lambda caminho, valor: recebidos.append((caminho, valor)))
+    for pedaco in pedacos:
+        parser.feed(pedaco)
+    return recebidos
+
+
+def _esperado():
+    return [(("title",), DOCUMENTO["title"]), (("cover_prompt",), DOCUMENTO["cover_prompt"])] + [
+        (("parts", i, j), valor) for i, parte in enumerate(DOCUMENTO["parts"]) for j, valor in enumerate(parte)
+    ]
+
+
+@PARSERS
+def test_documento_inteiro(parser_cls):
+    assert _campos(parser_cls, [json.dumps(DOCUMENTO, ensure_ascii=False, indent=2)]) == _esperado()
+
+
+@PARSERS
+@pytest.mark.parametrize("tamanho", [1, 3, 17])
+def test_pedacos_cortam_strings_e_escapes(parser_cls, tamanho):
+    texto = json.dumps(DOCUMENTO, ensure_ascii=False)
+    pedacos = [texto[i:i + tamanho] for i in range(0, len(texto), tamanho)]
+    assert _campos(parser_cls, pedacos) == _esperado()
+
+
+@PARSERS
+def test_campo_avisado_assim_que_fecha(parser_cls):
+    recebidos = []
+    parser = parser_cls(lambda caminho, valor: recebidos.append(caminho))
+    parser.feed('{"title": "Um título", "cover_prompt": "Uma ca')
+    assert recebidos == [("title",)]
+    parser.feed('pa", "parts": [["Texto 1", "Prom')
+    assert recebidos == [("title",), ("cover_prompt",), ("parts", 0, 0)]
+    parser.feed('pt 1"]')
+    assert recebidos[-1] == ("parts", 0, 1)
+
+
+@PARSERS
+def test_valores_que_nao_sao_string_nao_atrapalham(parser_cls):
+    texto = '{"n": 3, "ok": true, "nada": null, "lista": [1, {"x": "y"}, [2.5]], "title": "T"}'
+    assert _campos(parser_cls, [texto]) == [(("lista", 1, "x"), "y"), (("title",), "T")]
@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+from api import JobQueue, StoryRequest, Universe, send_event
+
+PEDIDO = StoryRequest(universe=Universe(id="u", name="U", style="estilo"))
+
+
+def _tipo(evento: str) -> str:
+    return json.loads(evento.split("data: ", 1)[1])["type"]
+
+
+async def _ler(fila, job_id, after, quantos):
+    """Os primeiros `quantos` eventos a partir de `after`, como (seq, tipo)"""
+    lidos = []
+    eventos = fila.events(job_id, after)
+    try:
+        async for evento in eventos:
+            seq, dados = evento.split("\n", 1)
+            lidos.append((int(seq[len("id: "):]), _tipo(dados)))
+            if len(lidos) == quantos:
+                break
+    finally:
+        await eventos.aclose()
+    return lidos
+
+
+def test_replay_a_partir_do_last_event_id(tmp_path):
+    async def cenario():
+        # Sem workers: os jobs ficam na fila e os eventos são gravados à mão
+        fila = JobQueue(str(tmp_path / "jobs.db"), 0, 10)
+        fila.open()
+        job_id = fila.submit("chave", PEDIDO)
+        for tipo in ("stage", "image_start", "image_done"):
+            fila.append(job_id, send_event(tipo, {}))
+        todos = await _ler(fila, job_id, 0, 4)
+        depois = await _ler(fila, job_id, 2, 2)
+        await fila.close()
+        return todos, depois
+
+    todos, depois = asyncio.run(cenario())
+    assert todos == [(1, "queued"), (2, "stage"), (3, "image_start"), (4, "image_done")]
+    assert depois == [(3, "image_start"), (4, "image_done")]
+
+
+def test_job_retomado_nao_repete_eventos_antigos(tmp_path):
+    caminho = str(tmp_path / "jobs.db")
+
+    async def interrompido():
+        fila = JobQueue(caminho, 0, 10)
+        fila.open()
+        job_id = fila.submit("chave", PEDIDO)
+        assert fila._claim()[0] == job_id  # rodando quando o servidor cai
+        for tipo in ("stage", "image_start", "image_done"):
+            fila.append(job_id, send_event(tipo, {}))
+        ultimo = fila.last_seq(job_id)
+        await fila.close()
+        return job_id, ultimo
+
+    async def reinicio(job_id, ultimo):
+        fila = JobQueue(caminho, 0, 10)
+        fila.open()
+        status = fila.status(job_id)
+        do_inicio = await _ler(fila, job_id, 0, 1)
+        reconectando = await _ler(fila, job_id, ultimo - 1, 1)
+        fila.append(job_id, send_event("image_start", {}))
+        novos = await _ler(fila, job_id, ultimo + 1, 1)
+        await fila.close()
+        return status, do_inicio, reconectando, novos
+
+    job_id, ultimo = asyncio.run(interrompido())
+    status, do_inicio, reconectando, novos = asyncio.run(reinicio(job_id, ultimo))
+    assert status == "queued"
+    # Só o aviso sobra da execução anterior, com o seq seguinte ao último
+    assert do_inicio == reconectando == [(ultimo + 1, "requeued")]
+    assert novos == [(ultimo + 2, "image_start")]
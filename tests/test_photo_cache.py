@@ -0,0 +1,77 @@
+import asyncio
+import base64
+
+from api import ReferencePhotoCache
+
+FOTO = base64.b64encode(b"foto de referencia").decode("ascii")
+
+
+def test_leitura_compartilhada_e_cache():
+    async def cenario():
+        cache = ReferencePhotoCache(1024 * 1024)
+        chave = cache.key(FOTO)
+        cargas = []
+
+        async def carregar():
+            cargas.append(1)
+            await asyncio.sleep(0.01)
+            return b"jpeg"
+
+        resultados = await asyncio.gather(*(cache._obter(chave, carregar) for _ in range(3)))
+        await cache._obter(chave, carregar)
+        return cargas, resultados
+
+    cargas, resultados = asyncio.run(cenario())
+    assert len(cargas) == 1
+    assert all(foto.inline_data.data == b"jpeg" for _, foto in resultados)
+
+
+def test_cancelar_quem_carrega_nao_prende_quem_aguarda():
+    async def cenario():
+        cache = ReferencePhotoCache(1024 * 1024)
+        chave = cache.key(FOTO)
+        liberar = asyncio.Event()
+
+        async def carga_lenta():
+            await liberar.wait()
+            return b"lenta"
+
+        async def carga_rapida():
+            return b"rapida"
+
+        primeira = asyncio.create_task(cache._obter(chave, carga_lenta))
+        await asyncio.sleep(0)
+        segunda = asyncio.create_task(cache._obter(chave, carga_rapida))
+        await asyncio.sleep(0)
+        primeira.cancel()
+        _, foto = await asyncio.wait_for(segunda, timeout=1)
+        assert primeira.cancelled()
+        return foto, cache
+
+    foto, cache = asyncio.run(cenario())
+    assert foto.inline_data.data == b"rapida"
+    assert not cache._em_andamento
+
+
+def test_cancelar_quem_aguarda_nao_afeta_a_carga():
+    async def cenario():
+        cache = ReferencePhotoCache(1024 * 1024)
+        chave = cache.key(FOTO)
+        liberar = asyncio.Event()
+
+        async def carregar():
+            await liberar.wait()
+            return b"jpeg"
+
+        primeira = asyncio.create_task(cache._obter(chave, carregar))
+        await asyncio.sleep(0)
+        segunda = asyncio.create_task(cache._obter(chave, carregar))
+        await asyncio.sleep(0)
+        segunda.cancel()
+        await asyncio.sleep(0)
+        liberar.set()
+        _, foto = await primeira
+        assert segunda.cancelled()
+        return foto
+
+    assert asyncio.run(cenario()).inline_data.data == b"jpeg"
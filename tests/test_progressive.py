@@ -0,0 +1,93 @@
+import asyncio
+import base64
+import json
+import os
+from io import BytesIO
+
+import httpx
+from google.genai import errors as genai_errors
+from PIL import Image
+
+import api
+import benchmark
+from api import Character, StoryRequest, Universe
+
+
+class GeminiSemFinalDaParte3(benchmark.FakeGemini):
+    """Rascunhos rápidos, finais lentos; a versão final da parte 3 sempre falha"""
+
+    async def generate_content(self, model, contents, config=None):
+        if "flash-image" not in model and "parte 3 " in contents[0]:
+            await asyncio.sleep(0.05)
+            raise genai_errors.ClientError(400, {"error": {"code": 400, "message": "recusada", "status": "X"}})
+        return await super().generate_content(model, contents, config)
+
+
+def _foto_b64() -> str:
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (10, 120, 200)).save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def test_rascunho_e_depois_versao_final(api_isolada, monkeypatch):
+    monkeypatch.setattr(api, "client", GeminiSemFinalDaParte3(latencia_texto=0.1, latencia_rascunho=0.02,
+                                                              latencia_imagem=0.5, sigma=0))
+    request = StoryRequest(
+        characters=[Character(id="1", name="Ana", images=[_foto_b64()])],
+        universe=Universe(id="u", name="U", style="estilo"),
+        use_cache=False,
+        progressive=True,
+    )
+
+    async def cenario():
+        api.catalog.load()
+        api.result_cache.load()
+        eventos = [json.loads(e[len("data: "):]) async for e in api.story_pipeline(request)]
+        # O que o StoryViewer busca enquanto havia versões finais a caminho
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://teste") as cliente:
+            story_id = next(e for e in eventos if e["type"] == "complete")["data"]["id"]
+            lida = (await cliente.get(f"/api/stories/{story_id}")).json()
+        return eventos, lida
+
+    eventos, lida = asyncio.run(cenario())
+    tipos = [e["type"] for e in eventos]
+    ids = ["capa", *(f"parte_{i}" for i in range(1, 6))]
+    rascunhos = {e["imageId"]: (n, e) for n, e in enumerate(eventos) if e["type"] == "image_done"}
+    finais = {e["imageId"]: (n, e) for n, e in enumerate(eventos) if e["type"] == "image_upgraded"}
+    completo = tipos.index("complete")
+
+    # Cada imagem chega primeiro em rascunho, com o nome simples
+    assert set(rascunhos) == set(ids)
+    for id_img, (_, evento) in rascunhos.items():
+        assert evento["quality"] == "draft"
+        assert evento["imageUrl"].endswith(f"/{id_img}.png")
+
+    # A versão final vem depois, com outro nome (_v2); a da parte 3 falhou e não chega
+    assert set(finais) == set(ids) - {"parte_3"}
+    for id_img, (n, evento) in finais.items():
+        assert n > rascunhos[id_img][0]
+        assert evento["quality"] == "final"
+        assert evento["imageUrl"].endswith(f"/{id_img}_v2.png")
+    assert "image_error" not in tipos
+
+    # O livro fica pronto com os rascunhos, e as finais chegam depois do complete
+    assert eventos[completo]["data"]["upgrading"]
+    # O trace fica só no story.json, fora do que o front guarda
+    assert "trace" not in eventos[completo]["data"]
+    assert any(n > completo for n, _ in finais.values())
+    assert tipos[-1] == "image_upgraded"
+
+    # No fim, o cliente que busca a história vê as finais e o rascunho no lugar da que falhou
+    pasta = os.path.join(api_isolada, lida["folder"])
+    with open(os.path.join(pasta, "story.json"), encoding="utf-8") as f:
+        salvo = json.load(f)
+    assert salvo["trace"]["spans"]
+    for story in (lida, salvo):
+        assert story["upgrading"] == []
+        assert story["images"]["parte_3"].endswith("/parte_3.png")
+        assert story["imageQuality"]["parte_3"] == "draft"
+        for id_img in set(ids) - {"parte_3"}:
+            assert story["images"][id_img] == finais[id_img][1]["imageUrl"]
+            assert story["imageQuality"][id_img] == "final"
+    assert os.path.exists(os.path.join(pasta, "parte_3.png"))
+    assert not os.path.exists(os.path.join(pasta, "parte_3_v2.png"))
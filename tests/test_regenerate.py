@@ -0,0 +1,133 @@
+import asyncio
+import base64
+import json
+import os
+from io import BytesIO
+
+import httpx
+import pytest
+from PIL import Image
+
+import api
+from api import Character, StoryRequest, Universe
+
+
+def _foto_b64() -> str:
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (10, 120, 200)).save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+async def _criar_historia() -> dict:
+    """Roda o pipeline com o FakeGemini e devolve a história do evento complete"""
+    api.catalog.load()
+    api.result_cache.load()
+    request = StoryRequest(
+        characters=[Character(id="1", name="Ana", images=[_foto_b64()])],
+        universe=Universe(id="u", name="U", style="estilo"),
+        use_cache=False,
+    )
+    eventos = [json.loads(e[len("data: "):]) async for e in api.story_pipeline(request)]
+    assert eventos[-1]["type"] == "complete"
+    return eventos[-1]["data"]
+
+
+def _cliente():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://teste")
+
+
+def _story_json(pasta, story) -> dict:
+    with open(os.path.join(pasta, story["folder"], "story.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _regenerar(cliente, story_id, id_img):
+    if id_img == "capa":
+        return cliente.post(f"/api/stories/{story_id}/cover/regenerate")
+    return cliente.post(f"/api/stories/{story_id}/parts/{id_img.split('_')[1]}/regenerate")
+
+
+def test_versoes_sobem_e_story_json_e_catalogo_acompanham(api_isolada):
+    async def cenario():
+        story = await _criar_historia()
+        async with _cliente() as cliente:
+            primeira = (await _regenerar(cliente, story["id"], "parte_2")).json()
+            segunda = (await _regenerar(cliente, story["id"], "parte_2")).json()
+            capa = (await _regenerar(cliente, story["id"], "capa")).json()
+            lida = (await cliente.get(f"/api/stories/{story['id']}")).json()
+            lista = (await cliente.get("/api/stories")).json()
+        return story, primeira, segunda, capa, lida, lista
+
+    story, primeira, segunda, capa, lida, lista = asyncio.run(cenario())
+    pasta = os.path.join(api_isolada, story["folder"])
+    assert primeira["imageUrl"].endswith("/parte_2_v2.png")
+    assert segunda["imageUrl"].endswith("/parte_2_v3.png")
+    assert capa["imageUrl"].endswith("/capa_v2.png")
+    # As versões antigas continuam no disco: são servidas como imutáveis
+    for nome in ("parte_2.png", "parte_2_v2.png", "parte_2_v3.png", "capa.png", "capa_v2.png"):
+        assert os.path.exists(os.path.join(pasta, nome))
+
+    # Cada regeneração parte da versão anterior: nenhuma troca se perde
+    esperado = {"parte_2": segunda["imageUrl"], "capa": capa["imageUrl"]}
+    for fonte in (_story_json(api_isolada, story)["images"], api.catalog.get(story["id"])["images"],
+                  lida["images"], capa["story"]["images"]):
+        assert {k: fonte[k] for k in esperado} == esperado
+        assert fonte["parte_1"] == story["images"]["parte_1"]
+    assert segunda["story"]["images"]["parte_2"] == segunda["imageUrl"]
+    assert "trace" not in segunda["story"]
+    assert all(url.startswith(f"/historias/{story['folder']}/parte_2_v3") for url in
+               [d["url"] for d in lida["derivatives"]["parte_2"]])
+    # O resumo da listagem também vê a capa nova
+    resumo = next(s for s in lista["stories"] if s["id"] == story["id"])
+    assert resumo["cover"] == capa["imageUrl"]
+
+
+def test_regeneracoes_simultaneas(api_isolada):
+    async def cenario():
+        story = await _criar_historia()
+        async with _cliente() as cliente:
+            mesma = await asyncio.gather(*(_regenerar(cliente, story["id"], "parte_4") for _ in range(2)))
+            diferentes = await asyncio.gather(*(_regenerar(cliente, story["id"], i)
+                                                for i in ("parte_1", "parte_3", "capa")))
+        return story, mesma, diferentes
+
+    story, mesma, diferentes = asyncio.run(cenario())
+    # A mesma imagem duas vezes ao mesmo tempo: uma é recusada
+    assert sorted(r.status_code for r in mesma) == [200, 409]
+    # Imagens diferentes ao mesmo tempo: todas ficam no story.json
+    assert [r.status_code for r in diferentes] == [200, 200, 200]
+    salvo = _story_json(api_isolada, story)["images"]
+    for resposta in [*diferentes, *(r for r in mesma if r.status_code == 200)]:
+        dados = resposta.json()
+        assert salvo[dados["imageId"]] == dados["imageUrl"]
+        assert api.catalog.get(story["id"])["images"][dados["imageId"]] == dados["imageUrl"]
+
+
+@pytest.mark.parametrize("caminho, status", [
+    ("/api/stories/nao_existe/cover/regenerate", 404),
+    ("/api/stories/{id}/parts/9/regenerate", 404),
+    ("/api/stories/{id}/parts/0/regenerate", 404),
+])
+def test_historia_ou_capitulo_inexistente(api_isolada, caminho, status):
+    async def cenario():
+        story = await _criar_historia()
+        async with _cliente() as cliente:
+            return (await cliente.post(caminho.format(id=story["id"]))).status_code
+
+    assert asyncio.run(cenario()) == status
+
+
+def test_sem_fotos_de_referencia(api_isolada):
+    async def cenario():
+        story = await _criar_historia()
+        for personagem in story["characters"]:
+            api.character_store._personagens.clear()
+            os.rename(os.path.join(api.character_store.directory, personagem["id"]),
+                      os.path.join(api_isolada, f"removido_{personagem['id']}"))
+        async with _cliente() as cliente:
+            return story, await _regenerar(cliente, story["id"], "parte_1")
+
+    story, resposta = asyncio.run(cenario())
+    assert resposta.status_code == 409
+    # Nada muda quando a regeneração é recusada
+    assert _story_json(api_isolada, story)["images"] == story["images"]
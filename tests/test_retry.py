@@ -0,0 +1,199 @@
+import asyncio
+import json
+import random
+import time
+
+import httpx
+import pytest
+from google.genai import errors as genai_errors
+
+import api
+import historia
+
+
+def _erro(classe_erro, codigo, retry_after=None, retry_delay=None):
+    corpo = {"error": {"code": codigo, "message": "falha", "status": "X", "details": []}}
+    if retry_delay is not None:
+        corpo["error"]["details"].append({"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                          "retryDelay": retry_delay})
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    return classe_erro(codigo, corpo, httpx.Response(codigo, headers=headers))
+
+
+def _json_invalido():
+    try:
+        json.loads("{")
+    except json.JSONDecodeError as e:
+        return e
+
+
+class Implementacao:
+    """Adapta api.py e historia.py (mesma política, nomes diferentes) para os mesmos testes"""
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.api = nome == "api"
+
+    def classificar(self, e):
+        return api.classify_error(e) if self.api else historia.classificar_erro(e)
+
+    def dica(self, e):
+        return api.retry_hint(e) if self.api else historia.dica_de_espera(e)
+
+    @property
+    def seguranca(self):
+        return api.SafetyBlockError if self.api else historia.BloqueioSegurancaError
+
+    @property
+    def prazo(self):
+        return api.DeadlineExceeded if self.api else historia.PrazoEsgotadoError
+
+    @property
+    def classe_prazo(self):
+        return "deadline" if self.api else "prazo"
+
+    def tentativas(self, classe):
+        if self.api:
+            return api.RETRY_POLICY[classe]["attempts"]
+        return historia.POLITICA_RETRY[classe]["tentativas"]
+
+    def base(self, classe):
+        return (api.RETRY_POLICY if self.api else historia.POLITICA_RETRY)[classe]["base"]
+
+    def executar(self, func, orcamento=None, prazo=None):
+        """Roda func com retry dentro de uma história com `orcamento` retentativas e `prazo` segundos"""
+        async def cenario():
+            if self.api:
+                contexto = api.new_story_context(deadline=prazo or 3600)
+                if orcamento is not None:
+                    contexto["retryBudget"] = orcamento
+                api.contexto_historia.set(contexto)
+                return await api.retry_with_backoff(func, operation_name="teste"), contexto["retries"]
+            estado = {"restante": historia.ORCAMENTO_RETRY_HISTORIA if orcamento is None else orcamento,
+                      "retries": {}, "rastro": historia.Rastro(),
+                      "prazo": time.monotonic() + prazo if prazo else None}
+            historia.orcamento_historia.set(estado)
+            return await historia.com_retentativas_async(func, nome_operacao="teste"), estado["retries"]
+        return asyncio.run(cenario())
+
+
+@pytest.fixture(params=["api", "historia"])
+def impl(request):
+    return Implementacao(request.param)
+
+
+@pytest.fixture
+def esperas(monkeypatch):
+    """Troca o asyncio.sleep do backoff por um registro das esperas"""
+    registradas = []
+    dormir = asyncio.sleep
+
+    async def sleep_falso(segundos, *args, **kwargs):
+        registradas.append(segundos)
+        await dormir(0)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep_falso)
+    return registradas
+
+
+def _falhando(erros, resultado="ok"):
+    """Função que levanta os erros em sequência e depois devolve `resultado`"""
+    chamadas = []
+
+    async def func():
+        chamadas.append(len(chamadas))
+        if len(chamadas) <= len(erros):
+            raise erros[len(chamadas) - 1]
+        return resultado
+    return func, chamadas
+
+
+@pytest.mark.parametrize("erro, classe", [
+    (lambda: _erro(genai_errors.ClientError, 429), "rate_limit"),
+    (lambda: RuntimeError("RESOURCE_EXHAUSTED: quota"), "rate_limit"),
+    (lambda: _erro(genai_errors.ServerError, 500), "transient"),
+    (lambda: _erro(genai_errors.ServerError, 503), "transient"),
+    (lambda: TimeoutError("sem resposta"), "transient"),
+    (lambda: ConnectionResetError(), "transient"),
+    (lambda: _erro(genai_errors.ClientError, 400), "validation"),
+    (lambda: _erro(genai_errors.ClientError, 403), "validation"),
+    (lambda: _erro(genai_errors.ClientError, 404), "validation"),
+    (_json_invalido, "validation"),
+])
+def test_classificacao(impl, erro, classe):
+    assert impl.classificar(erro()) == classe
+
+
+def test_classificacao_de_seguranca_e_prazo(impl):
+    assert impl.classificar(impl.seguranca("bloqueada")) == "safety"
+    assert impl.classificar(impl.prazo("acabou")) == impl.classe_prazo
+
+
+@pytest.mark.parametrize("erro, dica", [
+    (lambda: _erro(genai_errors.ClientError, 429, retry_after="7"), 7.0),
+    (lambda: _erro(genai_errors.ClientError, 429, retry_delay="3s"), 3.0),
+    (lambda: _erro(genai_errors.ClientError, 429, retry_after="7", retry_delay="3s"), 3.0),
+    (lambda: _erro(genai_errors.ClientError, 429, retry_after="Wed, 21 Oct 2026 07:28:00 GMT"), None),
+    (lambda: _erro(genai_errors.ServerError, 503), None),
+    (lambda: RuntimeError("503"), None),
+])
+def test_dica_de_espera(impl, erro, dica):
+    assert impl.dica(erro()) == dica
+
+
+def test_retry_after_e_respeitado(impl, esperas):
+    func, chamadas = _falhando([_erro(genai_errors.ClientError, 429, retry_after="7")])
+    resultado, retries = impl.executar(func)
+    assert resultado == "ok"
+    assert len(chamadas) == 2
+    assert retries == {"rate_limit": 1}
+    # A dica do servidor mais um jitter de até `base`
+    assert 7.0 <= esperas[0] <= 7.0 + impl.base("rate_limit")
+
+
+def test_backoff_exponencial_com_teto(impl, esperas):
+    random.seed(1)
+    erros = [_erro(genai_errors.ServerError, 503)] * (impl.tentativas("transient") - 1)
+    func, chamadas = _falhando(erros)
+    assert impl.executar(func)[0] == "ok"
+    assert len(esperas) == len(erros)
+    for n, espera in enumerate(esperas, 1):
+        assert 0 <= espera <= min(20.0, 1.0 * 2 ** (n - 1))
+
+
+@pytest.mark.parametrize("classe, erro", [
+    ("transient", lambda: _erro(genai_errors.ServerError, 503)),
+    ("rate_limit", lambda: _erro(genai_errors.ClientError, 429)),
+    ("validation", lambda: _erro(genai_errors.ClientError, 400)),
+])
+def test_desiste_depois_das_tentativas_da_classe(impl, esperas, classe, erro):
+    func, chamadas = _falhando([erro() for _ in range(10)])
+    with pytest.raises(genai_errors.APIError):
+        impl.executar(func)
+    assert len(chamadas) == impl.tentativas(classe)
+
+
+def test_bloqueio_de_seguranca_nao_repete(impl, esperas):
+    func, chamadas = _falhando([impl.seguranca("bloqueada")])
+    with pytest.raises(impl.seguranca):
+        impl.executar(func)
+    assert chamadas == [0]
+    assert esperas == []
+
+
+def test_orcamento_da_historia_esgotado(impl, esperas):
+    func, chamadas = _falhando([_erro(genai_errors.ServerError, 503) for _ in range(10)])
+    esperado = api.RetryBudgetExceeded if impl.api else genai_errors.ServerError
+    with pytest.raises(esperado):
+        impl.executar(func, orcamento=2)
+    # Duas novas tentativas e a terceira falha encerra, antes do limite da classe (4)
+    assert len(chamadas) == 3
+    assert len(esperas) == 2
+
+
+def test_espera_alem_do_prazo_desiste_na_hora(impl, esperas):
+    func, chamadas = _falhando([_erro(genai_errors.ClientError, 429, retry_after="30")])
+    with pytest.raises(impl.prazo):
+        impl.executar(func, prazo=5)
+    assert chamadas == [0]
+    assert esperas == []
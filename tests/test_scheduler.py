@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import api
+from api import AdaptiveLimit, FairLane
+
+
+@pytest.fixture(autouse=True)
+def sem_cooldown(monkeypatch):
+    # Sem o intervalo mínimo entre cortes, cada pico corta na hora
+    monkeypatch.setattr(api, "AIMD_COOLDOWN", 0.0)
+
+
+def test_limite_cresce_com_chamadas_saudaveis():
+    limite = AdaptiveLimit(4, 1, 8)
+    for _ in range(40):
+        limite.on_success(1.0)
+    assert limite.current == 8
+    assert limite.latency_avg == pytest.approx(1.0)
+
+
+def test_limite_nunca_passa_dos_extremos():
+    limite = AdaptiveLimit(2, 1, 8)
+    for _ in range(10):
+        limite.on_rate_limit()
+    assert limite.current == 1
+
+
+def test_pico_isolado_corta_o_limite():
+    limite = AdaptiveLimit(8, 1, 16)
+    for _ in range(10):
+        limite.on_success(1.0)
+    antes = limite.value
+    limite.on_success(5.0)
+    assert limite.value == pytest.approx(antes * api.AIMD_BACKOFF_LATENCY)
+
+
+def test_mudanca_duradoura_de_latencia_vira_a_nova_referencia():
+    limite = AdaptiveLimit(8, 1, 16)
+    for _ in range(api.AIMD_WINDOW):
+        limite.on_success(1.0)
+    # A latência do modelo triplica e fica assim
+    for _ in range(api.AIMD_WINDOW * 3):
+        limite.on_success(3.0)
+    assert limite.baseline == pytest.approx(3.0)
+    assert limite.latency_avg == pytest.approx(3.0)
+    # Depois de algumas quedas, o limite volta a subir em vez de ficar no mínimo
+    assert limite.current > 8
+
+
+def test_fair_lane_reparte_as_vagas_em_round_robin():
+    async def cenario():
+        lane = FairLane(AdaptiveLimit(1, 1, 1))
+        ordem = []
+
+        async def chamada(historia, n):
+            await lane.acquire(historia)
+            ordem.append((historia, n))
+            await asyncio.sleep(0)
+            lane.release()
+
+        await lane.acquire("ocupada")
+        tarefas = [asyncio.create_task(chamada("a", n)) for n in range(3)]
+        tarefas += [asyncio.create_task(chamada("b", n)) for n in range(3)]
+        await asyncio.sleep(0)
+        assert lane.waiting == 6
+        lane.release()
+        await asyncio.gather(*tarefas)
+        return ordem, lane
+
+    ordem, lane = asyncio.run(cenario())
+    assert [historia for historia, _ in ordem] == ["a", "b", "a", "b", "a", "b"]
+    assert lane.in_flight == 0 and lane.waiting == 0
+
+
+def test_fair_lane_cancelamento_na_fila_nao_perde_vaga():
+    async def cenario():
+        lane = FairLane(AdaptiveLimit(1, 1, 1))
+        await lane.acquire("a")
+        esperando = asyncio.create_task(lane.acquire("b"))
+        await asyncio.sleep(0)
+        esperando.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await esperando
+        lane.release()
+        return lane
+
+    lane = asyncio.run(cenario())
+    assert lane.in_flight == 0 and lane.waiting == 0
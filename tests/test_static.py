@@ -0,0 +1,118 @@
+import gzip
+import json
+import os
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+
+CONTEUDO_IMAGEM = bytes(range(256)) * 8
+
+
+@pytest.fixture
+def historia():
+    """Pasta de história com uma imagem e um story.json pré-comprimido"""
+    pasta = os.path.join(api.STORIES_DIR, f"estaticos_{uuid.uuid4().hex[:8]}")
+    os.makedirs(pasta)
+    with open(os.path.join(pasta, "capa_v2.png"), "wb") as f:
+        f.write(CONTEUDO_IMAGEM)
+    dados = json.dumps({"title": "Teste", "parts": ["a" * 500]}).encode("utf-8")
+    with open(os.path.join(pasta, "story.json"), "wb") as f:
+        f.write(dados)
+    with open(os.path.join(pasta, "story.json.gz"), "wb") as f:
+        f.write(gzip.compress(dados))
+    return f"/historias/{os.path.basename(pasta)}", pasta, dados
+
+
+@pytest.fixture
+def cliente():
+    # Sem o `with`: o lifespan desligaria os pools de processos compartilhados pelos outros testes
+    return TestClient(api.app)
+
+
+def test_imagem_com_etag_e_immutable(cliente, historia):
+    url, _, _ = historia
+    resposta = cliente.get(f"{url}/capa_v2.png")
+    assert resposta.status_code == 200
+    assert resposta.content == CONTEUDO_IMAGEM
+    assert resposta.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert resposta.headers["etag"].startswith('"')
+
+    repetida = cliente.get(f"{url}/capa_v2.png", headers={"If-None-Match": resposta.headers["etag"]})
+    assert repetida.status_code == 304
+    assert repetida.content == b""
+    assert cliente.get(f"{url}/capa_v2.png", headers={"If-None-Match": '"outro"'}).status_code == 200
+
+
+def test_etag_muda_quando_o_arquivo_muda(cliente, historia):
+    url, pasta, dados = historia
+    antes = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "identity"}).headers["etag"]
+    caminho = os.path.join(pasta, "story.json")
+    with open(caminho, "wb") as f:
+        f.write(dados + b" ")
+    os.utime(caminho, ns=(os.stat(caminho).st_atime_ns, os.stat(caminho).st_mtime_ns + 10**9))
+    depois = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "identity", "If-None-Match": antes})
+    assert depois.status_code == 200
+    assert depois.headers["etag"] != antes
+
+
+def test_range_e_if_range(cliente, historia):
+    url, _, _ = historia
+    etag = cliente.get(f"{url}/capa_v2.png").headers["etag"]
+
+    parcial = cliente.get(f"{url}/capa_v2.png", headers={"Range": "bytes=0-9"})
+    assert parcial.status_code == 206
+    assert parcial.headers["content-range"] == f"bytes 0-9/{len(CONTEUDO_IMAGEM)}"
+    assert parcial.content == CONTEUDO_IMAGEM[:10]
+
+    mesma_versao = cliente.get(f"{url}/capa_v2.png", headers={"Range": "bytes=10-19", "If-Range": etag})
+    assert mesma_versao.status_code == 206
+    assert mesma_versao.content == CONTEUDO_IMAGEM[10:20]
+
+    # Versão diferente da que o cliente tem: o arquivo inteiro volta
+    outra_versao = cliente.get(f"{url}/capa_v2.png", headers={"Range": "bytes=10-19", "If-Range": '"velho"'})
+    assert outra_versao.status_code == 200
+    assert outra_versao.content == CONTEUDO_IMAGEM
+
+
+def test_story_json_pre_comprimido(cliente, historia):
+    url, _, dados = historia
+    comprimida = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "gzip"})
+    assert comprimida.status_code == 200
+    assert comprimida.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in comprimida.headers["vary"]
+    assert comprimida.headers["cache-control"] == "no-cache"
+    assert comprimida.headers["content-type"].startswith("application/json")
+    assert comprimida.content == dados
+
+    simples = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in simples.headers
+    assert "Accept-Encoding" in simples.headers["vary"]
+    assert simples.content == dados
+    # Cada representação tem o próprio ETag
+    assert simples.headers["etag"] != comprimida.headers["etag"]
+
+    recusada = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "content-encoding" not in recusada.headers
+
+
+def test_brotli_tem_preferencia(cliente, historia):
+    brotli = pytest.importorskip("brotli")
+    url, pasta, dados = historia
+    with open(os.path.join(pasta, "story.json.br"), "wb") as f:
+        f.write(brotli.compress(dados))
+    resposta = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "gzip, br"})
+    assert resposta.headers["content-encoding"] == "br"
+    assert resposta.content == dados
+
+
+def test_comprimido_mais_antigo_que_o_original_e_ignorado(cliente, historia):
+    url, pasta, dados = historia
+    caminho = os.path.join(pasta, "story.json")
+    info = os.stat(caminho + ".gz")
+    os.utime(caminho, ns=(info.st_atime_ns, info.st_mtime_ns + 10**9))
+    resposta = cliente.get(f"{url}/story.json", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in resposta.headers
+    assert resposta.content == dados